@@ -0,0 +1,222 @@
+# Cold storage for messages past their room type's CHAT_RETENTION_DAYS. archive_messages moves
+# them into per-room files under CHAT_ARCHIVE_DIR/<room uuid>/: append-only <n>.seg segments of
+# zlib-compressed blocks, and an index with one fixed-size record per block (its cursors, seq range
+# and position). Blocks are fsynced before their index record, so readers, which memory-map both
+# files, only ever see complete blocks. Archived messages page like hot history but aren't searched
+# or counted as unread.
+import bisect
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from chat.models import MessageModel
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+Block = namedtuple('Block', [
+    'first_ts', 'first_pk', 'last_ts', 'last_pk', 'first_seq', 'last_seq', 'segment', 'offset', 'length', 'count'
+])
+BLOCK = struct.Struct('<qqqqQQIQII')
+
+
+# Archived messages come back as these rather than MessageModel instances, which cost
+# far more to build than a page read spends on everything else. They carry what
+# serialize_message and the history cursors read.
+ArchivedUser = namedtuple('ArchivedUser', ['pk', 'username'])
+ArchivedMessage = namedtuple('ArchivedMessage', ['pk', 'seq', 'text', 'user', 'group_id', 'created_at'])
+
+
+def _message(row, group_id):
+    pk, seq, user_id, username, text, ts = row
+    return ArchivedMessage(pk, seq, text, ArchivedUser(user_id, username), group_id, from_timestamp(ts))
+
+
+def to_timestamp(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def from_timestamp(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+class _Index:
+    # A read-only sequence of Block records over the memory-mapped index file.
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.buffer) // BLOCK.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Block._make(BLOCK.unpack_from(self.buffer, i * BLOCK.size))
+
+
+def _map(path):
+    # mmap cannot map an empty file; a missing or empty one reads as no data.
+    try:
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return b''
+
+
+class RoomArchive:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.index_path = self.directory / 'index'
+
+    def _segment_path(self, segment):
+        return self.directory / f'{segment}.seg'
+
+    def last_block(self):
+        index = _Index(_map(self.index_path))
+        return index[-1] if len(index) else None
+
+    def last_seq(self):
+        block = self.last_block()
+        return block.last_seq if block else 0
+
+    def append(self, messages, block_size, segment_size):
+        # ``messages`` are ordered by (created_at, id) and must all be newer than the archive's tail.
+        if not messages:
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        last = self.last_block()
+        segment = last.segment if last else 1
+        if self._segment_path(segment).exists() and self._segment_path(segment).stat().st_size >= segment_size:
+            segment += 1
+
+        blocks = []
+        with open(self._segment_path(segment), 'ab') as file:
+            offset = file.tell()
+            for i in range(0, len(messages), block_size):
+                chunk = messages[i:i + block_size]
+                data = zlib.compress(json.dumps([
+                    [msg.pk, msg.seq, msg.user_id, msg.user.username, msg.text, to_timestamp(msg.created_at)]
+                    for msg in chunk
+                ]).encode())
+                file.write(data)
+                blocks.append(Block(
+                    to_timestamp(chunk[0].created_at), chunk[0].pk,
+                    to_timestamp(chunk[-1].created_at), chunk[-1].pk,
+                    chunk[0].seq, max(msg.seq for msg in chunk),
+                    segment, offset, len(data), len(chunk)
+                ))
+                offset += len(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+        with open(self.index_path, 'ab') as file:
+            file.write(b''.join(BLOCK.pack(*block) for block in blocks))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _read_block(self, segments, block):
+        if block.segment not in segments:
+            segments[block.segment] = _map(self._segment_path(block.segment))
+        return json.loads(zlib.decompress(segments[block.segment][block.offset:block.offset + block.length]))
+
+    def read_before(self, group_id, limit, cursor=None):
+        # Up to ``limit`` messages older than ``cursor`` (created_at, id), newest first.
+        index = _Index(_map(self.index_path))
+        if cursor is None:
+            end = len(index)
+        else:
+            cursor = (to_timestamp(cursor[0]), cursor[1])
+            end = bisect.bisect_left(index, cursor, key=lambda block: (block.first_ts, block.first_pk))
+
+        rows, segments = [], {}
+        for i in range(end - 1, -1, -1):
+            block = self._read_block(segments, index[i])
+            rows += [row for row in reversed(block) if cursor is None or (row[5], row[0]) < cursor]
+            if len(rows) >= limit:
+                break
+        return [_message(row, group_id) for row in rows[:limit]]
+
+    def read_after(self, group_id, limit, cursor):
+        # Up to ``limit`` messages newer than ``cursor`` (created_at, id), oldest first.
+        index = _Index(_map(self.index_path))
+        cursor = (to_timestamp(cursor[0]), cursor[1])
+        start = bisect.bisect_right(index, cursor, key=lambda block: (block.last_ts, block.last_pk))
+
+        rows, segments = [], {}
+        for i in range(start, len(index)):
+            block = self._read_block(segments, index[i])
+            rows += [row for row in block if (row[5], row[0]) > cursor]
+            if len(rows) >= limit:
+                break
+        return [_message(row, group_id) for row in rows[:limit]]
+
+    def contains(self, msg):
+        found = self.read_after(msg.group_id, 1, (msg.created_at, msg.pk - 1))
+        return bool(found) and found[0].pk == msg.pk
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def get_archive(group_id):
+    return RoomArchive(Path(settings.CHAT_ARCHIVE_DIR) / str(group_id))
+
+
+def last_archived(group_ids):
+    # The newest archived message of each of these rooms that has any.
+    found = {}
+    for group_id in group_ids:
+        messages = get_archive(group_id).read_before(group_id, 1)
+        if messages:
+            found[group_id] = messages[0]
+    return found
+
+
+def archive_room(room, cutoff, batch_size):
+    archive = get_archive(room.pk)
+    archived = 0
+    messages = MessageModel.objects.select_related('user').filter(group=room, created_at__lt=cutoff)
+    queryset = messages.order_by('created_at', 'pk')
+    while True:
+        batch = list(queryset[:batch_size])
+        if not batch:
+            return archived
+
+        last = archive.last_block()
+        tail = (last.last_ts, last.last_pk) if last else (-1, -1)
+        new = [msg for msg in batch if (to_timestamp(msg.created_at), msg.pk) > tail]
+        done = []
+        # Older ones were archived by a run that died before deleting them, unless a clock
+        # went backwards. Those stay in the table: the append-only index can't take them.
+        for msg in batch[:len(batch) - len(new)]:
+            if archive.contains(msg):
+                done.append(msg)
+            else:
+                logger.warning('Message %s is older than the archive of room %s and stays in the table', msg.pk, room.pk)
+
+        archive.append(new, settings.CHAT_ARCHIVE_BLOCK_SIZE, settings.CHAT_ARCHIVE_SEGMENT_SIZE)
+        with transaction.atomic():
+            MessageModel.objects.filter(pk__in=[msg.pk for msg in done + new]).delete()
+        archived += len(new)
+
+        created_at, pk = batch[-1].created_at, batch[-1].pk
+        queryset = messages.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk)
+        ).order_by('created_at', 'pk')
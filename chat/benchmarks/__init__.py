@@ -0,0 +1,9 @@
+from . import batching, database, encoding, layers, websocket
+
+SUITES = {
+    'batching': batching.run,
+    'database': database.run,
+    'encoding': encoding.run,
+    'layers': layers.run,
+    'websocket': websocket.run,
+}
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+
+from chat.benchmarks.common import test_environment
+from chat.benchmarks.websocket import Client, create_fixtures
+from chat.utils import encode_frame
+
+MESSAGE = {
+    'id': 232073017633664,
+    'seq': 1,
+    'message': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt',
+    'user': 'benchmark_user',
+    'sent_at': '18/10/2026, 18:27',
+}
+
+
+async def _receive_all(client, expected):
+    frames = received = 0
+    while received < expected:
+        response = await client.communicator.receive_json_from(timeout=30)
+        frames += 1
+        received += len(response['message']) if response['event'] == 'messages.batch' else 1
+    return frames
+
+
+async def _burst(application, tokens, room, messages, batched):
+    clients = [Client(application, f'/chat/{room.uuid}/', token) for token in tokens]
+    for client in clients:
+        await client.connect()
+        if batched:
+            await client.request('batch.mode', {'enabled': True})
+
+    layer = get_channel_layer()
+    frame = encode_frame(MESSAGE, event='chat.message')
+    started = time.perf_counter()
+    receivers = [asyncio.ensure_future(_receive_all(client, messages)) for client in clients]
+    # One busy room: the broadcasts arrive back to back, as they would from many senders.
+    for _ in range(messages):
+        await layer.group_send(str(room.uuid), {'type': 'chat.message', 'text': frame})
+    frames = await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - started
+
+    for client in clients:
+        await client.disconnect()
+
+    deliveries = messages * len(clients)
+    return {
+        'messages': messages,
+        'clients': len(clients),
+        'frames_per_client': round(sum(frames) / len(frames), 1),
+        'elapsed_ms': round(elapsed * 1000, 3),
+        'throughput_per_s': round(deliveries / elapsed, 1),
+    }
+
+
+def run(clients=50, messages=20, **options):
+    from core.asgi import application
+
+    # A burst that fills several batches but stays under the channel layer's default
+    # capacity of 100 queued messages per channel, past which group_send drops messages.
+    messages = min(messages * 4, 90)
+    with test_environment():
+        users, tokens, room = create_fixtures(clients)
+        results = {
+            'unbatched': asyncio.run(_burst(application, tokens, room, messages, batched=False)),
+            'batched': asyncio.run(_burst(application, tokens, room, messages, batched=True)),
+        }
+
+    results['speedup'] = round(results['batched']['throughput_per_s'] / results['unbatched']['throughput_per_s'], 2)
+    return {
+        'suite': 'batching',
+        'scenarios': results,
+    }
@@ -0,0 +1,47 @@
+import math
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from django.db import connection
+
+from chat.db import close_thread_connections
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def summarize(latencies, elapsed):
+    return {
+        'operations': len(latencies),
+        'throughput_per_s': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+@contextmanager
+def test_environment():
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict['TEST']
+    old_test_name = test_settings.get('NAME')
+    if connection.vendor == 'sqlite' and not old_test_name:
+        # A shared-cache in-memory database fails concurrent writers with "table is locked"
+        # instead of waiting for the lock, so measure against a file like a real deployment.
+        test_settings['NAME'] = str(Path(tempfile.mkdtemp()) / 'benchmark.sqlite3')
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    old_layer = channel_layers.backends.get('default')
+    channel_layers.backends['default'] = InMemoryChannelLayer()
+    try:
+        yield
+    finally:
+        close_thread_connections()
+        channel_layers.backends.pop('default')
+        if old_layer is not None:
+            channel_layers.backends['default'] = old_layer
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = old_test_name
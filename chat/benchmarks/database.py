@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection
+
+from chat.benchmarks.common import summarize, test_environment
+from chat.db import database_sync_to_async, database_write_to_async
+from chat.models import ChatRoomModel, MessageModel, ParticipantModel, UserModel
+
+
+def create_fixtures(clients):
+    UserModel.objects.bulk_create([UserModel(username=f'bench_db_{i}') for i in range(clients)])
+    users = list(UserModel.objects.filter(username__startswith='bench_db_').order_by('pk'))
+    room = ChatRoomModel.objects.create(name='bench_db', type='group')
+    ParticipantModel.objects.bulk_create([
+        ParticipantModel(user=user, group=room, is_creator=i == 0) for i, user in enumerate(users)
+    ])
+    return users, room
+
+
+def write_message(room, user, text):
+    MessageModel.objects.create(text=text, group=room, user=user)
+
+
+def read_history(room):
+    messages = MessageModel.objects.select_related('user').filter(group=room).order_by('-created_at', '-pk')
+    return [(msg.pk, msg.text, msg.user.username) for msg in messages[:settings.CHAT_MESSAGE_PAGE_SIZE]]
+
+
+async def _timed_loop(operations, call, *args):
+    latencies, errors = [], 0
+    for i in range(operations):
+        started = time.perf_counter()
+        try:
+            await call(*args, i)
+        except OperationalError:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+    return latencies, errors
+
+
+async def _scenario(clients, operations, call, *args):
+    started = time.perf_counter()
+    runs = await asyncio.gather(*(_timed_loop(operations, call, *args, client) for client in clients))
+    result = summarize([latency for latencies, _ in runs for latency in latencies], time.perf_counter() - started)
+    result['errors'] = sum(errors for _, errors in runs)
+    return result
+
+
+async def _run(users, room, operations):
+    queued_write = database_write_to_async(write_message)
+    pooled_write = database_sync_to_async(write_message)
+    pooled_read = database_sync_to_async(read_history)
+
+    async def write(executor, user, i):
+        await executor(room, user, f'{user.username} message {i}')
+
+    async def read(user, i):
+        await pooled_read(room)
+
+    results = {
+        'write': await _scenario(users, operations, write, queued_write),
+        'write.pooled': await _scenario(users, operations, write, pooled_write),
+        'read': await _scenario(users, operations, read),
+    }
+
+    # Half the clients read while the other half writes through the queue.
+    readers, writers = users[::2], users[1::2]
+    results['read.during_write'], results['write.during_read'] = await asyncio.gather(
+        _scenario(readers, operations, read),
+        _scenario(writers, operations, write, queued_write),
+    )
+    return results
+
+
+def run(clients=50, messages=20, **options):
+    with test_environment():
+        users, room = create_fixtures(clients)
+        journal_mode = None
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                journal_mode = cursor.fetchone()[0]
+        results = asyncio.run(_run(users, room, messages))
+
+    return {
+        'suite': 'database',
+        'clients': clients,
+        'operations_per_client': messages,
+        'database': connection.vendor,
+        'journal_mode': journal_mode,
+        'db_threads': settings.CHAT_DB_THREADS,
+        'scenarios': results,
+    }
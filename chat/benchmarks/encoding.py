@@ -0,0 +1,45 @@
+import json
+import time
+
+from chat.utils import encode_frame
+
+MESSAGE = {
+    'id': 232073017633664,
+    'message': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt',
+    'user': 'benchmark_user',
+    'sent_at': '18/10/2026, 18:27',
+}
+
+
+def _best_of(rounds, func):
+    timings = []
+    for _ in range(rounds):
+        started = time.process_time()
+        func()
+        timings.append(time.process_time() - started)
+    return min(timings)
+
+
+def run(recipients=2000, rounds=20, **options):
+    # What every receiving consumer did before: re-encode the same envelope.
+    def per_recipient():
+        event = {'type': 'chat.message', 'message': MESSAGE}
+        for _ in range(recipients):
+            json.dumps({'status': 'ok', 'event': event['type'], 'message': event['message']})
+
+    # The sender encodes once and receivers forward the text unchanged.
+    def pre_encoded():
+        event = {'type': 'chat.message', 'text': encode_frame(MESSAGE, event='chat.message')}
+        for _ in range(recipients):
+            event['text']
+
+    before = _best_of(rounds, per_recipient)
+    after = _best_of(rounds, pre_encoded)
+    return {
+        'suite': 'encoding',
+        'recipients': recipients,
+        'per_recipient_encode_ms': round(before * 1000, 3),
+        'encode_once_ms': round(after * 1000, 3),
+        'cpu_saved_per_broadcast_ms': round((before - after) * 1000, 3),
+        'speedup': round(before / after, 1) if after else None,
+    }
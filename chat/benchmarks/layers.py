@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+from chat.benchmarks.common import summarize
+from chat.layers import HybridChannelLayer
+
+
+class RemoteLayer(InMemoryChannelLayer):
+    # In-memory stand-in for Redis: every call that would be a network round trip waits ``rtt`` first.
+    def __init__(self, rtt):
+        super().__init__(capacity=1000)
+        self.rtt = rtt
+
+    async def send(self, channel, message):
+        await asyncio.sleep(self.rtt)
+        await super().send(channel, message)
+
+    async def group_add(self, group, channel):
+        await asyncio.sleep(self.rtt)
+        await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await asyncio.sleep(self.rtt)
+        await super().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        # Like channels_redis, one round trip for the whole group.
+        await asyncio.sleep(self.rtt)
+        for channel in list(self.groups.get(group, ())):
+            try:
+                await InMemoryChannelLayer.send(self, channel, message)
+            except ChannelFull:
+                pass
+
+
+async def _deliveries(members, rounds):
+    # members: (layer, channel) pairs in one group; the first member's layer sends.
+    sender = members[0][0]
+    latencies = []
+
+    async def receive(layer, channel, started):
+        await layer.receive(channel)
+        latencies.append(time.perf_counter() - started)
+
+    async def deliver(i):
+        started = time.perf_counter()
+        receivers = [asyncio.ensure_future(receive(layer, channel, started)) for layer, channel in members]
+        await sender.group_send('room', {'type': 'chat.message', 'text': f'message {i}'})
+        await asyncio.gather(*receivers)
+
+    await deliver('warm-up')
+    latencies.clear()
+    began = time.perf_counter()
+    for i in range(rounds):
+        await deliver(i)
+    return summarize(latencies, time.perf_counter() - began)
+
+
+async def _scenario(nodes, clients, rounds):
+    members = []
+    for i in range(clients):
+        layer = nodes[i % len(nodes)]
+        channel = await layer.new_channel()
+        await layer.group_add('room', channel)
+        members.append((layer, channel))
+    # Let the nodes of the hybrid scenarios find each other before measuring.
+    await asyncio.sleep(0.1)
+    return await _deliveries(members, rounds)
+
+
+async def _run(clients, rounds, rtt):
+    results = {}
+    results['remote.single_node'] = await _scenario([RemoteLayer(rtt)], clients, rounds)
+
+    remote = RemoteLayer(rtt)
+    results['hybrid.single_node'] = await _scenario(
+        [HybridChannelLayer(remote, capacity=1000, discovery_timeout=0.05)], clients, rounds
+    )
+
+    remote = RemoteLayer(rtt)
+    results['hybrid.multi_node'] = await _scenario(
+        [HybridChannelLayer(remote, capacity=1000, discovery_timeout=0.05) for _ in range(2)], clients, rounds
+    )
+    return results
+
+
+def run(clients=50, rounds=20, remote_rtt=0.5, **options):
+    return {
+        'suite': 'layers',
+        'clients': clients,
+        'rounds': rounds,
+        'remote_rtt_ms': remote_rtt,
+        'scenarios': asyncio.run(_run(clients, rounds, remote_rtt / 1000)),
+    }
@@ -0,0 +1,126 @@
+import asyncio
+import time
+import uuid
+
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from chat.benchmarks.common import summarize, test_environment
+from chat.models import ChatRoomModel, ParticipantModel, UserModel
+
+
+def create_fixtures(clients):
+    prefix = uuid.uuid4().hex[:8]
+    UserModel.objects.bulk_create([UserModel(username=f'bench_{prefix}_{i}') for i in range(clients)])
+    users = list(UserModel.objects.filter(username__startswith=f'bench_{prefix}_').order_by('pk'))
+    tokens = Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users])
+    room = ChatRoomModel.objects.create(name=f'bench_{prefix}', type='group')
+    ParticipantModel.objects.bulk_create([
+        ParticipantModel(user=user, group=room, is_creator=i == 0) for i, user in enumerate(users)
+    ])
+    return users, [token.key for token in tokens], room
+
+
+class Client:
+    def __init__(self, application, path, token):
+        self.communicator = WebsocketCommunicator(application, f'{path}?authorization={token}')
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=10)
+        if not connected:
+            raise RuntimeError('Benchmark client could not connect')
+
+    async def request(self, event, data, match=None):
+        await self.communicator.send_json_to({'event': event, 'data': data})
+        while True:
+            response = await self.communicator.receive_json_from(timeout=30)
+            if response['event'] == (match or event):
+                return response
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+
+async def _timed(latencies, coroutine):
+    started = time.perf_counter()
+    result = await coroutine
+    latencies.append(time.perf_counter() - started)
+    return result
+
+
+async def _scenario(operations):
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(_timed(latencies, operation) for operation in operations))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+async def _run(application, users, tokens, room, messages):
+    room_path = f'/chat/{room.uuid}/'
+    results = {}
+
+    clients = [Client(application, room_path, token) for token in tokens]
+    results['connect'] = await _scenario(client.connect() for client in clients)
+
+    async def send_messages(client, user):
+        latencies = []
+        for i in range(messages):
+            text = f'{user.username} message {i}'
+            started = time.perf_counter()
+            await client.communicator.send_json_to({'event': 'send.message', 'data': {'message': text}})
+            while True:
+                response = await client.communicator.receive_json_from(timeout=30)
+                if response['message'].get('message') == text:
+                    break
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    started = time.perf_counter()
+    per_client = await asyncio.gather(*(send_messages(client, user) for client, user in zip(clients, users)))
+    results['send.message'] = summarize(
+        [latency for latencies in per_client for latency in latencies], time.perf_counter() - started
+    )
+
+    # Let the remaining broadcasts arrive before measuring history reads.
+    await asyncio.sleep(0.5)
+    for client in clients:
+        while not await client.communicator.receive_nothing(timeout=0.01):
+            await client.communicator.receive_output()
+
+    results['list.message'] = await _scenario(client.request('list.message', {}) for client in clients)
+
+    for client in clients:
+        await client.disconnect()
+
+    main_clients = [Client(application, '/', token) for token in tokens]
+    for client in main_clients:
+        await client.connect()
+    member_ids = [user.pk for user in users[:10]]
+    results['group.create'] = await _scenario(
+        client.request('group.create', {'name': f'bench_group_{i}', 'participants': member_ids, 'type': 'group'})
+        for i, client in enumerate(main_clients)
+    )
+    for client in main_clients:
+        await client.disconnect()
+
+    return results
+
+
+def run(clients=50, messages=20, **options):
+    from core.asgi import application
+
+    with test_environment():
+        users, tokens, room = create_fixtures(clients)
+        # Measure the server, not the limits a real client is held to.
+        with override_settings(CHAT_RATE_LIMITS={}):
+            results = asyncio.run(_run(application, users, tokens, room, messages))
+
+    return {
+        'suite': 'websocket',
+        'clients': clients,
+        'messages_per_client': messages,
+        'database': connection.vendor,
+        'scenarios': results,
+    }
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chat.metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_GROUP = 'chat.cache'
+
+RoomMetadata = namedtuple('RoomMetadata', ['group', 'member_ids', 'creator_id'])
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+caches = {}
+
+
+def register(name, cache):
+    caches[name] = cache
+    return cache
+
+
+room_cache = register('rooms', TTLCache(settings.CHAT_ROOM_CACHE_SIZE, settings.CHAT_ROOM_CACHE_TTL))
+token_cache = register('tokens', TTLCache(settings.CHAT_TOKEN_CACHE_SIZE, settings.CHAT_TOKEN_CACHE_TTL))
+directory_cache = register('directory', TTLCache(settings.CHAT_DIRECTORY_CACHE_SIZE, settings.CHAT_DIRECTORY_CACHE_TTL))
+
+
+@register_collector
+def cache_metrics():
+    return [
+        ('chat_cache_hits_total', 'counter', 'Cache lookups that found a live entry',
+         [({'cache': name}, cache.hits) for name, cache in caches.items()]),
+        ('chat_cache_misses_total', 'counter', 'Cache lookups that missed or found an expired entry',
+         [({'cache': name}, cache.misses) for name, cache in caches.items()]),
+        ('chat_cache_entries', 'gauge', 'Entries currently held in the cache',
+         [({'cache': name}, len(cache)) for name, cache in caches.items()]),
+    ]
+
+
+async def invalidate(name, key):
+    caches[name].pop(key)
+    await get_channel_layer().group_send(INVALIDATION_GROUP, {
+        'type': 'cache.invalidate',
+        'cache': name,
+        'key': key,
+    })
+
+
+# Other broadcasts on INVALIDATION_GROUP, by event type, for state that has to be shared
+# between processes the same way.
+handlers = {}
+
+
+def on_broadcast(event_type, handler):
+    handlers[event_type] = handler
+
+
+_listener = None
+
+
+async def _keep_subscribed(channel_layer, channel):
+    interval = getattr(channel_layer, 'group_expiry', 86400) / 2
+    while True:
+        await channel_layer.group_add(INVALIDATION_GROUP, channel)
+        await asyncio.sleep(interval)
+
+
+async def _listen():
+    while True:
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        subscription = asyncio.ensure_future(_keep_subscribed(channel_layer, channel))
+        try:
+            while True:
+                event = await channel_layer.receive(channel)
+                if event['type'] in handlers:
+                    handlers[event['type']](event)
+                    continue
+                cache = caches.get(event.get('cache'))
+                if cache is not None:
+                    cache.pop(event.get('key'))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Cache invalidation listener failed, restarting')
+            for cache in caches.values():
+                cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            subscription.cancel()
+
+
+def start_invalidation_listener():
+    global _listener
+    loop = asyncio.get_running_loop()
+    if _listener is None or _listener.done() or _listener.get_loop() is not loop:
+        _listener = loop.create_task(_listen())
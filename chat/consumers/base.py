@@ -1,23 +1,91 @@
+from asgiref.sync import sync_to_async
+from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+from django.utils import timezone
 
-from chat.models import ChatRoomModel, ParticipantModel, UserModel
+from chat.archive import last_archived
+from chat.cache import directory_cache, invalidate, start_invalidation_listener
+from chat.db import database_write_to_async
+from chat.dbrouters import database_user, pinned_users, replica_reads, share_pin
+from chat.deletion import delete_group
+from chat.fanout import notify_added_to_group
+from chat.metrics import connections, event_latency, events_total, rate_limited
+from chat.models import ChatRoomModel, MessageModel, ParticipantModel, UserModel
+from chat.outbox import Outbox
+from chat.ratelimit import RateLimiter
+from chat.utils import spawn
 
 
 class BaseConsumer(AsyncJsonWebsocketConsumer):
+    # Channel layer events whose handlers only forward a frame. They never touch the database,
+    # so they skip the connection cleanup (a thread hop) channels runs before every handler.
+    frame_events = frozenset()
+
+    async def dispatch(self, message):
+        if message['type'] in self.frame_events:
+            return await getattr(self, get_handler_name(message))(message)
+        return await super().dispatch(message)
+
     async def connect(self):
+        start_invalidation_listener()
         await self.accept()
+        # accept() and close() go through base_send as well, so from here on every frame
+        # to this socket passes the outbox. It needs the transport daphne writes to.
+        if 'transport' in self.scope:
+            self.outbox = Outbox(
+                self.base_send,
+                self.scope['transport'],
+                maxsize=settings.CHAT_SEND_QUEUE_SIZE,
+                policy=settings.CHAT_SEND_QUEUE_POLICY,
+                consumer=type(self).__name__,
+                high_water=settings.CHAT_SEND_BUFFER_HIGH_WATER,
+            )
+            self.base_send = self.outbox.send
+        self.rate_limiter = RateLimiter(self.scope['user'].id)
+        self.counted_connection = True
+        connections.inc(consumer=type(self).__name__)
         if self.scope['user'].is_anonymous:
             await self._throw_error(message={'detail': 'Authorization failed'})
             await self.close(code=1000)
             return
 
+    async def disconnect(self, code):
+        if hasattr(self, 'outbox'):
+            self.outbox.close()
+        if getattr(self, 'counted_connection', False):
+            self.counted_connection = False
+            connections.dec(consumer=type(self).__name__)
+        return await super().disconnect(code)
+
     async def receive_json(self, content, **kwargs):
         message = await self.parse_content(content)
         if message:
-            event = message['event'].replace('.', '_')
-            return await getattr(self, f'event_{event}', self.method_undefined)(message)
+            handler = getattr(self, f"event_{message['event'].replace('.', '_')}", None)
+            event = message['event'].replace('_', '.') if handler else 'undefined'
+            events_total.inc(consumer=type(self).__name__, event=event)
+            limited = self.rate_limiter.check(event)
+            if limited:
+                scope, retry_after = limited
+                rate_limited.inc(consumer=type(self).__name__, event=event, scope=scope)
+                return await self._throw_error(
+                    message={
+                        'detail': f'Rate limit exceeded for this {scope}',
+                        'retry_after': round(retry_after, 3),
+                    },
+                    event=message['event']
+                )
+            user_id = self.scope['user'].id
+            with event_latency.time(consumer=type(self).__name__, event=event), database_user(user_id):
+                pinned_until = pinned_users.get(user_id)
+                result = await (handler or self.method_undefined)(message)
+            await share_pin(user_id, pinned_until)
+            return result
 
+        events_total.inc(consumer=type(self).__name__, event='invalid')
         return await self._throw_error(
             message={
                 'detail': 'Invalid input',
@@ -43,6 +111,9 @@ class BaseConsumer(AsyncJsonWebsocketConsumer):
                 and isinstance(content.get('data'), dict)):
             return content
 
+    async def _send_frame(self, event):
+        await self.send(text_data=event['text'])
+
     async def _send_message(self, message, event=None):
         await self.send_json(content={
             'status': 'ok',
@@ -59,9 +130,11 @@ class BaseConsumer(AsyncJsonWebsocketConsumer):
 
 
 class MainConsumer(BaseConsumer):
+    frame_events = frozenset({'send.notification'})
+
     async def connect(self):
         await super().connect()
-        self.channel = f'user_{self.scope['user'].id}'
+        self.channel = f"user_{self.scope['user'].id}"
         await self.channel_layer.group_add(self.channel, self.channel_name)
 
     async def disconnect(self, code):
@@ -69,6 +142,8 @@ class MainConsumer(BaseConsumer):
         return await super().disconnect(code)
 
     async def send_notification(self, event):
+        if 'text' in event:
+            return await self._send_frame(event)
         return await self._send_message(message=event['message'], event=event['type'])
 
     async def event_group_create(self, massage):
@@ -110,28 +185,69 @@ class MainConsumer(BaseConsumer):
         )
 
     async def event_group_list(self, message):
-        return await self._send_message(
-            message=await self.group_list(self.scope['user']),
+        after = message['data'].get('after')
+        limit = message['data'].get('limit', settings.CHAT_GROUP_PAGE_SIZE)
+        if (after is None or isinstance(after, int) and not isinstance(after, bool)) \
+                and isinstance(limit, int) and not isinstance(limit, bool) and limit > 0:
+            return await self._send_message(
+                message=await self.group_list(
+                    self.scope['user'],
+                    after=after,
+                    limit=min(limit, settings.CHAT_GROUP_PAGE_SIZE_MAX)
+                ),
+                event=message['event']
+            )
+
+        return await self._throw_error(
+            message={
+                'detail': 'Invalid data',
+                'valid_data_example': {
+                    'after': 'next cursor from the previous page (optional)',
+                    'limit': settings.CHAT_GROUP_PAGE_SIZE,
+                }
+            },
             event=message['event']
         )
 
     async def event_user_list(self, message):
-        return await self._send_message(
-            message=await self.user_list(),
+        prefix = message['data'].get('prefix', '')
+        after = message['data'].get('after')
+        limit = message['data'].get('limit', settings.CHAT_USER_PAGE_SIZE)
+        if isinstance(prefix, str) and (after is None or isinstance(after, str)) \
+                and isinstance(limit, int) and not isinstance(limit, bool) and limit > 0:
+            return await self._send_message(
+                message=await self.user_list(
+                    prefix=prefix,
+                    after=after,
+                    limit=min(limit, settings.CHAT_USER_PAGE_SIZE_MAX)
+                ),
+                event=message['event']
+            )
+
+        return await self._throw_error(
+            message={
+                'detail': 'Invalid data',
+                'valid_data_example': {
+                    'prefix': 'beginning of a username (optional)',
+                    'after': 'next cursor from the previous page (optional)',
+                    'limit': settings.CHAT_USER_PAGE_SIZE,
+                }
+            },
             event=message['event']
         )
 
     async def event_group_delete(self, message):
         if isinstance(message['data'].get('group'), str):
             group = message['data']['group']
-            available_groups = {
-                group['group_name']: group['group_uuid']
-                for group in await self.group_list(self.scope['user'])
-                if group['is_creator']
-            }
+            group_uuid = await self.get_created_group(group)
 
-            if group in available_groups.keys():
-                await self.delete_group(available_groups[group])
+            if group_uuid:
+                await self.hide_group(group_uuid)
+                await invalidate('rooms', group_uuid)
+                await self.channel_layer.group_send(group_uuid, {'type': 'room.deleted'})
+                # Messages and participants go in batches; progress arrives as
+                # 'group deletion' notifications on this user's channel.
+                spawn(delete_group(group_uuid, group, self.scope['user'].id))
                 return await self._send_message(
                     message={
                         'detail': f'Group {group} was deleted'
@@ -146,45 +262,114 @@ class MainConsumer(BaseConsumer):
             }
         })
 
-    @database_sync_to_async
+    @database_write_to_async
     def add_participant(self, group, user):
         participant = ParticipantModel(user=user, group=group)
         participant.save()
 
-    @database_sync_to_async
+    @database_write_to_async
     def create_group(self, name, participants, chat_type):
         if (chat_type not in ChatRoomModel.TYPES or
                 (chat_type == 'dialog' and len(participants) > 1)):
             return
-        group = ChatRoomModel.objects.create(name=name, type=chat_type)
+        participants = [pk for pk in participants if isinstance(pk, int) and not isinstance(pk, bool)]
 
-        ParticipantModel.objects.create(group=group, user=self.scope['user'], is_creator=True)
-        for participant in participants:
-            user = UserModel.objects.filter(pk=participant).first()
-            if user:
-                ParticipantModel.objects.get_or_create(group=group, user=user)
+        with transaction.atomic():
+            group = ChatRoomModel.objects.create(name=name, type=chat_type)
+            ParticipantModel.objects.create(group=group, user=self.scope['user'], is_creator=True)
+
+            user_ids = list(
+                UserModel.objects.filter(pk__in=participants)
+                .exclude(pk=self.scope['user'].id)
+                .values_list('pk', flat=True)
+            )
+            ParticipantModel.objects.bulk_create(
+                [ParticipantModel(group=group, user_id=user_id) for user_id in user_ids],
+                ignore_conflicts=True
+            )
+            transaction.on_commit(lambda: notify_added_to_group(group, user_ids))
 
         return group
 
-    @database_sync_to_async
-    def delete_group(self, group_uuid):
-        group = ChatRoomModel.objects.get(pk=group_uuid)
-        group.delete()
+    @database_write_to_async
+    def hide_group(self, group_uuid):
+        ChatRoomModel.objects.filter(pk=group_uuid).update(deleted_at=timezone.now())
+
+    async def get_created_group(self, name):
+        group_uuid = await ParticipantModel.objects.filter(
+            user=self.scope['user'], is_creator=True, group__name=name, group__deleted_at__isnull=True
+        ).values_list('group_id', flat=True).afirst()
+        return str(group_uuid) if group_uuid else None
 
-    @database_sync_to_async
-    def group_list(self, user):
+    async def group_list(self, user, limit, after=None):
+        messages = MessageModel.objects.filter(group=OuterRef('group')).order_by()
+        latest = messages.order_by('-seq')[:1]
+        unread = messages.filter(
+            pk__gt=OuterRef('last_read_id')
+        ).exclude(user=user).values('group').annotate(count=Count('pk')).values('count')
+
+        chats = user.chats.filter(group__deleted_at__isnull=True).select_related('group').annotate(
+            unread=Coalesce(Subquery(unread), Value(0)),
+            last_text=Subquery(latest.annotate(preview=Substr('text', 1, settings.CHAT_PREVIEW_LENGTH)).values('preview')),
+            last_sender=Subquery(latest.values('user__username')),
+            last_sent_at=Subquery(latest.values('created_at')),
+        ).order_by('pk')
+        if after is not None:
+            chats = chats.filter(pk__gt=after)
+        with replica_reads():
+            chats = [chat async for chat in chats[:limit + 1]]
+
+        has_more = len(chats) > limit
+        chats = chats[:limit]
+        cold = [chat.group_id for chat in chats if chat.last_sent_at is None]
+        if cold:
+            archived = await sync_to_async(last_archived, thread_sensitive=False)(cold)
+            for chat in chats:
+                if chat.group_id in archived:
+                    msg = archived[chat.group_id]
+                    chat.last_text = msg.text[:settings.CHAT_PREVIEW_LENGTH]
+                    chat.last_sender = msg.user.username
+                    chat.last_sent_at = msg.created_at
         data = []
-        chats = user.chats.all().select_related("group")
         for chat in chats:
             data.append({
                 "group_uuid": str(chat.group.uuid),
                 "group_name": chat.group.name,
                 "group_link": chat.group.link,
-                "is_creator": chat.is_creator
+                "is_creator": chat.is_creator,
+                "unread": chat.unread,
+                "last_message": {
+                    "text": chat.last_text,
+                    "sender": chat.last_sender,
+                    "sent_at": chat.last_sent_at.strftime(format='%d/%m/%Y, %H:%M'),
+                } if chat.last_sent_at else None,
             })
-        return data
+        return {
+            'groups': data,
+            'next': chats[-1].pk if has_more else None,
+        }
+
+    async def user_list(self, prefix, limit, after=None):
+        key = (prefix, after, limit)
+        users = directory_cache.get(key)
+        if users is None:
+            # Two extra rows: one in case the caller is dropped, one to tell whether there is a next page.
+            users = await self.search_users(prefix, limit + 2, after)
+            directory_cache.set(key, users)
+
+        users = [user for user in users if user['id'] != self.scope['user'].id]
+        return {
+            'users': users[:limit],
+            'next': users[limit - 1]['username'] if len(users) > limit else None,
+        }
 
-    @database_sync_to_async
-    def user_list(self):
-        users = UserModel.objects.all().exclude(pk=self.scope['user'].id)
-        return [{'id': user.id, 'username': user.username} for user in users]
+    async def search_users(self, prefix, limit, after=None):
+        # A range on username walks its unique index on every backend,
+        # unlike startswith, which SQLite runs as a case-insensitive LIKE.
+        users = UserModel.objects.filter(
+            username__gte=prefix, username__lt=prefix + '\U0010ffff', username__startswith=prefix
+        ).order_by('username')
+        if after is not None:
+            users = users.filter(username__gt=after)
+        with replica_reads():
+            return [user async for user in users.values('id', 'username')[:limit]]
@@ -1,47 +1,118 @@
+import asyncio
+import base64
+import binascii
+import uuid
+from datetime import datetime, timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
 from .base import BaseConsumer
-from channels.db import database_sync_to_async
+from chat.archive import get_archive
+from chat.cache import RoomMetadata, invalidate, room_cache
+from chat.db import database_sync_to_async, database_write_to_async
+from chat.dbrouters import database_user, pin_to_primary, replica_reads
+from chat.fanout import new_message_notice, notify_added_to_group, send_notifications
+from chat.metrics import channel_layer_send_latency
 from chat.models import ChatRoomModel, ParticipantModel, MessageModel, UserModel
+from chat.presence import get_presence
+from chat.search import search_messages
+from chat.sequence import get_sequence
+from chat.utils import encode_batch, encode_frame, spawn
+from chat.writebehind import message_writer, next_message_id
+
+
+def encode_cursor(msg):
+    value = f'{msg.created_at.isoformat()}|{msg.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        return
+
+
+def serialize_message(msg):
+    return {
+        'id': msg.pk,
+        'seq': msg.seq,
+        'text': msg.text,
+        'sender': msg.user.username,
+        'sent_at': msg.created_at.strftime(format='%d/%m/%Y, %H:%M')
+    }
 
 
 class ChatRoomConsumer(BaseConsumer):
+    frame_events = frozenset({'chat.message'})
+
     async def connect(self):
+        # Broadcast frames waiting for the batch window; None while batching is off.
+        self.batch = None
+        self.batch_flush = None
         await super().connect()
         self.group_id = self.scope['url_route']['kwargs']['chat_room']
-        self.group = await self.get_group()
-        if not self.group:
+        try:
+            self.group_id = str(uuid.UUID(self.group_id))
+            room = await self.get_room()
+        except ValueError:
+            room = None
+        if not room:
             await self._throw_error(message={
                 'detail': 'Group not found'
             })
             return await self.close(1000)
 
-        self.participants = await self.get_participants()
+        self.group = room.group
 
-        if self.scope['user'] not in self.participants:
+        if self.scope['user'].id not in room.member_ids:
             await self._throw_error(message={
                 'detail': 'Access denied'
             })
             return await self.close(1000)
 
         await self.channel_layer.group_add(self.group_id, self.channel_name)
+        self.presence = get_presence()
+        await self.presence.enter(self.group_id, self.scope['user'].id, self.channel_name)
+        if self.presence.expires:
+            self.presence_heartbeat = spawn(self._refresh_presence())
+
+    async def _refresh_presence(self):
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_TTL / 3)
+            await self.presence.refresh(self.group_id, self.scope['user'].id, self.channel_name)
 
     async def disconnect(self, code):
+        if self.batch_flush is not None:
+            self.batch_flush.cancel()
+        if hasattr(self, 'presence'):
+            if hasattr(self, 'presence_heartbeat'):
+                self.presence_heartbeat.cancel()
+            await self.presence.leave(self.group_id, self.scope['user'].id, self.channel_name)
         await self.channel_layer.group_discard(self.group_id, self.channel_name)
         return await super().disconnect(code)
 
     async def _group_send(self, message):
-        await self.channel_layer.group_send(
-            self.group_id,
-            {
-                'type': 'chat.message',
-                'message': message,
-            }
-        )
+        text = encode_frame(message, event='chat.message')
+        with channel_layer_send_latency.time(operation='group_send'):
+            await self.channel_layer.group_send(
+                self.group_id,
+                {
+                    'type': 'chat.message',
+                    'text': text,
+                }
+            )
 
     @staticmethod
     def creator_permission(func):
         async def wrapper(self, *args, **kwargs):
-            creator = await self.get_creator()
-            if creator == self.scope['user']:
+            room = await self.get_room()
+            if room and room.creator_id == self.scope['user'].id:
                 return await func(self, *args, **kwargs)
             else:
                 return await self._throw_error(
@@ -50,13 +121,45 @@ class ChatRoomConsumer(BaseConsumer):
         return wrapper
 
     async def chat_message(self, event):
-        return await self._send_message(message=event['message'], event=event['type'])
+        if 'text' not in event:
+            return await self._send_message(message=event['message'], event=event['type'])
+        if self.batch is None:
+            return await self._send_frame(event)
+
+        self.batch.append(event['text'])
+        if len(self.batch) >= settings.CHAT_BATCH_MAX_SIZE:
+            return await self._flush_batch()
+        if self.batch_flush is None:
+            self.batch_flush = spawn(self._flush_batch_later())
+
+    async def room_deleted(self, event):
+        await self._throw_error(message={
+            'detail': 'Group was deleted'
+        })
+        await self.close(1000)
+
+    async def _flush_batch_later(self):
+        await asyncio.sleep(settings.CHAT_BATCH_WINDOW)
+        self.batch_flush = None
+        await self._flush_batch()
+
+    async def _flush_batch(self):
+        if self.batch_flush is not None:
+            self.batch_flush.cancel()
+            self.batch_flush = None
+        frames, self.batch = self.batch, []
+        if len(frames) == 1:
+            await self.send(text_data=frames[0])
+        elif frames:
+            await self.send(text_data=encode_batch(frames))
 
     async def event_send_message(self, message):
         if isinstance(message['data'].get('message'), str) and len(message['data']['message']) > 0:
             msg = await self.save_message(message['data']['message'])
             return await self._group_send(
                 message={
+                    'id': msg.pk,
+                    'seq': msg.seq,
                     'message': msg.text,
                     'user': self.scope['user'].username,
                     'sent_at': msg.created_at.strftime(format='%d/%m/%Y, %H:%M'),
@@ -72,11 +175,119 @@ class ChatRoomConsumer(BaseConsumer):
             event=message['event']
         )
 
+    async def event_batch_mode(self, message):
+        enabled = message['data'].get('enabled')
+        if isinstance(enabled, bool):
+            if enabled and self.batch is None:
+                self.batch = []
+            elif not enabled and self.batch is not None:
+                await self._flush_batch()
+                self.batch = None
+            return await self._send_message(
+                message={
+                    'enabled': enabled,
+                    'window_ms': round(settings.CHAT_BATCH_WINDOW * 1000),
+                    'max_size': settings.CHAT_BATCH_MAX_SIZE,
+                },
+                event=message['event']
+            )
+        return await self._throw_error(
+            message={
+                'detail': 'Invalid data',
+                'valid_data_example': {
+                    'enabled': True,
+                }
+            },
+            event=message['event']
+        )
+
     async def event_list_message(self, message):
-        messages = await self.get_message_list()
-        return await self._send_message(
+        before, after = message['data'].get('before'), message['data'].get('after')
+        limit = message['data'].get('limit', settings.CHAT_MESSAGE_PAGE_SIZE)
+        cursor = before or after
+
+        if (not (before and after)
+                and (cursor is None or isinstance(cursor, str))
+                and isinstance(limit, int) and not isinstance(limit, bool) and limit > 0):
+            cursor = decode_cursor(cursor) if cursor else None
+            if cursor or not (before or after):
+                page = await self.get_message_list(
+                    limit=min(limit, settings.CHAT_MESSAGE_PAGE_SIZE_MAX),
+                    before=cursor if before else None,
+                    after=cursor if after else None,
+                )
+                return await self._send_message(message=page, event=message['event'])
+
+        return await self._throw_error(
+            message={
+                'detail': 'Invalid data',
+                'valid_data_example': {
+                    'before': 'cursor from previous page (optional)',
+                    'after': 'cursor from previous page (optional)',
+                    'limit': settings.CHAT_MESSAGE_PAGE_SIZE,
+                }
+            },
+            event=message['event']
+        )
+
+    async def event_sync_since(self, message):
+        since = message['data'].get('since')
+        if isinstance(since, int) and not isinstance(since, bool) and since >= 0:
+            return await self._send_message(message=await self.get_messages_since(since), event=message['event'])
+        return await self._throw_error(
+            message={
+                'detail': 'Invalid data',
+                'valid_data_example': {
+                    'since': 'seq of the last message the client has',
+                }
+            },
+            event=message['event']
+        )
+
+    async def event_search_message(self, message):
+        query = message['data'].get('query')
+        limit = message['data'].get('limit', settings.CHAT_SEARCH_PAGE_SIZE)
+        offset = message['data'].get('offset', 0)
+        if (isinstance(query, str) and query.strip()
+                and isinstance(limit, int) and not isinstance(limit, bool) and limit > 0
+                and isinstance(offset, int) and not isinstance(offset, bool) and offset >= 0):
+            limit = min(limit, settings.CHAT_SEARCH_PAGE_SIZE_MAX)
+            messages = await self.search_messages(query, limit + 1, offset)
+            return await self._send_message(
+                message={
+                    'messages': messages[:limit],
+                    'next': offset + limit if len(messages) > limit else None,
+                },
+                event=message['event']
+            )
+        return await self._throw_error(
+            message={
+                'detail': 'Invalid data',
+                'valid_data_example': {
+                    'query': 'words to find',
+                    'limit': settings.CHAT_SEARCH_PAGE_SIZE,
+                    'offset': 0,
+                }
+            },
+            event=message['event']
+        )
+
+    async def event_mark_read(self, message):
+        message_id = message['data'].get('message')
+        if message_id is None or (isinstance(message_id, int) and not isinstance(message_id, bool)):
+            await self.mark_read(message_id)
+            return await self._send_message(
+                message={
+                    'unread': await self.get_unread_count()
+                },
+                event=message['event']
+            )
+        return await self._throw_error(
             message={
-                'messages': messages
+                'detail': 'Invalid data',
+                'valid_data_example': {
+                    'message': 1,
+                }
             },
             event=message['event']
         )
@@ -84,13 +295,9 @@ class ChatRoomConsumer(BaseConsumer):
     @creator_permission
     async def event_add_participants(self, message):
         if isinstance(message['data'].get('users'), list):
-            participants = []
-            for user in message['data']['users']:
-                participant = await self.add_participant(user)
-                if participant:
-                    participants.append(participant)
-
+            participants = await self.add_participants(message['data']['users'])
             if len(participants) > 0:
+                await invalidate('rooms', self.group_id)
                 return await self._group_send(
                     message={
                         'detail': f'Users: {participants} was added to chat'
@@ -111,6 +318,7 @@ class ChatRoomConsumer(BaseConsumer):
         if message['data'].get('user') and message['data']['user'] != self.scope['user'].id:
             user = await self.delete_participant(message['data']['user'])
             if user:
+                await invalidate('rooms', self.group_id)
                 return await self._group_send(message={
                     'detail': f'User {user} was deleted'
                 })
@@ -130,6 +338,10 @@ class ChatRoomConsumer(BaseConsumer):
                 'available_events': [
                     'send.message',
                     'list.message',
+                    'sync.since',
+                    'search.message',
+                    'batch.mode',
+                    'mark.read',
                     'add.participants',
                     'delete.participant',
                     'event.list'
@@ -138,56 +350,179 @@ class ChatRoomConsumer(BaseConsumer):
             event=message['event']
         )
 
-    @database_sync_to_async
-    def get_group(self):
-        try:
-            return ChatRoomModel.objects.get(uuid=self.group_id)
-        except:
+    async def get_room(self):
+        room = room_cache.get(self.group_id)
+        if room is None:
+            room = await self.load_room()
+            if room:
+                room_cache.set(self.group_id, room)
+        return room
+
+    async def load_room(self):
+        group = await ChatRoomModel.objects.filter(uuid=self.group_id, deleted_at__isnull=True).afirst()
+        if not group:
             return
+        participants = [
+            row async for row in ParticipantModel.objects.filter(group=group).values_list('user_id', 'is_creator')
+        ]
+        return RoomMetadata(
+            group=group,
+            member_ids=frozenset(user_id for user_id, _ in participants),
+            creator_id=next((user_id for user_id, is_creator in participants if is_creator), None),
+        )
 
-    @database_sync_to_async
-    def get_creator(self):
-        creator = ParticipantModel.objects.filter(group=self.group, is_creator=True).first()
-        if creator:
-            return creator.user
-        return
+    async def get_message_list(self, limit, before=None, after=None):
+        queryset = MessageModel.objects.select_related('user').filter(group=self.group)
+        if after:
+            created_at, pk = after
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk)
+            ).order_by('created_at', 'pk')
+        else:
+            if before:
+                created_at, pk = before
+                queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+            queryset = queryset.order_by('-created_at', '-pk')
 
-    @database_sync_to_async
-    def get_participants(self):
-        queryset = ParticipantModel.objects.select_related('user').filter(group=self.group)
-        return [i.user for i in queryset]
+        with replica_reads():
+            messages = [msg async for msg in queryset[:limit + 1]]
+        # Past the hot window, history continues in the room's archive.
+        if after:
+            messages = (await self.read_archive(limit + 1, after=after) + messages)[:limit + 1]
+        elif len(messages) <= limit:
+            cursor = (messages[-1].created_at, messages[-1].pk) if messages else before
+            messages += await self.read_archive(limit + 1 - len(messages), before=cursor)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if not after:
+            messages.reverse()
 
-    @database_sync_to_async
-    def get_message_list(self):
-        messages = MessageModel.objects.select_related('user').filter(group=self.group).order_by('created_at')
-        res = []
-        for msg in messages:
-            if not msg.is_viewed and msg.user != self.scope['user']:
-                msg.is_viewed = True
-                msg.save()
-
-            res.append({
-                'text': msg.text,
-                'sender': msg.user.username,
-                'sent_at': msg.created_at.strftime(format='%d/%m/%Y, %H:%M')
-            })
-        return res
+        if messages and not before:
+            await self.mark_read(messages[-1].pk)
 
-    @database_sync_to_async
-    def save_message(self, text):
-        message = MessageModel.objects.create(text=text, group=self.group, user=self.scope['user'])
-        return message
+        return {
+            'messages': [serialize_message(msg) for msg in messages],
+            'has_more': has_more,
+            'before': encode_cursor(messages[0]) if messages else None,
+            'after': encode_cursor(messages[-1]) if messages else None,
+        }
+
+    async def read_archive(self, limit, before=None, after=None):
+        archive = get_archive(self.group_id)
+        if after:
+            return await sync_to_async(archive.read_after, thread_sensitive=False)(self.group.pk, limit, after)
+        return await sync_to_async(archive.read_before, thread_sensitive=False)(self.group.pk, limit, before)
+
+    async def get_messages_since(self, since):
+        # Taken before the query, so a message flushed in between is found in one or the other.
+        pending = message_writer.pending(self.group_id)
+        last_seq = await ChatRoomModel.objects.filter(pk=self.group.pk).values_list('last_seq', flat=True).aget()
+        if settings.CHAT_WRITE_BEHIND['ENABLED']:
+            # The room's last_seq only catches up when a batch is flushed.
+            last_seq = max(last_seq, await get_sequence().current(self.group_id) or 0)
+        archived_seq = await sync_to_async(get_archive(self.group_id).last_seq, thread_sensitive=False)()
+        if since > last_seq or last_seq - since > settings.CHAT_SYNC_MAX_GAP or since < archived_seq:
+            return {'reload': True, 'last_seq': last_seq}
+
+        messages = {
+            msg.pk: msg async for msg in MessageModel.objects.select_related('user').filter(
+                group=self.group, seq__gt=since
+            )
+        }
+        for msg in pending:
+            if msg.seq > since:
+                messages.setdefault(msg.pk, msg)
+
+        # Seqs that other workers handed out but have not written yet leave holes. The reply
+        # stops at the first one and the client asks again; a hole that outlives
+        # CHAT_SYNC_HOLE_TIMEOUT is a message that was lost, and is skipped.
+        lost_before = timezone.now() - timedelta(seconds=settings.CHAT_SYNC_HOLE_TIMEOUT)
+        run, seq = [], since
+        for msg in sorted(messages.values(), key=lambda msg: msg.seq):
+            if msg.seq != seq + 1 and msg.created_at > lost_before:
+                break
+            run.append(msg)
+            seq = msg.seq
+        return {
+            'reload': False,
+            'last_seq': seq,
+            'pending': seq < last_seq,
+            'messages': [serialize_message(msg) for msg in run],
+        }
 
     @database_sync_to_async
-    def add_participant(self, user_id):
-        try:
-            user = UserModel.objects.get(pk=user_id)
-            participant, flag = ParticipantModel.objects.get_or_create(group=self.group, user=user)
-            return user.username if flag else None
-        except:
+    def search_messages(self, query, limit, offset):
+        return [serialize_message(msg) for msg in search_messages(self.group, query, limit, offset)]
+
+    @database_write_to_async
+    def mark_read(self, message_id=None):
+        latest = MessageModel.objects.filter(group=self.group).order_by('-pk')
+        if message_id is not None:
+            latest = latest.filter(pk__lte=message_id)
+        message_id = latest.values_list('pk', flat=True).first()
+        if message_id is None:
             return
+        # Every newest history page lands here, and re-reading a room mustn't pin the reader
+        # to the primary. Only a watermark that actually moved does.
+        with database_user(None):
+            updated = ParticipantModel.objects.filter(
+                group=self.group,
+                user=self.scope['user'],
+                last_read_id__lt=message_id,
+            ).update(last_read_id=message_id)
+        if updated:
+            pin_to_primary(self.scope['user'].id)
 
-    @database_sync_to_async
+    async def get_unread_count(self):
+        last_read = await ParticipantModel.objects.filter(
+            group=self.group, user=self.scope['user']
+        ).values_list('last_read_id', flat=True).afirst()
+        return await MessageModel.objects.filter(
+            group=self.group, pk__gt=last_read or 0
+        ).exclude(user=self.scope['user']).acount()
+
+    async def save_message(self, text):
+        if not settings.CHAT_WRITE_BEHIND['ENABLED']:
+            return await self.create_message(text)
+
+        message = await message_writer.put(MessageModel(
+            pk=next_message_id(),
+            seq=await get_sequence().next(self.group_id),
+            text=text,
+            group=self.group,
+            user=self.scope['user'],
+            created_at=timezone.now(),
+        ))
+        room = await self.get_room()
+        if room:
+            spawn(send_notifications(
+                list(room.member_ids - {self.scope['user'].id}), new_message_notice(message), room=self.group_id
+            ))
+        return message
+
+    @database_write_to_async
+    def create_message(self, text):
+        return MessageModel.objects.create(text=text, group=self.group, user=self.scope['user'])
+
+    @database_write_to_async
+    def add_participants(self, user_ids):
+        user_ids = [pk for pk in user_ids if isinstance(pk, int) and not isinstance(pk, bool)]
+
+        with transaction.atomic():
+            users = list(
+                UserModel.objects.filter(pk__in=user_ids)
+                .exclude(chats__group=self.group)
+                .values_list('pk', 'username')
+            )
+            ParticipantModel.objects.bulk_create(
+                [ParticipantModel(group=self.group, user_id=pk) for pk, _ in users],
+                ignore_conflicts=True
+            )
+            transaction.on_commit(lambda: notify_added_to_group(self.group, [pk for pk, _ in users]))
+
+        return [username for _, username in users]
+
+    @database_write_to_async
     def delete_participant(self, user_id):
         try:
             user = UserModel.objects.get(pk=user_id)
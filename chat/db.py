@@ -0,0 +1,87 @@
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from asgiref.sync import SyncToAsync
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connections
+
+from chat.metrics import db_queue_wait, register_collector
+
+_queued_at = contextvars.ContextVar('queued_at', default=None)
+
+# Sync ORM work that the async ORM cannot express (transactions, raw SQL, bulk writes)
+# runs here rather than on asgiref's single thread-sensitive executor, which the async
+# ORM queries already use. Every call opens and commits its own transaction, so it does
+# not depend on which thread it lands on.
+db_executor = ThreadPoolExecutor(max_workers=settings.CHAT_DB_THREADS, thread_name_prefix='chat-db')
+
+# SQLite takes one writer at a time. Queueing every write of the process on one thread turns
+# lock contention into an in-process queue, while reads keep running on db_executor alongside
+# it under WAL. Other processes (more workers, archive_messages) still contend for the lock.
+db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-db-writer')
+
+EXECUTORS = {'pool': db_executor, 'writer': db_writer}
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    # Records how long each call waits between being awaited and starting on a worker thread.
+    def __init__(self, func, thread_sensitive=False, executor=None):
+        if not thread_sensitive and executor is None:
+            executor = db_executor
+        name = next((name for name, known in EXECUTORS.items() if known is executor), 'other')
+
+        @functools.wraps(func)
+        def timed(*func_args, **func_kwargs):
+            queued_at = _queued_at.get()
+            if queued_at is not None:
+                db_queue_wait.observe(time.perf_counter() - queued_at, executor=name)
+            return func(*func_args, **func_kwargs)
+
+        super().__init__(timed, thread_sensitive=thread_sensitive, executor=executor)
+
+    async def __call__(self, *args, **kwargs):
+        token = _queued_at.set(time.perf_counter())
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            _queued_at.reset(token)
+
+
+database_sync_to_async = InstrumentedDatabaseSyncToAsync
+
+
+def database_write_to_async(func):
+    return InstrumentedDatabaseSyncToAsync(func, executor=db_writer)
+
+
+def close_thread_connections():
+    # Persistent connections stay open in the database threads between calls. Close every
+    # thread's connections, e.g. before the database they point at goes away. The async ORM
+    # runs on asgiref's single thread-sensitive executor, so that one is included too.
+    for executor, threads in (
+        (db_executor, db_executor._max_workers),
+        (db_writer, 1),
+        (SyncToAsync.single_thread_executor, 1),
+    ):
+        # Every job holds its thread until all of them have started, so each lands on its own.
+        barrier = threading.Barrier(threads)
+
+        def close():
+            barrier.wait()
+            connections.close_all()
+
+        wait([executor.submit(close) for _ in range(threads)])
+
+
+@register_collector
+def executor_metrics():
+    return [
+        ('chat_db_threads', 'gauge', 'Worker threads available to database calls',
+         [({'executor': name}, executor._max_workers) for name, executor in EXECUTORS.items()]),
+        ('chat_db_queue_depth', 'gauge', 'Database calls waiting for a worker thread',
+         [({'executor': name}, executor._work_queue.qsize()) for name, executor in EXECUTORS.items()]),
+    ]
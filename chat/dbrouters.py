@@ -0,0 +1,90 @@
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chat.cache import INVALIDATION_GROUP, TTLCache, on_broadcast
+
+# Pins only need to outlive CHAT_REPLICA_PIN_SECONDS; the cache just bounds their number.
+PIN_CACHE_SIZE = 100000
+PIN_CACHE_TTL = 300
+
+_user_id = contextvars.ContextVar('database_user', default=None)
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+# Users who wrote recently, mapped to the time until which they read from the primary.
+pinned_users = TTLCache(PIN_CACHE_SIZE, PIN_CACHE_TTL)
+# When this process last told the others about a user's pin.
+shared_pins = TTLCache(PIN_CACHE_SIZE, PIN_CACHE_TTL)
+
+
+@contextmanager
+def database_user(user_id):
+    # Attributes the queries in this block to ``user_id`` for read-your-writes pinning.
+    token = _user_id.set(user_id)
+    try:
+        yield
+    finally:
+        _user_id.reset(token)
+
+
+@contextmanager
+def replica_reads():
+    # Marks the reads in this block as safe to serve from a replica. The context variable
+    # is copied into sync_to_async threads, so this covers async ORM calls too.
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def pin_to_primary(user_id, seconds=None):
+    pinned_users.set(user_id, time.monotonic() + (seconds or settings.CHAT_REPLICA_PIN_SECONDS))
+
+
+async def share_pin(user_id, pinned_until):
+    # The user's next request may land on another worker, so the others pin them as well.
+    # Broadcasting at most every half pin period and holding remote pins for one and a half
+    # keeps them covered for the full period after every write.
+    if not settings.CHAT_DATABASE_REPLICAS or pinned_users.get(user_id) == pinned_until:
+        return
+    now = time.monotonic()
+    shared_at = shared_pins.get(user_id)
+    if shared_at is not None and now - shared_at < settings.CHAT_REPLICA_PIN_SECONDS / 2:
+        return
+    shared_pins.set(user_id, now)
+    await get_channel_layer().group_send(INVALIDATION_GROUP, {'type': 'database.pin', 'user': user_id})
+
+
+on_broadcast('database.pin', lambda event: pin_to_primary(event['user'], settings.CHAT_REPLICA_PIN_SECONDS * 1.5))
+
+
+def is_pinned(user_id):
+    pinned_until = pinned_users.get(user_id)
+    return pinned_until is not None and pinned_until > time.monotonic()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = settings.CHAT_DATABASE_REPLICAS
+        if not replicas or not _replica_reads.get():
+            return settings.CHAT_DATABASE_PRIMARY
+        user_id = _user_id.get()
+        if user_id is not None and is_pinned(user_id):
+            return settings.CHAT_DATABASE_PRIMARY
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        user_id = _user_id.get()
+        if user_id is not None:
+            pin_to_primary(user_id)
+        return settings.CHAT_DATABASE_PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {settings.CHAT_DATABASE_PRIMARY, *settings.CHAT_DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
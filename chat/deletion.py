@@ -0,0 +1,54 @@
+import asyncio
+
+from django.conf import settings
+
+from chat.archive import get_archive
+from chat.db import database_sync_to_async, database_write_to_async
+from chat.fanout import send_notifications
+from chat.models import ChatRoomModel, MessageModel, ParticipantModel
+
+
+def delete_batch(group_uuid, batch_size):
+    # One bounded step of a room deletion: up to batch_size messages, then participants,
+    # then the empty room and its archive. Returns the model a step deleted from and how
+    # many rows, or (None, 0) once nothing is left. Every step is its own short transaction,
+    # so other writes get the database in between and memory never holds more than one batch.
+    for model in (MessageModel, ParticipantModel):
+        ids = list(model.objects.filter(group_id=group_uuid).values_list('pk', flat=True)[:batch_size])
+        if ids:
+            model.objects.filter(pk__in=ids).delete()
+            return model, len(ids)
+    deleted, _ = ChatRoomModel.objects.filter(pk=group_uuid).delete()
+    get_archive(group_uuid).remove()
+    return (ChatRoomModel, deleted) if deleted else (None, 0)
+
+
+def deletion_notice(name, deleted, total, done=False):
+    return {
+        'type': 'send.notification',
+        'message': {
+            'type': 'group deletion',
+            'group': name,
+            'deleted_messages': deleted,
+            'total_messages': total,
+            'done': done,
+        }
+    }
+
+
+async def delete_group(group_uuid, name, user_id):
+    loop = asyncio.get_running_loop()
+    # A task of its own, outside the consumer handlers that clean up stale connections.
+    total = await database_sync_to_async(MessageModel.objects.filter(group_id=group_uuid).count)()
+    deleted = 0
+    reported = loop.time()
+    while True:
+        model, count = await database_write_to_async(delete_batch)(group_uuid, settings.CHAT_DELETE_BATCH_SIZE)
+        if model is None or model is ChatRoomModel:
+            break
+        if model is MessageModel:
+            deleted += count
+        if loop.time() - reported >= settings.CHAT_DELETE_PROGRESS_INTERVAL:
+            reported = loop.time()
+            await send_notifications([user_id], deletion_notice(name, deleted, total))
+    await send_notifications([user_id], deletion_notice(name, deleted, total, done=True))
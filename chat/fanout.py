@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chat.metrics import channel_layer_send_latency, fanout_latency, notifications_suppressed
+from chat.presence import get_presence
+from chat.utils import encode_frame, run_detached
+
+logger = logging.getLogger(__name__)
+
+
+async def send_notifications(user_ids, message, room=None):
+    # With ``room`` set, users who have that room open are skipped: the room broadcast
+    # already shows them the message.
+    if room is not None:
+        present = await get_presence().users(room)
+        recipients = [user_id for user_id in user_ids if user_id not in present]
+        notifications_suppressed.inc(len(user_ids) - len(recipients))
+        user_ids = recipients
+
+    channel_layer = get_channel_layer()
+    batch_size = settings.CHAT_FANOUT_BATCH_SIZE
+    message = {
+        'type': message['type'],
+        'text': encode_frame(message['message'], event=message['type']),
+    }
+
+    with fanout_latency.time():
+        for i in range(0, len(user_ids), batch_size):
+            with channel_layer_send_latency.time(operation='fanout_batch'):
+                results = await asyncio.gather(
+                    *(channel_layer.group_send(f'user_{user_id}', message) for user_id in user_ids[i:i + batch_size]),
+                    return_exceptions=True
+                )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.warning('Notification fan-out failed: %r', result)
+
+
+def new_message_notice(message):
+    return {
+        'type': 'send.notification',
+        'message': {
+            'type': 'new message',
+            'group': message.group.name,
+            'sender': message.user.username,
+            'message': message.text,
+        }
+    }
+
+
+def fan_out(user_ids, message, room=None):
+    user_ids = list(user_ids)
+    if user_ids:
+        run_detached(send_notifications, user_ids, message, room)
+
+
+def notify_added_to_group(group, user_ids):
+    if group.type != 'dialog':
+        fan_out(user_ids, {
+            'type': 'send.notification',
+            'message': {
+                'type': 'new group',
+                'message': f'You were added to group {group.name}',
+            }
+        })
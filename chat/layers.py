@@ -0,0 +1,374 @@
+import asyncio
+import bisect
+import functools
+import hashlib
+import inspect
+import logging
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from channels_redis.core import RedisChannelLayer
+from django.utils.module_loading import import_string
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from chat.metrics import channel_layer_group_sends
+
+logger = logging.getLogger(__name__)
+
+
+def build_layer(config):
+    if isinstance(config, dict):
+        return import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+    return config
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    # Channels created in this process, and their groups, live in process memory, and sends
+    # to them never leave it. The process (a node) joins each remote group once for all its
+    # members and sends a group message remotely only while other nodes have members too:
+    # nodes find each other with hybrid.join / hybrid.here / hybrid.leave, and until that has
+    # settled, or while a crashed peer is still listed, messages just go remote as well.
+    # Every process on the remote layer must use this one, since group messages are wrapped in
+    # a hybrid.group envelope, and in-process deliveries are shallow copies handlers mustn't mutate.
+    extensions = ['groups', 'flush']
+
+    def __init__(self, remote, capacity=100, peer_ttl=30, discovery_timeout=0.5, expiry=60):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.remote = build_layer(remote)
+        self.peer_ttl = peer_ttl
+        self.discovery_timeout = discovery_timeout
+        self.loop = None
+        self._reset()
+
+    def __getattr__(self, name):
+        # Code that talks to Redis directly (RedisPresence) sees the remote layer's API.
+        if name == 'remote':
+            raise AttributeError(name)
+        return getattr(self.remote, name)
+
+    def _reset(self):
+        self.node = None
+        self.channels = {}
+        self.groups = {}
+        self.peers = {}
+        self.probed = {}
+        self._remote_receives = {}
+        self._pump = None
+
+    def _at_home(self):
+        # Local state belongs to one event loop. Calls from another loop (async_to_sync in a
+        # worker thread) go through the remote layer like any other process's would.
+        return asyncio.get_running_loop() is self.loop
+
+    async def new_channel(self, prefix='specific'):
+        channel = await self.remote.new_channel(prefix)
+        loop = asyncio.get_running_loop()
+        if self.loop is None or self.loop.is_closed() or not self.loop.is_running():
+            self.loop = loop
+            self._reset()
+        if loop is self.loop:
+            self.channels[channel] = asyncio.Queue(maxsize=self.capacity)
+        return channel
+
+    async def send(self, channel, message):
+        queue = self.channels.get(channel) if self._at_home() else None
+        if queue is None:
+            return await self.remote.send(channel, message)
+        if queue.full():
+            raise ChannelFull(channel)
+        queue.put_nowait(dict(message))
+
+    async def receive(self, channel):
+        queue = self.channels.get(channel) if self._at_home() else None
+        if queue is None:
+            return self._unwrap(await self.remote.receive(channel))
+        if not queue.empty():
+            return queue.get_nowait()
+
+        # Messages from other nodes arrive through the remote layer. Its pending receive
+        # outlives a local delivery and is picked up by the next call.
+        remote = self._remote_receives.get(channel)
+        if remote is None:
+            remote = self._remote_receives[channel] = asyncio.ensure_future(self.remote.receive(channel))
+        local = asyncio.ensure_future(queue.get())
+        try:
+            await asyncio.wait([local, remote], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            local.cancel()
+            remote.cancel()
+            self._close(channel)
+            raise
+        if local.done():
+            return local.result()
+        local.cancel()
+        del self._remote_receives[channel]
+        return self._unwrap(remote.result())
+
+    def _close(self, channel):
+        # The consumer behind the channel is gone: forget it, and leave groups it never discarded.
+        self.channels.pop(channel, None)
+        self._remote_receives.pop(channel, None)
+        for group, members in list(self.groups.items()):
+            if channel in members:
+                members.discard(channel)
+                if not members:
+                    self.loop.create_task(self._leave(group))
+
+    @staticmethod
+    def _unwrap(message):
+        if message.get('type') == 'hybrid.group':
+            return message['message']
+        return message
+
+    async def group_add(self, group, channel):
+        if not (self._at_home() and channel in self.channels):
+            return await self.remote.group_add(group, channel)
+        members = self.groups.setdefault(group, set())
+        first = not members
+        members.add(channel)
+        # Also on later joins, so the node's membership never reaches the remote group expiry.
+        await self.remote.group_add(group, await self._node())
+        if first:
+            await self._probe(group)
+
+    async def group_discard(self, group, channel):
+        members = self.groups.get(group) if self._at_home() else None
+        if not members or channel not in members:
+            return await self.remote.group_discard(group, channel)
+        members.discard(channel)
+        if not members:
+            await self._leave(group)
+
+    async def _leave(self, group):
+        if self.groups.get(group):
+            return
+        self.groups.pop(group, None)
+        self.probed.pop(group, None)
+        peers = self.peers.pop(group, set())
+        await self.remote.group_discard(group, self.node)
+        for peer in peers:
+            try:
+                await self.remote.send(peer, {'type': 'hybrid.leave', 'group': group, 'node': self.node})
+            except ChannelFull:
+                pass
+
+    async def group_send(self, group, message):
+        members = self.groups.get(group) if self._at_home() else None
+        if not members:
+            channel_layer_group_sends.inc(route='remote')
+            return await self.remote.group_send(group, self._wrap(group, message, origin=None))
+
+        self._deliver(group, message)
+        if await self._has_peers(group):
+            channel_layer_group_sends.inc(route='remote')
+            await self.remote.group_send(group, self._wrap(group, message, origin=self.node))
+        else:
+            channel_layer_group_sends.inc(route='local')
+
+    @staticmethod
+    def _wrap(group, message, origin):
+        return {'type': 'hybrid.group', 'group': group, 'origin': origin, 'message': message}
+
+    def _deliver(self, group, message):
+        for channel in self.groups.get(group, ()):
+            queue = self.channels.get(channel)
+            # Like the remote layers, group_send drops messages for channels that are full.
+            if queue is not None and not queue.full():
+                queue.put_nowait(dict(message))
+
+    async def _has_peers(self, group):
+        now = self.loop.time()
+        probed = self.probed.get(group)
+        if probed is None or now - probed >= self.peer_ttl:
+            await self._probe(group)
+            return True
+        return now - probed < self.discovery_timeout or bool(self.peers.get(group))
+
+    async def _probe(self, group):
+        self.probed[group] = self.loop.time()
+        self.peers[group] = set()
+        await self.remote.group_send(group, {'type': 'hybrid.join', 'group': group, 'node': self.node})
+
+    async def _node(self):
+        if self.node is None:
+            # The default prefix: channels_redis reads this process's channels from the single
+            # queue of whichever receive holds its lock, and consumers' channels use 'specific'.
+            self.node = await self.remote.new_channel()
+            self._pump = self.loop.create_task(self._receive_node())
+        return self.node
+
+    async def _receive_node(self):
+        while True:
+            message = await self.remote.receive(self.node)
+            try:
+                await self._handle_node_message(message)
+            except Exception:
+                logger.exception('Hybrid channel layer failed to handle %r', message.get('type'))
+
+    async def _handle_node_message(self, message):
+        kind, group = message.get('type'), message.get('group')
+        if kind == 'hybrid.group':
+            if message['origin'] != self.node:
+                self._deliver(group, message['message'])
+        elif kind == 'hybrid.join':
+            if message['node'] != self.node and group in self.groups:
+                self.peers.setdefault(group, set()).add(message['node'])
+                await self.remote.send(message['node'], {'type': 'hybrid.here', 'group': group, 'node': self.node})
+        elif kind == 'hybrid.here':
+            if group in self.groups:
+                self.peers.setdefault(group, set()).add(message['node'])
+        elif kind == 'hybrid.leave':
+            self.peers.get(group, set()).discard(message['node'])
+
+    async def flush(self):
+        if self._pump is not None:
+            self._pump.cancel()
+        for remote in self._remote_receives.values():
+            remote.cancel()
+        self._reset()
+        await self.remote.flush()
+
+
+CONNECTION_ERRORS = (RedisConnectionError, RedisTimeoutError, OSError)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f'{node}#{i}'), index) for index, node in enumerate(self.nodes) for i in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [index for _, index in points]
+        # Room and user group names repeat on every send, and hashing is most of a lookup.
+        self.lookup = functools.lru_cache(maxsize=65536)(self._lookup)
+
+    def walk(self, key):
+        # Node indexes in ring order from the key's position, each once: the owner first,
+        # then where the key goes if the owner is unavailable.
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for i in range(len(self._hashes)):
+            owner = self._owners[(start + i) % len(self._hashes)]
+            if owner not in seen:
+                seen.add(owner)
+                yield owner
+                if len(seen) == len(self.nodes):
+                    return
+
+    def _lookup(self, key):
+        return self._owners[bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+def shard_name(host):
+    # Ring positions follow the shard's address, not its place in the hosts list, so
+    # reordering or appending hosts moves nothing else.
+    if 'address' in host:
+        name = host['address']
+    else:
+        name = f"redis://{host.get('host', 'localhost')}:{host.get('port', 6379)}"
+    return f"{name}/{host['db']}" if 'db' in host else name
+
+
+class GuardedConnection:
+    # Marks the shard down when a command to it fails to connect or times out.
+    def __init__(self, layer, index, connection):
+        self.layer = layer
+        self.index = index
+        self.connection = connection
+
+    def __getattr__(self, name):
+        attribute = getattr(self.connection, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if inspect.isawaitable(result):
+                return self._guard(result)
+            if hasattr(result, 'execute'):
+                return GuardedConnection(self.layer, self.index, result)
+            return result
+        return call
+
+    async def _guard(self, awaitable):
+        try:
+            return await awaitable
+        except CONNECTION_ERRORS:
+            self.layer.mark_down(self.index)
+            raise
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    # Places groups and process channels with a consistent-hash ring, so a new shard takes about
+    # 1/n of the keys and nothing else moves. A shard that stops answering is skipped for
+    # failover_timeout seconds and its groups move to the next one, losing their memberships
+    # until members rejoin. Process channels stay on their owner shard: a send to one that is
+    # down raises rather than leave the message where nobody reads it.
+    def __init__(self, hosts=None, ring_replicas=160, failover_timeout=30, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing([shard_name(host) for host in self.hosts], ring_replicas)
+        self.failover_timeout = failover_timeout
+        self._down_until = {}
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if isinstance(value, bytes):
+            value = value.decode()
+        if '!' in value:
+            # send hashes the full channel name and receive the process part: both must agree.
+            return self.ring.lookup(self.non_local_name(value))
+        down = self.down_shards() if self._down_until else ()
+        if not down:
+            return self.ring.lookup(value)
+        for index in self.ring.walk(value):
+            if index not in down:
+                return index
+        # Every shard is down: keep trying the owner.
+        return self.ring.lookup(value)
+
+    def down_shards(self):
+        now = time.monotonic()
+        for index, until in list(self._down_until.items()):
+            if until <= now:
+                del self._down_until[index]
+        return set(self._down_until)
+
+    def mark_down(self, index):
+        if self.ring_size > 1 and index not in self.down_shards():
+            logger.warning('Channel layer shard %s is unavailable, failing over its groups for %ss',
+                           self.ring.nodes[index], self.failover_timeout)
+            self._down_until[index] = time.monotonic() + self.failover_timeout
+
+    def connection(self, index):
+        return GuardedConnection(self, index, super().connection(index))
+
+    async def _failover(self, operation, *args):
+        # Retry on the next shard while failures keep taking shards out of the ring.
+        while True:
+            down = self.down_shards()
+            try:
+                return await operation(*args)
+            except CONNECTION_ERRORS:
+                if self.down_shards() <= down or len(self.down_shards()) == self.ring_size:
+                    raise
+
+    async def send(self, channel, message):
+        if '!' in channel:
+            return await super().send(channel, message)
+        return await self._failover(super().send, channel, message)
+
+    async def group_add(self, group, channel):
+        return await self._failover(super().group_add, group, channel)
+
+    async def group_discard(self, group, channel):
+        return await self._failover(super().group_discard, group, channel)
+
+    async def group_send(self, group, message):
+        return await self._failover(super().group_send, group, message)
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import archive_room
+from chat.models import ChatRoomModel
+
+
+class Command(BaseCommand):
+    help = 'Move messages past their room type\'s CHAT_RETENTION_DAYS into the compressed per-room archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_ARCHIVE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        total = 0
+        for chat_type, days in settings.CHAT_RETENTION_DAYS.items():
+            if days is None:
+                continue
+            cutoff = timezone.now() - timedelta(days=days)
+            # The ids are read up front: a cursor held open over the rooms (and their messages)
+            # while archive_room deletes from chat_messagemodel is not something to rely on.
+            room_ids = list(ChatRoomModel.objects.filter(
+                type=chat_type, deleted_at__isnull=True, messages__created_at__lt=cutoff
+            ).distinct().values_list('pk', flat=True))
+            for room_id in room_ids:
+                room = ChatRoomModel.objects.filter(pk=room_id, deleted_at__isnull=True).first()
+                if room is None:
+                    continue
+                archived = archive_room(room, cutoff, options['batch_size'])
+                if archived:
+                    self.stdout.write(f'Archived {archived} messages of {room.name} ({room.pk})')
+                total += archived
+        self.stdout.write(self.style.SUCCESS(f'Archived {total} messages'))
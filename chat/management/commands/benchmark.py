@@ -0,0 +1,77 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import SUITES
+
+BASELINE_PATH = Path(__file__).resolve().parents[2] / 'benchmarks' / 'baselines.json'
+
+# Metric name -> True when a larger value is better.
+CHECKED_METRICS = {
+    'throughput_per_s': True,
+    'p95_ms': False,
+    'p99_ms': False,
+}
+
+
+def find_regressions(result, baseline, tolerance, path=''):
+    regressions = []
+    for key, expected in baseline.items():
+        actual = result.get(key)
+        if isinstance(expected, dict) and isinstance(actual, dict):
+            regressions += find_regressions(actual, expected, tolerance, f'{path}{key}.')
+        elif key in CHECKED_METRICS and isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+            if CHECKED_METRICS[key]:
+                regressed = actual < expected * (1 - tolerance)
+            else:
+                regressed = actual > expected * (1 + tolerance)
+            if regressed:
+                regressions.append(f'{path}{key}: {actual} (baseline {expected})')
+    return regressions
+
+
+class Command(BaseCommand):
+    help = 'Run chat performance benchmarks and print the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('suites', nargs='*', help=f'Suites to run, any of: {", ".join(SUITES)} (default: all)')
+        parser.add_argument('--recipients', type=int, default=2000)
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--clients', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=20)
+        parser.add_argument('--remote-rtt', type=float, default=0.5,
+                            help='Simulated round trip to the remote channel layer in ms (layers suite)')
+        parser.add_argument('--output', help='Also write the results to this file')
+        parser.add_argument('--baseline', default=BASELINE_PATH)
+        parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+        parser.add_argument('--check', action='store_true', help='Fail when a result regresses against the baseline')
+        parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed relative regression (default: 0.5)')
+
+    def handle(self, *args, **options):
+        suites = options['suites'] or list(SUITES)
+        unknown = set(suites) - set(SUITES)
+        if unknown:
+            raise CommandError(f'Unknown benchmark suites: {", ".join(sorted(unknown))}')
+
+        results = {suite: SUITES[suite](**options) for suite in suites}
+        output = json.dumps(results, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            Path(options['output']).write_text(output + '\n')
+
+        baseline_path = Path(options['baseline'])
+        if options['save_baseline']:
+            baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+            baseline.update(results)
+            baseline_path.write_text(json.dumps(baseline, indent=2) + '\n')
+
+        elif options['check']:
+            if not baseline_path.exists():
+                raise CommandError(f'No baseline at {baseline_path}, run with --save-baseline first')
+            baseline = json.loads(baseline_path.read_text())
+            regressions = []
+            for suite, result in results.items():
+                regressions += find_regressions(result, baseline.get(suite, {}), options['tolerance'], f'{suite}.')
+            if regressions:
+                raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
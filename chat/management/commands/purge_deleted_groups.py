@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.deletion import delete_batch
+from chat.models import ChatRoomModel, MessageModel
+
+
+class Command(BaseCommand):
+    help = 'Finish deleting rooms that group.delete hid but did not get to remove, e.g. after a restart'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_DELETE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        rooms = list(ChatRoomModel.objects.filter(deleted_at__isnull=False).values_list('pk', 'name'))
+        for group_uuid, name in rooms:
+            messages = 0
+            while True:
+                model, count = delete_batch(group_uuid, options['batch_size'])
+                if model is None or model is ChatRoomModel:
+                    break
+                if model is MessageModel:
+                    messages += count
+            self.stdout.write(f'Deleted group {name} ({group_uuid}) and {messages} messages')
+        self.stdout.write(self.style.SUCCESS(f'Purged {len(rooms)} deleted groups'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from chat import search
+from chat.models import MessageModel
+
+
+class Command(BaseCommand):
+    help = 'Recreate the full-text message search index from chat_messagemodel in one pass'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if not search.fts_supported(connection):
+            raise CommandError(
+                f'{connection.vendor} has no FTS5 support; search.message falls back to '
+                f'icontains matching and there is no index to rebuild'
+            )
+
+        search.uninstall(connection)
+        search.install(connection)
+        search.rebuild(connection)
+        count = MessageModel.objects.using(options['database']).count()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the search index over {count} messages'))
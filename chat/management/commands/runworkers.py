@@ -0,0 +1,44 @@
+import logging
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.supervisor import WORKER_IDS, Supervisor
+
+
+class Command(BaseCommand):
+    help = 'Serve the ASGI application from several worker processes sharing one listening socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--workers', type=int, default=settings.CHAT_WORKERS)
+        parser.add_argument('--application', default=':'.join(settings.ASGI_APPLICATION.rsplit('.', 1)))
+        parser.add_argument('--graceful-timeout', type=float, default=settings.CHAT_WORKER_GRACEFUL_TIMEOUT)
+        parser.add_argument('--health-interval', type=float, default=settings.CHAT_WORKER_HEALTH_INTERVAL)
+        parser.add_argument('--health-timeout', type=float, default=settings.CHAT_WORKER_HEALTH_TIMEOUT)
+        parser.add_argument('--health-failures', type=int, default=settings.CHAT_WORKER_HEALTH_FAILURES)
+        parser.add_argument('--health-port', type=int, help='Serve the state of all workers as JSON on this port')
+        parser.add_argument('--proxy-headers', action='store_true')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(
+            level={0: logging.WARNING, 1: logging.INFO}.get(options['verbosity'], logging.DEBUG),
+            format=f'%(asctime)s [supervisor {os.getpid()}] %(levelname)s %(name)s %(message)s',
+        )
+        workers = options['workers'] or min(os.cpu_count() or 1, WORKER_IDS // 2)
+        try:
+            supervisor = Supervisor(
+                options['application'], options['bind'], options['port'], workers,
+                graceful_timeout=options['graceful_timeout'],
+                health_interval=options['health_interval'],
+                health_timeout=options['health_timeout'],
+                health_failures=options['health_failures'],
+                health_port=options['health_port'],
+                verbosity=options['verbosity'],
+                proxy_headers=options['proxy_headers'],
+            )
+        except ValueError as exc:
+            raise CommandError(exc)
+        supervisor.run()
@@ -0,0 +1,189 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REGISTRY = []
+COLLECTORS = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [*zip(labelnames, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines += self._samples(key, value)
+        return lines
+
+    def _samples(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def register_collector(collector):
+    # ``collector`` is called at scrape time and returns (name, type, description, samples),
+    # where samples is a list of ({label: value}, value) pairs.
+    COLLECTORS.append(collector)
+    return collector
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    for collector in COLLECTORS:
+        for name, metric_type, description, samples in collector():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+fanout_latency = Histogram(
+    'chat_fanout_seconds',
+    'Time taken to deliver one notification to every recipient'
+)
+notifications_suppressed = Counter(
+    'chat_notifications_suppressed_total',
+    'Message notifications skipped because the recipient had the room open'
+)
+events_total = Counter(
+    'chat_events_total',
+    'WebSocket events handled',
+    ['consumer', 'event']
+)
+event_latency = Histogram(
+    'chat_event_duration_seconds',
+    'Time spent handling one WebSocket event',
+    ['consumer', 'event']
+)
+connections = Gauge(
+    'chat_connections',
+    'Open WebSocket connections',
+    ['consumer']
+)
+db_queue_wait = Histogram(
+    'chat_db_queue_wait_seconds',
+    'Time a database call waits for a worker thread',
+    ['executor']
+)
+rate_limited = Counter(
+    'chat_rate_limited_total',
+    'Events rejected by a rate limit',
+    ['consumer', 'event', 'scope']
+)
+send_queue_overflows = Counter(
+    'chat_send_queue_overflows_total',
+    'Outgoing frames that found the per-connection send queue full',
+    ['consumer', 'policy']
+)
+channel_layer_send_latency = Histogram(
+    'chat_channel_layer_send_seconds',
+    'Time spent in channel layer sends',
+    ['operation']
+)
+channel_layer_group_sends = Counter(
+    'chat_channel_layer_group_sends_total',
+    'Group sends by the hybrid channel layer, by whether they went through the remote layer',
+    ['route']
+)
@@ -1,16 +1,50 @@
+import functools
+
 from rest_framework.authtoken.models import Token
 from django.contrib.auth.models import AnonymousUser
-from channels.db import database_sync_to_async
 from channels.auth import AuthMiddlewareStack
+from twisted.internet.interfaces import IConsumer
+
+from chat.cache import token_cache
+from chat.db import database_sync_to_async
 
 
+# This runs before any consumer, so nothing has closed stale connections yet; the
+# database thread pool does that around every call.
 @database_sync_to_async
-def get_user_by_token(token):
+def load_user_by_token(token):
     try:
-        instance = Token.objects.get(key=token)
-        return instance.user
+        instance = Token.objects.select_related('user').get(key=token)
+        if instance.user.is_active:
+            return instance.user
     except Token.DoesNotExist:
-        return AnonymousUser
+        pass
+    return AnonymousUser
+
+
+async def get_user_by_token(token):
+    user = token_cache.get(token)
+    if user is None:
+        user = await load_user_by_token(token)
+        if user is not AnonymousUser:
+            token_cache.set(token, user)
+    return user
+
+
+class TransportMiddleware:
+    # Daphne hands the application a partial of Server.handle_reply bound to the connection's
+    # protocol. Its transport is where unsent bytes pile up when a client stops reading, so it
+    # goes into the scope for the consumers' outbox, as long as it is one the outbox can watch.
+    # Other servers, or a daphne that stops passing the protocol, leave the scope as it is.
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        if isinstance(send, functools.partial) and send.args:
+            transport = getattr(send.args[0], 'transport', None)
+            if IConsumer.providedBy(transport) or hasattr(transport, 'get_write_buffer_size'):
+                scope = dict(scope, transport=transport)
+        return await self.inner(scope, receive, send)
 
 
 class CheckValidPath:
@@ -60,4 +94,4 @@ def TokenAuthMiddlewareStack(inner):
     return TokenAuthMiddleware(AuthMiddlewareStack(inner))
 
 def CheckValidPathStack(inner):
-    return CheckValidPath(TokenAuthMiddlewareStack(inner))
+    return TransportMiddleware(CheckValidPath(TokenAuthMiddlewareStack(inner)))
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 18:22
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_chatroommodel_type_participantmodel_is_creator_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='participantmodel',
+            unique_together={('user', 'group')},
+        ),
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(fields=['group', 'created_at', 'id'], name='chat_message_history_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.6 on 2026-10-18 18:23
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def seed_last_read(apps, schema_editor):
+    # is_viewed was set once someone other than the author had seen a message, so for every
+    # participant the newest message that is viewed or their own is where their reading stopped.
+    ParticipantModel = apps.get_model('chat', 'ParticipantModel')
+    MessageModel = apps.get_model('chat', 'MessageModel')
+    db_alias = schema_editor.connection.alias
+
+    participants = list(ParticipantModel.objects.using(db_alias).values_list('pk', 'user_id', 'group_id'))
+    for pk, user_id, group_id in participants:
+        last_read = MessageModel.objects.using(db_alias).filter(
+            Q(is_viewed=True) | Q(user_id=user_id), group_id=group_id
+        ).order_by('-pk').values_list('pk', flat=True).first()
+        if last_read is not None:
+            ParticipantModel.objects.using(db_alias).filter(pk=pk).update(last_read_id=last_read)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_messagemodel_history_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participantmodel',
+            name='last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(seed_last_read, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='messagemodel',
+            name='is_viewed',
+        ),
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(fields=['group', 'id'], name='chat_message_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.6 on 2026-10-18 18:27
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_participantmodel_last_read_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messagemodel',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
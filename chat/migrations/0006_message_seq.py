@@ -0,0 +1,45 @@
+# Generated by Django 5.1.6 on 2026-10-18 18:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    ChatRoomModel = apps.get_model('chat', 'ChatRoomModel')
+    MessageModel = apps.get_model('chat', 'MessageModel')
+    db_alias = schema_editor.connection.alias
+
+    for room_id in list(ChatRoomModel.objects.using(db_alias).values_list('pk', flat=True)):
+        messages = list(
+            MessageModel.objects.using(db_alias).filter(group_id=room_id).order_by('created_at', 'id').only('id')
+        )
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        MessageModel.objects.using(db_alias).bulk_update(messages, ['seq'], batch_size=1000)
+        ChatRoomModel.objects.using(db_alias).filter(pk=room_id).update(last_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_alter_messagemodel_created_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommodel',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='messagemodel',
+            name='seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='messagemodel',
+            constraint=models.UniqueConstraint(fields=('group', 'seq'), name='chat_message_group_seq_uniq'),
+        ),
+    ]
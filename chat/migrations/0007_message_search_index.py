@@ -0,0 +1,68 @@
+from django.db import DatabaseError, migrations
+
+# Frozen copy of the index as it was first shipped; 0009 adds group_id.
+INSTALL_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts
+    USING fts5(text, content='chat_messagemodel', content_rowid='id')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_messagemodel BEGIN
+        INSERT INTO chat_message_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_messagemodel BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF text ON chat_messagemodel BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO chat_message_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+UNINSTALL_SQL = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+
+def fts_supported(connection):
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute('CREATE VIRTUAL TABLE temp.chat_fts5_probe USING fts5(x)')
+            cursor.execute('DROP TABLE temp.chat_fts5_probe')
+            return True
+        except DatabaseError:
+            return False
+
+
+def install_search_index(apps, schema_editor):
+    if fts_supported(schema_editor.connection):
+        for sql in INSTALL_SQL:
+            schema_editor.execute(sql)
+
+
+def uninstall_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in UNINSTALL_SQL:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
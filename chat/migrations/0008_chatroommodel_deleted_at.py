@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommodel',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
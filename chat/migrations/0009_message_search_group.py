@@ -0,0 +1,64 @@
+from importlib import import_module
+
+from django.db import migrations
+
+# Frozen copy of chat.search's SQL at this point in history.
+INSTALL_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts
+    USING fts5(text, group_id, content='chat_messagemodel', content_rowid='id')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_messagemodel BEGIN
+        INSERT INTO chat_message_fts(rowid, text, group_id) VALUES (new.id, new.text, new.group_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_messagemodel BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text, group_id)
+        VALUES ('delete', old.id, old.text, old.group_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF text, group_id ON chat_messagemodel BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text, group_id)
+        VALUES ('delete', old.id, old.text, old.group_id);
+        INSERT INTO chat_message_fts(rowid, text, group_id) VALUES (new.id, new.text, new.group_id);
+    END
+    """,
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+UNINSTALL_SQL = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+
+def reinstall(schema_editor, install_sql):
+    # The index gained a group_id column; FTS5 tables can't be altered, only rebuilt.
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite' and 'chat_message_fts' in connection.introspection.table_names():
+        for sql in UNINSTALL_SQL + install_sql:
+            schema_editor.execute(sql)
+
+
+def add_group_id(apps, schema_editor):
+    reinstall(schema_editor, INSTALL_SQL)
+
+
+def remove_group_id(apps, schema_editor):
+    reinstall(schema_editor, import_module('chat.migrations.0007_message_search_index').INSTALL_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_chatroommodel_deleted_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_group_id, remove_group_id),
+    ]
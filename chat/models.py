@@ -1,5 +1,7 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 UserModel = get_user_model()
@@ -13,10 +15,18 @@ class ChatRoomModel(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=200, db_index=True)
     type = models.CharField(max_length=10, choices=TYPES)
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # Set when group.delete hides the room; chat.deletion then removes it in batches.
+    deleted_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.name
 
+    def next_seq(self):
+        with transaction.atomic():
+            ChatRoomModel.objects.filter(pk=self.pk).update(last_seq=F('last_seq') + 1)
+            return ChatRoomModel.objects.filter(pk=self.pk).values_list('last_seq', flat=True).get()
+
     @property
     def link(self):
         return f"chat/{self.uuid}"
@@ -26,6 +36,9 @@ class ParticipantModel(models.Model):
     user = models.ForeignKey(UserModel, on_delete=models.CASCADE, related_name='chats')
     group = models.ForeignKey(ChatRoomModel, on_delete=models.CASCADE, related_name='participants')
     is_creator = models.BooleanField(default=False)
+    # Id of the newest message the user has read. A plain number rather than a foreign key,
+    # so archiving or deleting that message doesn't turn the whole room unread again.
+    last_read_id = models.PositiveBigIntegerField(default=0)
 
     class Meta:
         unique_together = "user", "group"
@@ -38,8 +51,24 @@ class MessageModel(models.Model):
     text = models.TextField()
     user = models.ForeignKey(UserModel, on_delete=models.CASCADE, related_name='messages')
     group = models.ForeignKey(ChatRoomModel, on_delete=models.CASCADE, related_name='messages')
-    is_viewed = models.BooleanField(default=False)
-    created_at = models.DateTimeField(auto_now=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    seq = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'seq'], name='chat_message_group_seq_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['group', 'created_at', 'id'], name='chat_message_history_idx'),
+            models.Index(fields=['group', 'id'], name='chat_message_unread_idx'),
+        ]
 
     def __str__(self):
         return f'<{self.text[:20]}> from {self.user} in {self.group}'
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and not self.seq:
+            with transaction.atomic():
+                self.seq = self.group.next_seq()
+                return super().save(*args, **kwargs)
+        return super().save(*args, **kwargs)
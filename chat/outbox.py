@@ -0,0 +1,106 @@
+import asyncio
+
+from twisted.internet.interfaces import IConsumer, IPushProducer
+from zope.interface import implementer
+
+from chat.metrics import send_queue_overflows
+
+POLICIES = ('drop_oldest', 'drop_newest', 'disconnect')
+
+# Like 1013 "Try Again Later", which autobahn won't send: the client should reconnect and
+# catch up with sync.since.
+OVERFLOW_CLOSE_CODE = 4013
+
+
+@implementer(IPushProducer)
+class Outbox:
+    # Sits in front of the ASGI send callable and watches the connection's transport. Frames
+    # go straight through while the transport keeps up; past that, a slow reader has them
+    # queued until it catches up, and once ``maxsize`` frames are waiting, ``policy`` decides
+    # what gives. Twisted transports say when they are backed up by pausing their registered
+    # producer; asyncio ones are polled for more than ``high_water`` unsent bytes.
+    def __init__(self, send, transport, maxsize, policy, consumer, high_water, poll_interval=0.05):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown send queue policy {policy!r}, expected one of {POLICIES}')
+        self._send = send
+        self.transport = transport
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.policy = policy
+        self.consumer = consumer
+        self.high_water = high_water
+        self.poll_interval = poll_interval
+        self.closing = False
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self._task = None
+        self.twisted = IConsumer.providedBy(transport)
+        if self.twisted:
+            # TCP transports pause past bufferSize; TLS ones pass the producer down to theirs.
+            if hasattr(transport, 'bufferSize'):
+                transport.bufferSize = high_water
+            transport.registerProducer(self, True)
+        self.registered = self.twisted
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    def stopProducing(self):
+        self.close()
+
+    def backlogged(self):
+        if self.twisted:
+            return not self.writable.is_set()
+        return self.transport.get_write_buffer_size() > self.high_water
+
+    async def wait_writable(self):
+        if self.twisted:
+            return await self.writable.wait()
+        while self.backlogged():
+            await asyncio.sleep(self.poll_interval)
+
+    async def send(self, message):
+        if self.closing:
+            return
+        if message['type'] == 'websocket.close':
+            self.closing = True
+        if self._task is None and not self.backlogged():
+            return await self._send(message)
+
+        if self.queue.full() and message['type'] == 'websocket.close':
+            self.queue.get_nowait()
+        elif self.queue.full():
+            send_queue_overflows.inc(consumer=self.consumer, policy=self.policy)
+            if self.policy == 'drop_newest':
+                return
+            if self.policy == 'drop_oldest':
+                self.queue.get_nowait()
+            else:
+                # The close frame goes out right away rather than waiting for a reader that
+                # may never catch up; the closing handshake times out on its own if it doesn't.
+                self.close()
+                return await self._send({'type': 'websocket.close', 'code': OVERFLOW_CLOSE_CODE})
+        self.queue.put_nowait(message)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        try:
+            while not self.queue.empty():
+                await self.wait_writable()
+                message = self.queue.get_nowait()
+                await self._send(message)
+                if message['type'] == 'websocket.close':
+                    return
+        finally:
+            self._task = None
+
+    def close(self):
+        self.closing = True
+        if self.registered:
+            self.registered = False
+            self.transport.unregisterProducer()
+        if self._task is not None:
+            self._task.cancel()
@@ -0,0 +1,81 @@
+import time
+from collections import Counter, defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+
+class LocalPresence:
+    # Rooms open in this process. Enough for a single worker or the in-memory channel layer.
+    expires = False
+
+    def __init__(self):
+        self._rooms = defaultdict(Counter)
+
+    async def enter(self, room, user_id, channel_name):
+        self._rooms[room][user_id] += 1
+
+    async def refresh(self, room, user_id, channel_name):
+        pass
+
+    async def leave(self, room, user_id, channel_name):
+        users = self._rooms.get(room)
+        if users is None:
+            return
+        users[user_id] -= 1
+        if users[user_id] <= 0:
+            del users[user_id]
+        if not users:
+            del self._rooms[room]
+
+    async def users(self, room):
+        return set(self._rooms.get(room, ()))
+
+
+class RedisPresence:
+    # One sorted set per room in the channel layer's Redis, shared by every worker. Members
+    # are scored by expiry time, so the entries of a crashed worker age out on their own
+    # while live connections refresh theirs.
+    expires = True
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def _key(self, room):
+        return f'{self.layer.prefix}:presence:{room}'
+
+    def _connection(self, key):
+        return self.layer.connection(self.layer.consistent_hash(key))
+
+    async def enter(self, room, user_id, channel_name):
+        key = self._key(room)
+        await self._connection(key).zremrangebyscore(key, min=0, max=time.time())
+        await self.refresh(room, user_id, channel_name)
+
+    async def refresh(self, room, user_id, channel_name):
+        key = self._key(room)
+        connection = self._connection(key)
+        await connection.zadd(key, {f'{user_id}:{channel_name}': time.time() + settings.CHAT_PRESENCE_TTL})
+        await connection.expire(key, settings.CHAT_PRESENCE_TTL)
+
+    async def leave(self, room, user_id, channel_name):
+        key = self._key(room)
+        await self._connection(key).zrem(key, f'{user_id}:{channel_name}')
+
+    async def users(self, room):
+        key = self._key(room)
+        members = await self._connection(key).zrangebyscore(key, min=time.time(), max='+inf')
+        return {int(member.split(b':', 1)[0]) for member in members}
+
+
+local_presence = LocalPresence()
+_redis_presence = {}
+
+
+def get_presence():
+    layer = get_channel_layer()
+    if hasattr(layer, 'consistent_hash') and hasattr(layer, 'connection'):
+        if layer not in _redis_presence:
+            _redis_presence[layer] = RedisPresence(layer)
+        return _redis_presence[layer]
+    return local_presence
@@ -0,0 +1,73 @@
+import time
+
+from django.conf import settings
+
+from chat.cache import TTLCache
+
+# Idle user buckets are forgotten after this long; any sane limit has refilled by then.
+USER_BUCKET_TTL = 300
+
+user_buckets = TTLCache(settings.CHAT_RATE_LIMIT_USERS, USER_BUCKET_TTL)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self):
+        # Seconds until one token is available, 0 if one is available now.
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    def __init__(self, user_id, limits=None):
+        self.user_id = user_id
+        self.limits = settings.CHAT_RATE_LIMITS if limits is None else limits
+        self._buckets = {}
+
+    def _limit(self, event, scope):
+        limits = self.limits.get(event, self.limits.get('*')) or {}
+        return limits.get(scope)
+
+    def _connection_bucket(self, event, limit):
+        bucket = self._buckets.get(event)
+        if bucket is None:
+            bucket = self._buckets[event] = TokenBucket(*limit)
+        return bucket
+
+    def _user_bucket(self, event, limit):
+        key = (self.user_id, event)
+        bucket = user_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*limit)
+        user_buckets.set(key, bucket)
+        return bucket
+
+    def check(self, event):
+        # Returns (scope, retry_after) for the first exhausted bucket, or None after
+        # taking a token from every bucket that applies to the event.
+        buckets = []
+        for scope, get_bucket in (('connection', self._connection_bucket), ('user', self._user_bucket)):
+            limit = self._limit(event, scope.upper())
+            if limit is None:
+                continue
+            bucket = get_bucket(event, limit)
+            retry_after = bucket.retry_after()
+            if retry_after:
+                return scope, retry_after
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            bucket.take()
@@ -0,0 +1,118 @@
+# Full-text search over message history. On SQLite with FTS5, chat_message_fts indexes text and
+# group_id as an external-content table kept in step by triggers, and queries match the room's id
+# alongside their terms. Elsewhere it falls back to icontains scoped to the room, which is a scan:
+# on PostgreSQL add a trigram or tsvector GIN index on chat_messagemodel.text before relying on it.
+from django.db import DatabaseError, connection
+
+from chat.models import MessageModel
+
+SEARCH_TABLE = 'chat_message_fts'
+
+INSTALL_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}
+    USING fts5(text, group_id, content='chat_messagemodel', content_rowid='id')
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON chat_messagemodel BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, text, group_id) VALUES (new.id, new.text, new.group_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON chat_messagemodel BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, text, group_id) VALUES ('delete', old.id, old.text, old.group_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE OF text, group_id ON chat_messagemodel BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, text, group_id) VALUES ('delete', old.id, old.text, old.group_id);
+        INSERT INTO {SEARCH_TABLE}(rowid, text, group_id) VALUES (new.id, new.text, new.group_id);
+    END
+    """,
+]
+
+UNINSTALL_SQL = [
+    f'DROP TRIGGER IF EXISTS {SEARCH_TABLE}_insert',
+    f'DROP TRIGGER IF EXISTS {SEARCH_TABLE}_delete',
+    f'DROP TRIGGER IF EXISTS {SEARCH_TABLE}_update',
+    f'DROP TABLE IF EXISTS {SEARCH_TABLE}',
+]
+
+
+def fts_supported(conn=connection):
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if cursor.fetchone()[0]:
+            return True
+        try:
+            cursor.execute('CREATE VIRTUAL TABLE temp.chat_fts5_probe USING fts5(x)')
+            cursor.execute('DROP TABLE temp.chat_fts5_probe')
+            return True
+        except DatabaseError:
+            return False
+
+
+_installed = {}
+
+
+def fts_installed(conn=connection):
+    if conn.alias not in _installed:
+        _installed[conn.alias] = conn.vendor == 'sqlite' and SEARCH_TABLE in conn.introspection.table_names()
+    return _installed[conn.alias]
+
+
+def install(conn=connection):
+    with conn.cursor() as cursor:
+        for sql in INSTALL_SQL:
+            cursor.execute(sql)
+    _installed.pop(conn.alias, None)
+
+
+def uninstall(conn=connection):
+    with conn.cursor() as cursor:
+        for sql in UNINSTALL_SQL:
+            cursor.execute(sql)
+    _installed.pop(conn.alias, None)
+
+
+def rebuild(conn=connection):
+    with conn.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')")
+
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def to_match_query(group_id, query):
+    # Quote every term so user input can never be parsed as FTS5 query syntax.
+    return ' AND '.join(['group_id:' + _quote(group_id)] + ['text:' + _quote(term) for term in query.split()])
+
+
+def search_messages(group, query, limit, offset=0):
+    terms = query.split()
+    if not terms:
+        return []
+
+    if fts_installed():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT m.id FROM {SEARCH_TABLE} f
+                JOIN chat_messagemodel m ON m.id = f.rowid
+                WHERE {SEARCH_TABLE} MATCH %s
+                ORDER BY bm25({SEARCH_TABLE}, 1.0, 0.0)
+                LIMIT %s OFFSET %s
+                """,
+                [to_match_query(group.pk.hex, query), limit, offset]
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        messages = MessageModel.objects.select_related('user').in_bulk(ids)
+        return [messages[pk] for pk in ids if pk in messages]
+
+    messages = MessageModel.objects.select_related('user').filter(group=group)
+    for term in terms:
+        messages = messages.filter(text__icontains=term)
+    return list(messages.order_by('-seq')[offset:offset + limit])
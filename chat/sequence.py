@@ -0,0 +1,77 @@
+from channels.layers import get_channel_layer
+
+from chat.models import ChatRoomModel
+
+
+async def _stored_last_seq(room):
+    return await ChatRoomModel.objects.filter(pk=room).values_list('last_seq', flat=True).aget()
+
+
+class LocalSequence:
+    # Per-room counters of this process, seeded once from the database. Enough when a single
+    # process writes every room, as with the in-memory channel layer.
+    def __init__(self):
+        self._last = {}
+
+    async def next(self, room):
+        if room not in self._last:
+            seed = await _stored_last_seq(room)
+            self._last.setdefault(room, seed)
+        self._last[room] += 1
+        return self._last[room]
+
+    async def current(self, room):
+        return self._last.get(room)
+
+
+class RedisSequence:
+    # One counter per room in the channel layer's Redis, shared by every worker. A counter that
+    # is missing (new, evicted, or on a shard that took over) starts again from the database.
+    INCREMENT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        return redis.call('INCR', KEYS[1])
+    """
+    SEED = """
+        local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+        if current < tonumber(ARGV[1]) then
+            redis.call('SET', KEYS[1], ARGV[1])
+        end
+        return redis.call('INCR', KEYS[1])
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def _key(self, room):
+        return f'{self.layer.prefix}:seq:{room}'
+
+    def _connection(self, key):
+        return self.layer.connection(self.layer.consistent_hash(key))
+
+    async def next(self, room):
+        key = self._key(room)
+        connection = self._connection(key)
+        seq = await connection.eval(self.INCREMENT, 1, key)
+        if not seq:
+            seq = await connection.eval(self.SEED, 1, key, await _stored_last_seq(room))
+        return seq
+
+    async def current(self, room):
+        key = self._key(room)
+        value = await self._connection(key).get(key)
+        return int(value) if value is not None else None
+
+
+local_sequence = LocalSequence()
+_redis_sequence = {}
+
+
+def get_sequence():
+    layer = get_channel_layer()
+    if hasattr(layer, 'consistent_hash') and hasattr(layer, 'connection'):
+        if layer not in _redis_sequence:
+            _redis_sequence[layer] = RedisSequence(layer)
+        return _redis_sequence[layer]
+    return local_sequence
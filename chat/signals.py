@@ -1,42 +1,39 @@
-from asgiref.sync import async_to_sync
-
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from channels.layers import get_channel_layer
-
-from chat.models import MessageModel, ParticipantModel
-
+from rest_framework.authtoken.models import Token
 
-def send_chat_message(chat, message):
-    async_to_sync(get_channel_layer().group_send)(chat, message)
+from chat.cache import invalidate
+from chat.fanout import fan_out, new_message_notice, notify_added_to_group
+from chat.models import MessageModel, ParticipantModel, UserModel
+from chat.utils import run_detached
 
 
 @receiver(post_save, sender=MessageModel)
 def message_notice(sender, instance, created, **kwargs):
     if created:
-        data = {
-            'type': 'send.notification',
-            'message': {
-                'type': 'new message',
-                'group': instance.group.name,
-                'sender': instance.user.username,
-                'message': instance.text,
-            }
-        }
-        participants = ParticipantModel.objects.filter(group=instance.group).exclude(user=instance.user)
-
-        for participant in participants:
-            send_chat_message(chat=f'user_{participant.user.id}', message=data)
+        data = new_message_notice(instance)
+        recipients = list(
+            ParticipantModel.objects.filter(group_id=instance.group_id)
+            .exclude(user_id=instance.user_id)
+            .values_list('user_id', flat=True)
+        )
+        transaction.on_commit(lambda: fan_out(recipients, data, room=str(instance.group_id)))
 
 
 @receiver(post_save, sender=ParticipantModel)
-def message_notice(sender, instance, created, **kwargs):
-    if created and instance.group.type != 'dialog' and not instance.creator_permission:
-        data = {
-            'type': 'send.notification',
-            'message': {
-                'type': 'new group',
-                'message': f'You were added to group {instance.group.name}',
-            }
-        }
-        send_chat_message(chat=f'user_{instance.user.id}', message=data)
+def participant_notice(sender, instance, created, **kwargs):
+    if created and not instance.is_creator:
+        transaction.on_commit(lambda: notify_added_to_group(instance.group, [instance.user_id]))
+
+
+@receiver(post_delete, sender=Token)
+def token_revoked(sender, instance, **kwargs):
+    transaction.on_commit(lambda: run_detached(invalidate, 'tokens', instance.key))
+
+
+@receiver(post_save, sender=UserModel)
+def user_deactivated(sender, instance, created, **kwargs):
+    if not created and not instance.is_active:
+        for key in Token.objects.filter(user=instance).values_list('key', flat=True):
+            transaction.on_commit(lambda key=key: run_detached(invalidate, 'tokens', key))
@@ -0,0 +1,347 @@
+# Pre-forked ASGI workers behind one listening socket, for manage.py runworkers. The supervisor
+# binds the socket and every worker inherits it (see chat.worker), so the kernel spreads connections
+# over them and a restart never closes the port. Workers get distinct CHAT_WORKER_IDs from 0-31,
+# which keeps write-behind message ids unique. Exited workers restart with a growing backoff, hung
+# ones (failing /health over their unix socket) are replaced, SIGHUP starts a new generation and
+# drains the old one once it's healthy, and SIGTERM or SIGINT drains everything and exits.
+import http.client
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+
+from chat.utils import is_internal
+
+logger = logging.getLogger(__name__)
+
+WORKER_IDS = 32
+STABLE_AFTER = 10
+MAX_BACKOFF = 30
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, host, timeout):
+        super().__init__(host, timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _health_host():
+    # The health request goes through Django's host validation like any other.
+    return next((host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost')
+
+
+def probe(socket_path, timeout):
+    connection = UnixHTTPConnection(socket_path, _health_host(), timeout)
+    try:
+        connection.request('GET', '/health')
+        response = connection.getresponse()
+        if response.status != 200:
+            raise OSError(f'/health answered {response.status}')
+        return json.loads(response.read())
+    finally:
+        connection.close()
+
+
+class Worker:
+    def __init__(self, slot, worker_id, generation, process, health_socket):
+        self.slot = slot
+        self.worker_id = worker_id
+        self.generation = generation
+        self.process = process
+        self.health_socket = health_socket
+        self.started = time.monotonic()
+        self.failures = 0
+        self.health = None
+        self.checked_at = None
+        self.kill_at = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def healthy(self):
+        return self.health is not None and self.failures == 0
+
+    def state(self):
+        return {
+            'slot': self.slot,
+            'worker_id': self.worker_id,
+            'generation': self.generation,
+            'pid': self.pid,
+            'uptime': round(time.monotonic() - self.started, 1),
+            'healthy': self.healthy,
+            'draining': self.kill_at is not None,
+            'failures': self.failures,
+            'connections': self.health['connections'] if self.health else None,
+            'checked_ago': round(time.monotonic() - self.checked_at, 1) if self.checked_at else None,
+        }
+
+
+class Supervisor:
+    def __init__(self, application, bind, port, workers, graceful_timeout, health_interval,
+                 health_timeout, health_failures, health_port=None, verbosity=1, proxy_headers=False):
+        # A reload runs two generations side by side, and each worker needs its own id.
+        if not 0 < workers <= WORKER_IDS // 2:
+            raise ValueError(f'workers must be between 1 and {WORKER_IDS // 2}')
+        self.application = application
+        self.bind = bind
+        self.port = port
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.health_failures = health_failures
+        self.health_port = health_port
+        self.verbosity = verbosity
+        self.proxy_headers = proxy_headers
+
+        self.slots = {}
+        self.starting = {}
+        self.retiring = []
+        self.pending = {}
+        self.crashes = {}
+        self.generation = 0
+        self.spawned = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.reload_requested = False
+        self.reload_waiting = False
+
+    def listen(self):
+        family = socket.AF_INET6 if ':' in self.bind else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.bind, self.port))
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.set_inheritable(True)
+        self.family = 'INET6' if family == socket.AF_INET6 else 'INET'
+        self.port = self.socket.getsockname()[1]
+
+    def free_worker_ids(self):
+        used = {worker.worker_id for worker in [*self.slots.values(), *self.starting.values(), *self.retiring]}
+        return sorted(set(range(WORKER_IDS)) - used)
+
+    def spawn(self, slot):
+        worker_id = self.free_worker_ids()[0]
+        self.spawned += 1
+        health_socket = os.path.join(self.socket_dir, f'worker-{self.spawned}.sock')
+        command = [
+            sys.executable, '-m', 'chat.worker', self.application,
+            '--fd', str(self.socket.fileno()),
+            '--family', self.family,
+            '--health-socket', health_socket,
+            '--graceful-timeout', str(self.graceful_timeout),
+            '--verbosity', str(self.verbosity),
+        ]
+        if self.proxy_headers:
+            command.append('--proxy-headers')
+        process = subprocess.Popen(
+            command,
+            pass_fds=(self.socket.fileno(),),
+            cwd=settings.BASE_DIR,
+            env={**os.environ, 'CHAT_WORKER_ID': str(worker_id)},
+        )
+        worker = Worker(slot, worker_id, self.generation, process, health_socket)
+        logger.info('Started worker %s (pid %s, generation %s)', worker_id, worker.pid, self.generation)
+        return worker
+
+    def retire(self, worker, sig=signal.SIGTERM):
+        # Drain, then kill whatever is left after the graceful timeout.
+        worker.kill_at = time.monotonic() + self.graceful_timeout + 5
+        self.retiring.append(worker)
+        try:
+            worker.process.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+    def check(self, worker):
+        try:
+            worker.health = probe(worker.health_socket, self.health_timeout)
+            worker.failures = 0
+        except (OSError, ValueError) as exc:
+            worker.failures += 1
+            logger.debug('Health check of worker %s failed: %s', worker.worker_id, exc)
+        worker.checked_at = time.monotonic()
+
+    def health_loop(self):
+        while not self.stopping.wait(self.health_interval):
+            with self.lock:
+                workers = list(self.slots.values())
+            for worker in workers:
+                self.check(worker)
+
+    def restart_hung(self):
+        now = time.monotonic()
+        for slot, worker in list(self.slots.items()):
+            # A worker that never answered yet gets graceful_timeout to boot.
+            booting = worker.health is None and now - worker.started < self.graceful_timeout
+            if worker.failures >= self.health_failures and not booting:
+                logger.warning('Worker %s (pid %s) failed %s health checks, replacing it',
+                               worker.worker_id, worker.pid, worker.failures)
+                with self.lock:
+                    del self.slots[slot]
+                self.retire(worker, signal.SIGKILL)
+                self.pending[slot] = now
+
+    def reap(self):
+        now = time.monotonic()
+        for slot, worker in list(self.slots.items()):
+            code = worker.process.poll()
+            if code is None:
+                continue
+            with self.lock:
+                del self.slots[slot]
+            if now - worker.started < STABLE_AFTER:
+                self.crashes[slot] = self.crashes.get(slot, 0) + 1
+            else:
+                self.crashes[slot] = 0
+            delay = min(2 ** self.crashes[slot] - 1, MAX_BACKOFF)
+            logger.error('Worker %s (pid %s) exited with %s, restarting in %ss', worker.worker_id, worker.pid, code, delay)
+            self.pending[slot] = now + delay
+
+        for worker in list(self.retiring):
+            if worker.process.poll() is not None:
+                self.retiring.remove(worker)
+                logger.info('Worker %s (pid %s) stopped', worker.worker_id, worker.pid)
+            elif now >= worker.kill_at:
+                logger.warning('Worker %s (pid %s) still running after the graceful timeout, killing it',
+                               worker.worker_id, worker.pid)
+                worker.process.kill()
+                worker.kill_at = float('inf')
+
+        for slot, at in list(self.pending.items()):
+            # Draining generations can hold every spare id for a while; the slot waits for one.
+            if now >= at and self.free_worker_ids():
+                del self.pending[slot]
+                worker = self.spawn(slot)
+                with self.lock:
+                    self.slots[slot] = worker
+
+    def reload(self):
+        # Until the generation before last has drained, its ids may be the ones this one needs.
+        # A reload requested meanwhile waits for them rather than failing.
+        if len(self.free_worker_ids()) < self.workers:
+            if not self.reload_waiting:
+                logger.info('Reload waits for %s draining workers', len(self.retiring))
+                self.reload_waiting = True
+            return
+        self.reload_requested = self.reload_waiting = False
+        self.generation += 1
+        logger.info('Reloading: starting generation %s', self.generation)
+        new = self.starting
+        for slot in range(self.workers):
+            new[slot] = self.spawn(slot)
+        deadline = time.monotonic() + self.graceful_timeout
+        while not all(worker.health for worker in new.values()):
+            exited = [worker for worker in new.values() if worker.process.poll() is not None]
+            if exited or time.monotonic() >= deadline or self.stopping.is_set():
+                logger.error('Generation %s did not come up, keeping generation %s', self.generation, self.generation - 1)
+                for worker in new.values():
+                    self.retire(worker, signal.SIGKILL)
+                self.starting = {}
+                return
+            time.sleep(0.2)
+            for worker in new.values():
+                if not worker.health:
+                    self.check(worker)
+
+        with self.lock:
+            old, self.slots, self.starting = self.slots, new, {}
+        self.pending.clear()
+        for worker in old.values():
+            self.retire(worker)
+        logger.info('Generation %s serving, draining %s old workers', self.generation, len(old))
+
+    def state(self):
+        with self.lock:
+            workers = [*self.slots.values(), *self.retiring]
+        workers = [worker.state() for worker in workers]
+        serving = [worker for worker in workers if not worker['draining']]
+        healthy = len(serving) == self.workers and all(worker['healthy'] for worker in serving)
+        return {
+            'status': 'ok' if healthy else 'degraded',
+            'pid': os.getpid(),
+            'generation': self.generation,
+            'workers': workers,
+        }
+
+    def serve_health(self):
+        supervisor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not is_internal(self.client_address[0]):
+                    self.send_error(403)
+                    return
+                state = supervisor.state()
+                body = json.dumps(state).encode()
+                self.send_response(200 if state['status'] == 'ok' else 503)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((self.bind, self.health_port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def _stop(self, signum, frame):
+        self.stopping.set()
+
+    def _reload(self, signum, frame):
+        self.reload_requested = True
+
+    def run(self):
+        self.listen()
+        self.socket_dir = tempfile.mkdtemp(prefix='chat-workers-')
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        health_server = self.serve_health() if self.health_port is not None else None
+        logger.info('Listening on %s:%s with %s workers', self.bind, self.port, self.workers)
+        try:
+            for slot in range(self.workers):
+                self.slots[slot] = self.spawn(slot)
+            threading.Thread(target=self.health_loop, daemon=True).start()
+            while not self.stopping.is_set():
+                if self.reload_requested:
+                    self.reload()
+                self.reap()
+                self.restart_hung()
+                self.stopping.wait(0.2)
+        finally:
+            self.shutdown()
+            if health_server:
+                health_server.shutdown()
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket.close()
+
+    def shutdown(self):
+        logger.info('Stopping %s workers', len(self.slots))
+        with self.lock:
+            workers, self.slots = list(self.slots.values()), {}
+        self.pending.clear()
+        for worker in workers:
+            self.retire(worker)
+        while self.retiring:
+            self.reap()
+            time.sleep(0.1)
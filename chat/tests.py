@@ -1,3 +1,1569 @@
-from django.test import TestCase
+import asyncio
+import copy
+import functools
+import http.client
+import json
+import math
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+import uuid
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels_redis.core import RedisChannelLayer
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from redis.exceptions import ConnectionError as RedisConnectionError
+from rest_framework.authtoken.models import Token
+from twisted.internet import tcp
+from twisted.internet.error import ConnectionDone
+from twisted.internet.protocol import Protocol
+from twisted.internet.testing import MemoryReactor
+from twisted.python.failure import Failure
+
+from chat.archive import archive_room, get_archive
+from chat.cache import (
+    INVALIDATION_GROUP, directory_cache, handlers, room_cache, start_invalidation_listener, token_cache,
+)
+from chat.consumers import ChatRoomConsumer, MainConsumer
+from chat.consumers.rooms import decode_cursor
+from chat.deletion import delete_batch, delete_group
+from chat.dbrouters import database_user, is_pinned, pinned_users, replica_reads, share_pin, shared_pins
+from chat.fanout import send_notifications
+from chat.layers import HybridChannelLayer, ShardedRedisChannelLayer
+from chat.middlewares import TransportMiddleware, get_user_by_token
+from chat.models import ChatRoomModel, MessageModel, ParticipantModel, UserModel
+from chat.outbox import OVERFLOW_CLOSE_CODE, Outbox
+from chat.presence import LocalPresence
+from chat.ratelimit import RateLimiter, user_buckets
+from chat.search import SEARCH_TABLE, fts_installed
+from chat.sequence import RedisSequence
+from chat.supervisor import Supervisor
+from chat.utils import encode_frame
+from chat.writebehind import IdGenerator, Journal, MessageWriter, _dump
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class RoomTestCase(TransactionTestCase):
+    # alice created the room and bob is a member. The messages alternate between them, bob first,
+    # and share timestamps in pairs, so every cursor has to break ties on the id.
+    message_count = 7
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.enterContext(override_settings(CHAT_ARCHIVE_DIR=directory))
+        self.alice = UserModel.objects.create(username='alice')
+        self.bob = UserModel.objects.create(username='bob')
+        self.room = ChatRoomModel.objects.create(name='room', type='group')
+        ParticipantModel.objects.create(user=self.alice, group=self.room, is_creator=True)
+        ParticipantModel.objects.create(user=self.bob, group=self.room)
+        start = timezone.now() - timedelta(hours=1)
+        self.messages = [
+            MessageModel.objects.create(
+                text=f'm{i}', user=[self.bob, self.alice][i % 2], group=self.room,
+                created_at=start + timedelta(minutes=i // 2),
+            )
+            for i in range(self.message_count)
+        ]
+
+    def consumer(self, user):
+        consumer = ChatRoomConsumer()
+        consumer.scope = {'user': user}
+        consumer.group = self.room
+        consumer.group_id = str(self.room.pk)
+        return consumer
+
+    @staticmethod
+    def texts(page):
+        return [msg['text'] for msg in page['messages']]
+
+
+class MessageHistoryTests(RoomTestCase):
+    def test_list_message_cursors_page_both_ways(self):
+        consumer = self.consumer(self.alice)
+        page = async_to_sync(consumer.get_message_list)(3)
+        self.assertEqual(self.texts(page), ['m4', 'm5', 'm6'])
+        self.assertTrue(page['has_more'])
+
+        pages = []
+        while page['has_more']:
+            page = async_to_sync(consumer.get_message_list)(3, before=decode_cursor(page['before']))
+            pages.append(self.texts(page))
+        self.assertEqual(pages, [['m1', 'm2', 'm3'], ['m0']])
+
+        pages = []
+        page = {'after': page['after'], 'has_more': True}
+        while page['has_more']:
+            page = async_to_sync(consumer.get_message_list)(2, after=decode_cursor(page['after']))
+            pages.append(self.texts(page))
+        self.assertEqual(pages, [['m1', 'm2'], ['m3', 'm4'], ['m5', 'm6']])
+
+    def test_bad_cursor_is_rejected(self):
+        self.assertIsNone(decode_cursor('not a cursor'))
+
+
+
+class ReadWatermarkTests(RoomTestCase):
+    def test_unread_counts_others_messages_past_watermark(self):
+        consumer = self.consumer(self.bob)
+        # m1, m3 and m5 are alice's.
+        self.assertEqual(async_to_sync(consumer.get_unread_count)(), 3)
+
+        async_to_sync(consumer.mark_read)(self.messages[3].pk)
+        self.assertEqual(async_to_sync(consumer.get_unread_count)(), 1)
+        # The watermark never moves back.
+        async_to_sync(consumer.mark_read)(self.messages[0].pk)
+        self.assertEqual(async_to_sync(consumer.get_unread_count)(), 1)
+
+    def test_newest_history_page_marks_room_read(self):
+        consumer = self.consumer(self.bob)
+        async_to_sync(consumer.get_message_list)(3, before=(self.messages[4].created_at, self.messages[4].pk))
+        self.assertEqual(async_to_sync(consumer.get_unread_count)(), 3)
+
+        async_to_sync(consumer.get_message_list)(3)
+        self.assertEqual(ParticipantModel.objects.get(user=self.bob).last_read_id, self.messages[-1].pk)
+        self.assertEqual(async_to_sync(consumer.get_unread_count)(), 0)
+
+    def test_only_a_moved_watermark_pins(self):
+        pinned_users.clear()
+        self.addCleanup(pinned_users.clear)
+        consumer = self.consumer(self.bob)
+        with database_user(self.bob.pk):
+            async_to_sync(consumer.get_message_list)(3)
+            self.assertTrue(is_pinned(self.bob.pk))
+
+            pinned_users.clear()
+            async_to_sync(consumer.get_message_list)(3)
+            async_to_sync(consumer.mark_read)(self.messages[2].pk)
+            self.assertFalse(is_pinned(self.bob.pk))
+
+
+class RecordingGroupSends:
+    # A channel layer that records group sends and how many of them were in flight at once.
+    def __init__(self, fail=()):
+        self.sent = []
+        self.fail = fail
+        self.in_flight = 0
+        self.peak = 0
+
+    async def group_send(self, group, message):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        if group in self.fail:
+            raise ChannelFull(group)
+        self.sent.append((group, message))
+
+
+class BatchModeTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.consumer = ChatRoomConsumer()
+        self.consumer.batch = None
+        self.consumer.batch_flush = None
+        self.sent = []
+
+        async def send(message):
+            self.sent.append(json.loads(message['text']))
+
+        self.consumer.base_send = send
+
+    async def broadcast(self, seq):
+        await self.consumer.chat_message({'type': 'chat.message', 'text': encode_frame({'seq': seq}, 'chat.message')})
+
+    async def set_mode(self, enabled):
+        await self.consumer.event_batch_mode({'event': 'batch.mode', 'data': {'enabled': enabled}})
+        self.assertEqual(self.sent.pop()['message']['enabled'], enabled)
+
+    async def test_frames_go_straight_out_without_batch_mode(self):
+        await self.broadcast(1)
+        self.assertEqual(self.sent, [{'status': 'ok', 'event': 'chat.message', 'message': {'seq': 1}}])
+
+    @override_settings(CHAT_BATCH_WINDOW=0.01)
+    async def test_window_gathers_frames_into_one_batch(self):
+        await self.set_mode(True)
+        for seq in (1, 2, 3):
+            await self.broadcast(seq)
+        self.assertEqual(self.sent, [])
+
+        await asyncio.sleep(0.05)
+        (batch,) = self.sent
+        self.assertEqual(batch['event'], 'messages.batch')
+        self.assertEqual([frame['message']['seq'] for frame in batch['message']], [1, 2, 3])
+
+        # A lone frame in a window goes out as itself.
+        await self.broadcast(4)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent[-1]['message'], {'seq': 4})
+
+    @override_settings(CHAT_BATCH_WINDOW=60, CHAT_BATCH_MAX_SIZE=2)
+    async def test_full_batch_flushes_early(self):
+        await self.set_mode(True)
+        for seq in (1, 2, 3):
+            await self.broadcast(seq)
+        self.assertEqual([[frame['message']['seq'] for frame in batch['message']] for batch in self.sent], [[1, 2]])
+        self.assertIsNotNone(self.consumer.batch_flush)
+
+    @override_settings(CHAT_BATCH_WINDOW=60)
+    async def test_disabling_flushes_waiting_frames(self):
+        await self.set_mode(True)
+        await self.broadcast(1)
+        await self.broadcast(2)
+        flush = self.consumer.batch_flush
+        await self.consumer.event_batch_mode({'event': 'batch.mode', 'data': {'enabled': False}})
+        self.assertEqual([frame['message']['seq'] for frame in self.sent[0]['message']], [1, 2])
+        await asyncio.sleep(0)
+        self.assertTrue(flush.cancelled())
+
+        await self.broadcast(3)
+        self.assertEqual(self.sent[-1]['message'], {'seq': 3})
+
+
+class SendNotificationsTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.enterContext(override_settings(CHAT_FANOUT_BATCH_SIZE=2))
+        self.layer = RecordingGroupSends(fail={'user_3'})
+        self.enterContext(mock.patch('chat.fanout.get_channel_layer', return_value=self.layer))
+
+    async def test_sends_encoded_frames_in_concurrent_batches(self):
+        notice = {'type': 'send.notification', 'message': {'type': 'new message', 'message': 'hi'}}
+        with self.assertLogs('chat.fanout', 'WARNING'):
+            await send_notifications([1, 2, 3, 4, 5], notice)
+
+        self.assertEqual([group for group, _ in self.layer.sent], ['user_1', 'user_2', 'user_4', 'user_5'])
+        self.assertEqual(self.layer.peak, 2)
+        _, message = self.layer.sent[0]
+        self.assertEqual(message['type'], 'send.notification')
+        self.assertEqual(json.loads(message['text'])['message'], notice['message'])
+
+    async def test_skips_users_present_in_room(self):
+        presence = LocalPresence()
+        await presence.enter('room', 2, 'specific.a')
+        await presence.enter('other', 4, 'specific.b')
+        notice = {'type': 'send.notification', 'message': {'type': 'new message', 'message': 'hi'}}
+        with mock.patch('chat.fanout.get_presence', return_value=presence):
+            await send_notifications([1, 2, 4], notice, room='room')
+        self.assertEqual([group for group, _ in self.layer.sent], ['user_1', 'user_4'])
+
+        await presence.leave('room', 2, 'specific.a')
+        self.layer.sent.clear()
+        with mock.patch('chat.fanout.get_presence', return_value=presence):
+            await send_notifications([1, 2], notice, room='room')
+        self.assertEqual([group for group, _ in self.layer.sent], ['user_1', 'user_2'])
+
+
+class MessageNoticeTests(RoomTestCase):
+    def save_message(self):
+        with mock.patch('chat.signals.fan_out') as fan_out, CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                MessageModel.objects.create(text='hi', user=self.alice, group=self.room)
+        (recipients, _), _ = fan_out.call_args
+        return recipients, len(queries)
+
+    def test_recipients_come_from_one_query(self):
+        recipients, few = self.save_message()
+        self.assertEqual(recipients, [self.bob.pk])
+
+        users = UserModel.objects.bulk_create([UserModel(username=f'user{i}') for i in range(50)])
+        ParticipantModel.objects.bulk_create([ParticipantModel(user=user, group=self.room) for user in users])
+        recipients, many = self.save_message()
+        self.assertEqual(len(recipients), 51)
+        self.assertEqual(many, few)
+
+    def test_notice_names_the_room_for_presence(self):
+        with mock.patch('chat.signals.fan_out') as fan_out:
+            with transaction.atomic():
+                MessageModel.objects.create(text='hi', user=self.alice, group=self.room)
+        self.assertEqual(fan_out.call_args.kwargs['room'], str(self.room.pk))
+
+
+class CacheInvalidationTests(unittest.IsolatedAsyncioTestCase):
+    # Another process invalidates an entry through the chat.cache group; this one's listener evicts it.
+    def setUp(self):
+        self.enterContext(override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS))
+        room_cache.clear()
+        token_cache.clear()
+
+    async def broadcast(self, cache, key):
+        start_invalidation_listener()
+        await asyncio.sleep(0.02)
+        await get_channel_layer().group_send(
+            INVALIDATION_GROUP, {'type': 'cache.invalidate', 'cache': cache, 'key': key}
+        )
+        await asyncio.sleep(0.02)
+
+    async def test_room_entry_evicted(self):
+        room_cache.set('room', 'metadata')
+        room_cache.set('other', 'metadata')
+        await self.broadcast('rooms', 'room')
+        self.assertIsNone(room_cache.get('room'))
+        self.assertEqual(room_cache.get('other'), 'metadata')
+
+    async def test_token_entry_evicted(self):
+        token_cache.set('token', 'user')
+        await self.broadcast('tokens', 'token')
+        self.assertIsNone(token_cache.get('token'))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class TokenCacheTests(TransactionTestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = UserModel.objects.create(username='alice')
+        self.token = Token.objects.create(user=self.user)
+
+    def authenticate(self):
+        return async_to_sync(get_user_by_token)(self.token.key)
+
+    def test_lookup_is_cached(self):
+        self.assertEqual(self.authenticate(), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(), self.user)
+
+    def test_revoked_token_is_evicted(self):
+        self.authenticate()
+        self.token.delete()
+        self.assertIs(self.authenticate(), AnonymousUser)
+
+    def test_deactivated_user_is_evicted(self):
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        self.assertIs(self.authenticate(), AnonymousUser)
+
+
+def database_thread_function(cls, name):
+    # What a database_*_to_async method runs on a database thread, to call it on this one,
+    # where the test connection counts its queries.
+    return cls.__dict__[name].func.__wrapped__
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ParticipantQueryTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = UserModel.objects.create(username='alice')
+        self.user_ids = [
+            user.pk for user in UserModel.objects.bulk_create([UserModel(username=f'user{i}') for i in range(1000)])
+        ]
+
+    def insert_batches(self, count):
+        # SQLite caps the parameters of one statement, so bulk_create splits the participant rows.
+        fields = [field for field in ParticipantModel._meta.concrete_fields if not field.primary_key]
+        return math.ceil(count / connection.ops.bulk_batch_size(fields, range(count)))
+
+    def count_queries(self, call, count):
+        with CaptureQueriesContext(connection) as queries:
+            group = call(self.user_ids[:count])
+        self.assertEqual(ParticipantModel.objects.filter(group=group).exclude(user=self.alice).count(), count)
+        return len(queries)
+
+    def assertConstantQueries(self, call):
+        few, many = self.count_queries(call, 10), self.count_queries(call, 1000)
+        self.assertEqual(many - few, self.insert_batches(1000) - self.insert_batches(10))
+
+    def test_group_create(self):
+        consumer = MainConsumer()
+        consumer.scope = {'user': self.alice}
+        create_group = database_thread_function(MainConsumer, 'create_group')
+        self.assertConstantQueries(lambda user_ids: create_group(consumer, 'room', user_ids, 'group'))
+
+    def test_add_participants(self):
+        add_participants = database_thread_function(ChatRoomConsumer, 'add_participants')
+
+        def call(user_ids):
+            consumer = ChatRoomConsumer()
+            consumer.scope = {'user': self.alice}
+            consumer.group = ChatRoomModel.objects.create(name='room', type='group')
+            self.assertEqual(len(add_participants(consumer, user_ids)), len(user_ids))
+            return consumer.group
+
+        self.assertConstantQueries(call)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class WriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.user = UserModel.objects.create(username='alice')
+        self.room = ChatRoomModel.objects.create(name='room', type='group')
+        self.next_id = IdGenerator(1)
+
+    def message(self, seq, text=None):
+        return MessageModel(
+            pk=self.next_id(), seq=seq, text=text or f'm{seq}', group=self.room, user=self.user,
+            created_at=timezone.now(),
+        )
+
+    def writer(self):
+        journal = Journal(self.directory, fsync=False, segment_size=3)
+        return MessageWriter(batch_size=2, flush_interval=0.01, max_queue_size=100, journal=journal)
+
+    def test_flushes_batches_and_discards_journal(self):
+        writer = self.writer()
+        messages = [self.message(seq) for seq in range(1, 6)]
+
+        async def write():
+            for message in messages:
+                await writer.put(message)
+            self.assertEqual(len(writer.pending(self.room.pk)), 5)
+            for _ in range(200):
+                if not writer.pending(self.room.pk):
+                    break
+                await asyncio.sleep(0.01)
+            writer._task.cancel()
+
+        async_to_sync(write)()
+        writer.close()
+        self.assertEqual(list(MessageModel.objects.order_by('seq').values_list('pk', flat=True)),
+                         [message.pk for message in messages])
+        self.assertEqual(ChatRoomModel.objects.get(pk=self.room.pk).last_seq, 5)
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_replays_orphaned_journal(self):
+        flushed, conflicting, lost = self.message(1), self.message(2), self.message(3)
+        MessageModel.objects.bulk_create([flushed, self.message(2, text='stored')])
+        conflicting.pk = MessageModel.objects.get(seq=2).pk
+        # A segment left behind by a worker that died.
+        path = self.directory / '999999-1.jsonl'
+        path.write_text(''.join(_dump(message) + '\n' for message in (flushed, conflicting, lost)))
+
+        with mock.patch('chat.writebehind._process_alive', return_value=False), \
+                self.assertLogs('chat.writebehind', 'ERROR') as logs:
+            self.writer().replay_orphans()
+        self.assertEqual(len([line for line in logs.output if 'conflicts' in line]), 1)
+        self.assertEqual(
+            list(MessageModel.objects.order_by('seq').values_list('text', flat=True)), ['m1', 'stored', 'm3']
+        )
+        self.assertEqual(ChatRoomModel.objects.get(pk=self.room.pk).last_seq, 3)
+        self.assertFalse(path.exists())
+
+
+class InternalEndpointTests(unittest.TestCase):
+    def test_metrics_only_answers_internal_clients(self):
+        client = Client()
+        self.assertEqual(client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 200)
+        self.assertEqual(client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 403)
+        with override_settings(CHAT_INTERNAL_NETWORKS=['203.0.113.0/24']):
+            self.assertEqual(client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 200)
+
+    def test_health_only_answers_internal_clients(self):
+        client = Client()
+        self.assertEqual(client.get('/health', REMOTE_ADDR='::1').status_code, 200)
+        self.assertEqual(client.get('/health', REMOTE_ADDR='203.0.113.7').status_code, 403)
+
+
+class FakeProcess:
+    # Exits when told to, or on its own with ``crash``.
+    pids = iter(range(1000, 100000))
+
+    def __init__(self, command, env, **kwargs):
+        self.pid = next(self.pids)
+        self.worker_id = int(env['CHAT_WORKER_ID'])
+        self.signals = []
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, sig):
+        self.signals.append(sig)
+        if sig == signal.SIGKILL:
+            self.returncode = -sig
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class SupervisorTests(unittest.TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch('chat.supervisor.subprocess.Popen', FakeProcess))
+        self.probe = self.enterContext(mock.patch('chat.supervisor.probe', return_value={'connections': 0}))
+        self.enterContext(mock.patch('chat.supervisor.time.sleep'))
+        self.logs = self.enterContext(self.assertLogs('chat.supervisor', 'INFO'))
+
+    def supervisor(self, workers):
+        supervisor = Supervisor(
+            'core.asgi:application', '127.0.0.1', 0, workers, graceful_timeout=30,
+            health_interval=1, health_timeout=1, health_failures=3,
+        )
+        supervisor.socket = mock.Mock(**{'fileno.return_value': 3})
+        supervisor.family = 'INET'
+        supervisor.socket_dir = '/nonexistent'
+        for slot in range(workers):
+            supervisor.slots[slot] = supervisor.spawn(slot)
+        return supervisor
+
+    def live_ids(self, supervisor):
+        workers = [*supervisor.slots.values(), *supervisor.retiring]
+        ids = [worker.worker_id for worker in workers if worker.process.poll() is None]
+        self.assertEqual(len(ids), len(set(ids)))
+        return ids
+
+    def test_reload_drains_the_old_generation(self):
+        supervisor = self.supervisor(4)
+        old = list(supervisor.slots.values())
+        supervisor.reload()
+        self.assertEqual(supervisor.generation, 1)
+        self.assertEqual({worker.generation for worker in supervisor.slots.values()}, {1})
+        self.assertEqual(supervisor.retiring, old)
+        self.assertEqual([worker.process.signals for worker in old], [[signal.SIGTERM]] * 4)
+
+        # One drains in time; the rest are killed past the graceful timeout.
+        old[0].process.returncode = 0
+        for worker in old:
+            worker.kill_at = 0
+        supervisor.reap()
+        self.assertEqual([worker.process.signals for worker in old[1:]], [[signal.SIGTERM, signal.SIGKILL]] * 3)
+        supervisor.reap()
+        self.assertEqual(supervisor.retiring, [])
+
+    def test_back_to_back_reloads_wait_for_free_ids(self):
+        supervisor = self.supervisor(16)
+        supervisor.reload()
+        supervisor.reload_requested = True
+        supervisor.reload()
+        # Both generations hold all 32 ids, so the second reload waits for the drain.
+        self.assertEqual((supervisor.generation, supervisor.reload_requested), (1, True))
+        self.assertEqual(len(self.live_ids(supervisor)), 32)
+        self.assertIn('INFO:chat.supervisor:Reload waits for 16 draining workers', self.logs.output)
+
+        for worker in supervisor.retiring:
+            worker.process.returncode = 0
+        supervisor.reap()
+        supervisor.reload()
+        self.assertEqual((supervisor.generation, supervisor.reload_requested), (2, False))
+        self.assertEqual(len(self.live_ids(supervisor)), 32)
+
+    def test_failed_reload_keeps_serving_generation(self):
+        supervisor = self.supervisor(2)
+        serving = dict(supervisor.slots)
+        self.probe.side_effect = OSError('connection refused')
+        supervisor.graceful_timeout = 0
+        supervisor.reload()
+        self.assertEqual(supervisor.slots, serving)
+        self.assertEqual(supervisor.starting, {})
+        self.assertEqual([worker.process.signals for worker in supervisor.retiring], [[signal.SIGKILL]] * 2)
+
+    def test_restart_waits_for_a_free_id(self):
+        supervisor = self.supervisor(16)
+        supervisor.reload()
+        # A hung worker is replaced, but every id is taken until its SIGKILL lands.
+        supervisor.slots[0].failures = 3
+        supervisor.slots[0].started -= 60
+        supervisor.restart_hung()
+        supervisor.retiring[-1].process.returncode = None
+        supervisor.reap()
+        self.assertNotIn(0, supervisor.slots)
+        self.assertIn(0, supervisor.pending)
+
+        supervisor.retiring[-1].process.returncode = -9
+        supervisor.reap()
+        supervisor.reap()
+        self.assertIn(0, supervisor.slots)
+        self.live_ids(supervisor)
+
+    def test_crashing_worker_backs_off(self):
+        supervisor = self.supervisor(1)
+        delays = []
+        for _ in range(6):
+            supervisor.slots[0].process.returncode = 1
+            supervisor.reap()
+            delays.append(round(supervisor.pending[0] - time.monotonic()))
+            supervisor.pending[0] = 0
+            supervisor.reap()
+        self.assertEqual(delays, [1, 3, 7, 15, 30, 30])
+
+        # A worker that ran for a while starts over.
+        supervisor.slots[0].started -= 60
+        supervisor.slots[0].process.returncode = 1
+        supervisor.reap()
+        self.assertIn(0, supervisor.slots)
+
+    def test_health_port_only_answers_internal_clients(self):
+        supervisor = self.supervisor(1)
+        supervisor.health_port = 0
+        server = supervisor.serve_health()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        def status():
+            connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+            try:
+                connection.request('GET', '/')
+                return connection.getresponse().status
+            finally:
+                connection.close()
+
+        self.assertEqual(status(), 503)
+        with override_settings(CHAT_INTERNAL_NETWORKS=['203.0.113.0/24']):
+            self.assertEqual(status(), 403)
+
+
+class SyncSinceTests(RoomTestCase):
+    def sync(self, since):
+        result = async_to_sync(self.consumer(self.alice).get_messages_since)(since)
+        if result['reload']:
+            return result
+        return result['last_seq'], result['pending'], [msg['seq'] for msg in result['messages']]
+
+    def test_sends_the_gap(self):
+        self.assertEqual(self.sync(4), (7, False, [5, 6, 7]))
+        self.assertEqual(self.sync(7), (7, False, []))
+
+    def test_asks_for_reload(self):
+        # Ahead of the room, e.g. after the room was recreated.
+        self.assertEqual(self.sync(8), {'reload': True, 'last_seq': 7})
+        with override_settings(CHAT_SYNC_MAX_GAP=3):
+            self.assertEqual(self.sync(3), {'reload': True, 'last_seq': 7})
+            self.assertEqual(self.sync(4), (7, False, [5, 6, 7]))
+
+    def test_stops_at_a_message_still_being_written(self):
+        # seq 5 went to another worker's write-behind queue; seq 6 and 7 are already stored.
+        MessageModel.objects.filter(seq=5).delete()
+        MessageModel.objects.filter(seq__gt=5).update(created_at=timezone.now())
+        self.assertEqual(self.sync(3), (4, True, [4]))
+
+    def test_skips_a_lost_message(self):
+        MessageModel.objects.filter(seq=5).delete()
+        self.assertEqual(self.sync(3), (7, False, [4, 6, 7]))
+
+
+class FakeCounters:
+    # The two RedisSequence scripts, run on a dict.
+    def __init__(self):
+        self.values = {}
+
+    async def eval(self, script, numkeys, key, *args):
+        if script == RedisSequence.INCREMENT:
+            if key not in self.values:
+                return 0
+        else:
+            self.values[key] = max(self.values.get(key, 0), int(args[0]))
+        self.values[key] += 1
+        return self.values[key]
+
+
+class RedisSequenceTests(TransactionTestCase):
+    def setUp(self):
+        self.room = ChatRoomModel.objects.create(name='room', type='group', last_seq=5)
+        self.redis = FakeCounters()
+        layer = mock.Mock(prefix='asgi', consistent_hash=lambda key: 0, connection=lambda index: self.redis)
+        self.sequence = RedisSequence(layer)
+
+    def next(self):
+        return async_to_sync(self.sequence.next)(self.room.pk)
+
+    def test_counter_is_seeded_from_the_database(self):
+        self.assertEqual(self.next(), 6)
+        ChatRoomModel.objects.filter(pk=self.room.pk).update(last_seq=20)
+        self.assertEqual(self.next(), 7)
+
+    def test_missing_counter_is_seeded_again(self):
+        self.next()
+        # Flushes by other workers moved last_seq on, then the key was evicted.
+        ChatRoomModel.objects.filter(pk=self.room.pk).update(last_seq=20)
+        self.redis.values.clear()
+        self.assertEqual(self.next(), 21)
+
+
+class GroupListTests(RoomTestCase):
+    def test_unread_count_and_preview(self):
+        ParticipantModel.objects.filter(user=self.bob).update(last_read_id=self.messages[3].pk)
+        (group,) = async_to_sync(MainConsumer().group_list)(self.bob, 10)['groups']
+        self.assertEqual(group['unread'], 1)
+        self.assertEqual(group['last_message']['text'], 'm6')
+        self.assertEqual(group['last_message']['sender'], 'bob')
+
+    def test_next_cursor(self):
+        for name in ('two', 'three'):
+            room = ChatRoomModel.objects.create(name=name, type='group')
+            ParticipantModel.objects.create(user=self.alice, group=room, is_creator=True)
+
+        consumer, names = MainConsumer(), []
+        result = {'next': None}
+        while True:
+            result = async_to_sync(consumer.group_list)(self.alice, 2, after=result['next'])
+            names.append([group['group_name'] for group in result['groups']])
+            if result['next'] is None:
+                break
+        self.assertEqual(names, [['room', 'two'], ['three']])
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                async_to_sync(MainConsumer().group_list)(self.alice, 50)
+            return len(queries)
+
+        few = count_queries()
+        for i in range(10):
+            room = ChatRoomModel.objects.create(name=f'room{i}', type='group')
+            ParticipantModel.objects.create(user=self.alice, group=room)
+            MessageModel.objects.create(text='hi', user=self.bob, group=room)
+        self.assertEqual(count_queries(), few)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class UserDirectoryTests(TransactionTestCase):
+    def setUp(self):
+        directory_cache.clear()
+        self.users = [UserModel.objects.create(username=name) for name in ('alice', 'bob', 'carol', 'dave', 'erin')]
+
+    def page(self, user, **kwargs):
+        consumer = MainConsumer()
+        consumer.scope = {'user': user}
+        page = async_to_sync(consumer.user_list)(**kwargs)
+        return [user['username'] for user in page['users']], page['next']
+
+    def test_next_cursor_skips_caller(self):
+        self.assertEqual(self.page(self.users[0], prefix='', limit=2), (['bob', 'carol'], 'carol'))
+        self.assertEqual(self.page(self.users[0], prefix='', limit=2, after='carol'), (['dave', 'erin'], None))
+
+    def test_cached_page_is_filtered_per_caller(self):
+        self.assertEqual(self.page(self.users[0], prefix='', limit=2), (['bob', 'carol'], 'carol'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.page(self.users[1], prefix='', limit=2), (['alice', 'carol'], 'carol'))
+
+    def test_prefix(self):
+        UserModel.objects.create(username='carl')
+        self.assertEqual(self.page(self.users[0], prefix='car', limit=5), (['carl', 'carol'], None))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class SearchIndexTests(RoomTestCase):
+    def setUp(self):
+        super().setUp()
+        if not fts_installed():
+            self.skipTest('SQLite without FTS5')
+
+    def found(self, query):
+        return [msg['text'] for msg in async_to_sync(self.consumer(self.alice).search_messages)(query, 10, 0)]
+
+    def test_index_follows_writes(self):
+        other = ChatRoomModel.objects.create(name='other', type='group')
+        MessageModel.objects.create(text='apple pie', user=self.alice, group=other)
+
+        message = MessageModel.objects.create(text='apple pie', user=self.alice, group=self.room)
+        self.assertEqual(self.found('apple'), ['apple pie'])
+
+        message.text = 'cherry pie'
+        message.save()
+        self.assertEqual(self.found('apple'), [])
+        self.assertEqual(self.found('cherry pie'), ['cherry pie'])
+
+        MessageModel.objects.filter(pk=message.pk).update(text='plum tart')
+        self.assertEqual(self.found('pie'), [])
+        self.assertEqual(self.found('tart'), ['plum tart'])
+
+        message.delete()
+        self.assertEqual(self.found('tart'), [])
+
+    def test_migrated_index_matches_chat_search(self):
+        # The migrations carry their own copy of the SQL, so check they end where chat.search starts.
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT name FROM pragma_table_info('{SEARCH_TABLE}')")
+            self.assertEqual([row[0] for row in cursor.fetchall()], ['text', 'group_id'])
+
+    def test_terms_are_not_query_syntax(self):
+        MessageModel.objects.create(text='"quoted" OR NEAR(x)', user=self.alice, group=self.room)
+        self.assertEqual(self.found('"quoted" OR'), ['"quoted" OR NEAR(x)'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class GroupDeletionTests(RoomTestCase):
+    def test_deletes_in_bounded_batches(self):
+        steps = []
+        while True:
+            model, count = delete_batch(self.room.pk, 3)
+            steps.append((model, count))
+            if model is None:
+                break
+        self.assertEqual(steps, [
+            (MessageModel, 3), (MessageModel, 3), (MessageModel, 1),
+            (ParticipantModel, 2), (ChatRoomModel, 1), (None, 0),
+        ])
+        self.assertFalse(ChatRoomModel.objects.exists())
+
+    @override_settings(CHAT_DELETE_BATCH_SIZE=3, CHAT_DELETE_PROGRESS_INTERVAL=0)
+    def test_reports_progress_to_creator(self):
+        with mock.patch('chat.deletion.send_notifications') as send:
+            async_to_sync(delete_group)(self.room.pk, 'room', self.alice.pk)
+        notices = [call.args for call in send.call_args_list]
+        self.assertEqual({user_ids[0] for user_ids, _ in notices}, {self.alice.pk})
+        progress = [(n['message']['deleted_messages'], n['message']['done']) for _, n in notices]
+        self.assertEqual(progress, [(3, False), (6, False), (7, False), (7, False), (7, True)])
+        self.assertFalse(MessageModel.objects.exists())
+
+    def test_members_are_told_before_deletion_starts(self):
+        events = []
+        consumer = MainConsumer()
+        consumer.scope = {'user': self.alice}
+        consumer.channel_layer = mock.Mock()
+        consumer.channel_layer.group_send = mock.AsyncMock(side_effect=lambda group, msg: events.append(msg['type']))
+
+        def spawn(coroutine):
+            coroutine.close()
+            events.append('delete_group')
+
+        async def send(message):
+            events.append('reply')
+
+        consumer.base_send = send
+        with mock.patch('chat.consumers.base.spawn', spawn), mock.patch('chat.consumers.base.invalidate'):
+            async_to_sync(consumer.event_group_delete)({'event': 'group.delete', 'data': {'group': 'room'}})
+        self.assertEqual(events, ['room.deleted', 'delete_group', 'reply'])
+        # Hidden from everyone right away, while the rows go in the background.
+        self.assertIsNotNone(ChatRoomModel.objects.get().deleted_at)
+        self.assertEqual(MessageModel.objects.count(), self.message_count)
+
+
+class ReplicaRoutingTests(unittest.TestCase):
+    # Two SQLite files stand in for the primary and its replica. They are migrated separately
+    # and never replicate, so every row tells which database a query went to.
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = Path(tempfile.mkdtemp())
+        for alias in ('test_primary', 'test_replica'):
+            database = copy.deepcopy(connections.settings['default'])
+            database['NAME'] = str(cls.directory / f'{alias}.sqlite3')
+            database['TEST'] = {**database['TEST'], 'NAME': database['NAME']}
+            connections.settings[alias] = database
+            call_command('migrate', database=alias, verbosity=0)
+        cls.enterClassContext(override_settings(
+            CHAT_DATABASE_PRIMARY='test_primary',
+            CHAT_DATABASE_REPLICAS=['test_replica'],
+        ))
+
+    @classmethod
+    def tearDownClass(cls):
+        for alias in ('test_primary', 'test_replica'):
+            connections[alias].close()
+            del connections.settings[alias]
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        pinned_users.clear()
+        shared_pins.clear()
+        directory_cache.clear()
+        self.user = UserModel.objects.using('test_primary').create(username='alice')
+        UserModel.objects.using('test_replica').create(pk=self.user.pk, username='alice')
+        UserModel.objects.using('test_replica').create(username='replica_only')
+
+    def tearDown(self):
+        for alias in ('test_primary', 'test_replica'):
+            UserModel.objects.using(alias).all().delete()
+            ChatRoomModel.objects.using(alias).all().delete()
+
+    def usernames(self):
+        return set(UserModel.objects.values_list('username', flat=True))
+
+    def test_reads_go_to_primary_by_default(self):
+        self.assertEqual(self.usernames(), {'alice'})
+
+    def test_replica_reads_go_to_replica(self):
+        with replica_reads():
+            self.assertEqual(self.usernames(), {'alice', 'replica_only'})
+
+    def test_writes_go_to_primary(self):
+        with replica_reads():
+            ChatRoomModel.objects.create(name='room', type='group')
+        self.assertTrue(ChatRoomModel.objects.using('test_primary').filter(name='room').exists())
+        self.assertFalse(ChatRoomModel.objects.using('test_replica').filter(name='room').exists())
+
+    def test_writer_reads_from_primary_after_write(self):
+        with database_user(self.user.pk):
+            ChatRoomModel.objects.create(name='room', type='group')
+            with replica_reads():
+                self.assertEqual(self.usernames(), {'alice'})
+
+        with database_user(self.user.pk + 1), replica_reads():
+            self.assertEqual(self.usernames(), {'alice', 'replica_only'})
+
+    def test_pin_expires(self):
+        with override_settings(CHAT_REPLICA_PIN_SECONDS=0.05), database_user(self.user.pk):
+            ChatRoomModel.objects.create(name='room', type='group')
+            time.sleep(0.1)
+            with replica_reads():
+                self.assertEqual(self.usernames(), {'alice', 'replica_only'})
+
+    def test_pin_is_shared_with_other_workers(self):
+        layer = mock.AsyncMock()
+        with mock.patch('chat.dbrouters.get_channel_layer', return_value=layer), database_user(self.user.pk):
+            for name in ('room', 'other'):
+                pinned_until = pinned_users.get(self.user.pk)
+                ChatRoomModel.objects.create(name=name, type='group')
+                async_to_sync(share_pin)(self.user.pk, pinned_until)
+        # Once per half pin period is enough.
+        (event,) = [call.args[1] for call in layer.group_send.await_args_list]
+
+        # Another worker, which never saw the write, receives the broadcast.
+        pinned_users.clear()
+        handlers[event['type']](event)
+        with database_user(self.user.pk), replica_reads():
+            self.assertEqual(self.usernames(), {'alice'})
+
+    def test_user_list_reads_from_replica(self):
+        consumer = MainConsumer()
+        consumer.scope = {'user': self.user}
+        result = async_to_sync(consumer.user_list)(prefix='', limit=10)
+        self.assertEqual([user['username'] for user in result['users']], ['replica_only'])
+
+
+class RecordingLayer(InMemoryChannelLayer):
+    # Stands in for Redis, shared by the nodes of a test, and records the group messages it carries.
+    def __init__(self):
+        super().__init__()
+        self.group_messages = []
+
+    async def group_send(self, group, message):
+        if message['type'] == 'hybrid.group':
+            self.group_messages.append(message['message'])
+        await super().group_send(group, message)
+
+
+class HybridChannelLayerTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.remote = RecordingLayer()
+
+    def node(self):
+        return HybridChannelLayer(self.remote, discovery_timeout=0)
+
+    async def settle(self):
+        for _ in range(20):
+            await asyncio.sleep(0)
+
+    async def receive_nothing(self, layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.05)
+
+    async def test_single_node_group_stays_local(self):
+        layer = self.node()
+        first, second = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add('room', first)
+        await layer.group_add('room', second)
+        await self.settle()
+
+        await layer.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(await layer.receive(first), {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(await layer.receive(second), {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(self.remote.group_messages, [])
+
+    async def test_members_on_other_nodes_receive_once(self):
+        a, b = self.node(), self.node()
+        local, other = await a.new_channel(), await b.new_channel()
+        await a.group_add('room', local)
+        await b.group_add('room', other)
+        await self.settle()
+
+        await a.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(await a.receive(local), {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(await b.receive(other), {'type': 'chat.message', 'text': 'hi'})
+        await self.receive_nothing(a, local)
+        await self.receive_nothing(b, other)
+        self.assertEqual(len(self.remote.group_messages), 1)
+
+    async def test_stops_forwarding_when_other_node_leaves(self):
+        a, b = self.node(), self.node()
+        local, other = await a.new_channel(), await b.new_channel()
+        await a.group_add('room', local)
+        await b.group_add('room', other)
+        await self.settle()
+        await b.group_discard('room', other)
+        await self.settle()
+
+        await a.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(await a.receive(local), {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(self.remote.group_messages, [])
+
+    async def test_node_without_members_sends_remote(self):
+        a, b = self.node(), self.node()
+        await a.new_channel()
+        other = await b.new_channel()
+        await b.group_add('room', other)
+        await self.settle()
+
+        await a.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(await b.receive(other), {'type': 'chat.message', 'text': 'hi'})
+
+    async def test_direct_send_across_nodes(self):
+        a, b = self.node(), self.node()
+        await a.new_channel()
+        other = await b.new_channel()
+
+        await a.send(other, {'type': 'send.notification', 'text': 'hi'})
+        self.assertEqual(await b.receive(other), {'type': 'send.notification', 'text': 'hi'})
+
+    async def test_cancelled_receive_leaves_groups(self):
+        layer = self.node()
+        channel = await layer.new_channel()
+        await layer.group_add('room', channel)
+        receive = asyncio.ensure_future(layer.receive(channel))
+        await self.settle()
+        receive.cancel()
+        await self.settle()
+
+        self.assertNotIn(channel, layer.channels)
+        self.assertNotIn('room', layer.groups)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+
+    def zremrangebyscore(self, key, min, max):
+        pass
+
+    async def execute(self):
+        self.redis._check()
+
+
+class FakeRedis:
+    # An in-process shard: enough of a Redis client for RedisChannelLayer's send, receive and
+    # group operations. Scripts are told apart by their keys, not run.
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def _check(self):
+        if self.down:
+            raise RedisConnectionError('Shard is down')
+
+    def _pop(self, key):
+        members = self.data.get(key)
+        if not members:
+            return None
+        member = min(members, key=members.get)
+        return key, member, members.pop(member)
+
+    async def zadd(self, key, mapping):
+        self._check()
+        self.data.setdefault(key, {}).update(mapping)
+
+    async def zrange(self, key, start, end):
+        self._check()
+        members = sorted(self.data.get(key, {}).items(), key=lambda item: item[1])
+        return [member.encode() if isinstance(member, str) else member for member, _ in members]
+
+    async def zpopmin(self, key):
+        self._check()
+        self._pop(key)
+
+    async def bzpopmin(self, key, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            self._check()
+            popped = self._pop(key)
+            if popped is not None or time.monotonic() >= deadline:
+                return popped
+            await asyncio.sleep(0.005)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        self._check()
+        keys, args = keys_and_args[:numkeys], keys_and_args[numkeys:]
+        if not keys and len(args) == 2:
+            # The receive cleanup: put messages left in the backup queue back on the channel.
+            channel, backup = args
+            self.data.setdefault(channel, {}).update(self.data.pop(backup, {}))
+            return None
+        # group_send: one message per channel key, then the capacities, time and expiry.
+        now = args[-2]
+        for key, message in zip(keys, args):
+            self.data.setdefault(key, {})[message] = now
+        return 0
+
+    async def zrem(self, key, *members):
+        self._check()
+        for member in members:
+            self.data.get(key, {}).pop(member, None)
+
+    async def zcount(self, key, min, max):
+        self._check()
+        return len(self.data.get(key, {}))
+
+    async def zremrangebyscore(self, key, min, max):
+        self._check()
+
+    async def expire(self, key, seconds):
+        self._check()
+
+
+def shard_hosts(count):
+    return [('10.0.0.%d' % i, 6379) for i in range(1, count + 1)]
+
+
+def group_names():
+    rooms = [str(uuid.uuid5(uuid.NAMESPACE_URL, f'room/{i}')) for i in range(3000)]
+    return rooms + [f'user_{i}' for i in range(1000)]
+
+
+class HybridOverRedisTests(unittest.IsolatedAsyncioTestCase):
+    # Two nodes over RedisChannelLayer instances that share one fake shard, the way separate
+    # worker processes share a Redis server.
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(RedisChannelLayer, 'connection', lambda layer, index: self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def node(self):
+        return HybridChannelLayer(RedisChannelLayer(hosts=shard_hosts(1)), discovery_timeout=0)
+
+    async def settle(self):
+        await asyncio.sleep(0.05)
+
+    async def test_node_channel_is_read_while_a_consumer_receives(self):
+        a, b = self.node(), self.node()
+        await a.new_channel()
+        other = await b.new_channel()
+        # The consumer's receive takes channels_redis' receive lock before the node exists.
+        receive = asyncio.ensure_future(b.receive(other))
+        await self.settle()
+        await b.group_add('room', other)
+        await self.settle()
+
+        await a.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(await asyncio.wait_for(receive, 1), {'type': 'chat.message', 'text': 'hi'})
+
+    async def test_members_on_both_nodes_receive(self):
+        a, b = self.node(), self.node()
+        local, other = await a.new_channel(), await b.new_channel()
+        receives = [asyncio.ensure_future(a.receive(local)), asyncio.ensure_future(b.receive(other))]
+        await self.settle()
+        await a.group_add('room', local)
+        await b.group_add('room', other)
+        await self.settle()
+
+        await b.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+        received = await asyncio.wait_for(asyncio.gather(*receives), 1)
+        self.assertEqual(received, [{'type': 'chat.message', 'text': 'hi'}] * 2)
+
+
+class ShardedRedisChannelLayerTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.shards = [FakeRedis() for _ in range(3)]
+        patcher = mock.patch.object(RedisChannelLayer, 'connection', lambda layer, index: self.shards[index])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_groups_spread_over_shards(self):
+        layer = ShardedRedisChannelLayer(hosts=shard_hosts(4))
+        names = group_names()
+        counts = [0] * 4
+        for name in names:
+            counts[layer.consistent_hash(name)] += 1
+        for count in counts:
+            self.assertAlmostEqual(count / len(names), 0.25, delta=0.05)
+
+    def test_adding_a_shard_only_moves_groups_to_it(self):
+        before = ShardedRedisChannelLayer(hosts=shard_hosts(4))
+        after = ShardedRedisChannelLayer(hosts=shard_hosts(5))
+        names = group_names()
+        moved = [name for name in names if before.consistent_hash(name) != after.consistent_hash(name)]
+        self.assertEqual({after.consistent_hash(name) for name in moved}, {4})
+        self.assertLess(len(moved) / len(names), 0.25)
+
+    def test_placement_follows_addresses_not_order(self):
+        layer = ShardedRedisChannelLayer(hosts=shard_hosts(4))
+        reordered = ShardedRedisChannelLayer(hosts=shard_hosts(4)[::-1])
+        for name in group_names()[:500]:
+            self.assertEqual(
+                layer.hosts[layer.consistent_hash(name)], reordered.hosts[reordered.consistent_hash(name)]
+            )
+
+    async def test_group_add_fails_over_to_next_shard(self):
+        layer = ShardedRedisChannelLayer(hosts=shard_hosts(3))
+        owner, fallback, _ = layer.ring.walk('room')
+        self.shards[owner].down = True
+
+        with self.assertLogs('chat.layers', 'WARNING'):
+            await layer.group_add('room', 'specific.a!b')
+        self.assertEqual(layer.down_shards(), {owner})
+        self.assertIn('specific.a!b', self.shards[fallback].data[layer._group_key('room')])
+
+        await layer.group_add('room', 'specific.a!c')
+        self.assertEqual(len(self.shards[fallback].data[layer._group_key('room')]), 2)
+
+    async def test_shard_rejoins_after_failover_timeout(self):
+        layer = ShardedRedisChannelLayer(hosts=shard_hosts(3), failover_timeout=0.05)
+        owner = layer.ring.lookup('room')
+        self.shards[owner].down = True
+        with self.assertLogs('chat.layers', 'WARNING'):
+            await layer.group_add('room', 'specific.a!b')
+        self.assertNotEqual(layer.consistent_hash('room'), owner)
+
+        self.shards[owner].down = False
+        await asyncio.sleep(0.1)
+        self.assertEqual(layer.consistent_hash('room'), owner)
+        await layer.group_add('room', 'specific.a!b')
+        self.assertIn(layer._group_key('room'), self.shards[owner].data)
+
+    async def test_send_to_down_shard_raises(self):
+        layer = ShardedRedisChannelLayer(hosts=shard_hosts(3))
+        channel = await layer.new_channel()
+        owner = layer.consistent_hash(channel)
+        self.shards[owner].down = True
+
+        with self.assertLogs('chat.layers', 'WARNING'), self.assertRaises(RedisConnectionError):
+            await layer.send(channel, {'type': 'chat.message'})
+        self.assertEqual(layer.consistent_hash(channel), owner)
+        self.assertFalse(any(shard.data for shard in self.shards))
+
+    async def test_process_channels_stay_put_when_another_process_failed_over(self):
+        sender = ShardedRedisChannelLayer(hosts=shard_hosts(3))
+        receiver = ShardedRedisChannelLayer(hosts=shard_hosts(3))
+        channel = await receiver.new_channel()
+        owner = receiver.consistent_hash(receiver.non_local_name(channel))
+        # Only the sender saw the owner fail; the receiver keeps reading from it.
+        with self.assertLogs('chat.layers', 'WARNING'):
+            sender.mark_down(owner)
+
+        await sender.send(channel, {'type': 'chat.message', 'text': 'hi'})
+        self.assertIn(sender.prefix + sender.non_local_name(channel), self.shards[owner].data)
+        message = await asyncio.wait_for(receiver.receive(channel), 1)
+        self.assertEqual(message, {'type': 'chat.message', 'text': 'hi'})
+
+    async def test_all_shards_down_raises(self):
+        layer = ShardedRedisChannelLayer(hosts=shard_hosts(3))
+        for shard in self.shards:
+            shard.down = True
+        with self.assertLogs('chat.layers', 'WARNING'), self.assertRaises(RedisConnectionError):
+            await layer.group_add('room', 'specific.a!b')
+
+
+class RateLimiterTests(unittest.TestCase):
+    def setUp(self):
+        user_buckets.clear()
+
+    def test_connection_bucket_allows_burst_then_limits(self):
+        limiter = RateLimiter(1, {'*': {'CONNECTION': (1, 2)}})
+        self.assertIsNone(limiter.check('send.message'))
+        self.assertIsNone(limiter.check('send.message'))
+        scope, retry_after = limiter.check('send.message')
+        self.assertEqual(scope, 'connection')
+        self.assertAlmostEqual(retry_after, 1, delta=0.05)
+        # Buckets are per event.
+        self.assertIsNone(limiter.check('list.message'))
+
+    def test_bucket_refills_at_rate(self):
+        limiter = RateLimiter(1, {'*': {'CONNECTION': (100, 1)}})
+        self.assertIsNone(limiter.check('send.message'))
+        self.assertIsNotNone(limiter.check('send.message'))
+        time.sleep(0.02)
+        self.assertIsNone(limiter.check('send.message'))
+
+    def test_user_bucket_is_shared_by_connections(self):
+        limits = {'*': {'USER': (1, 1)}}
+        self.assertIsNone(RateLimiter(1, limits).check('send.message'))
+        self.assertEqual(RateLimiter(1, limits).check('send.message')[0], 'user')
+        self.assertIsNone(RateLimiter(2, limits).check('send.message'))
+
+    def test_limited_event_takes_no_tokens(self):
+        limiter = RateLimiter(1, {'*': {'CONNECTION': (1, 5), 'USER': (1, 1)}})
+        limiter.check('send.message')
+        self.assertEqual(limiter.check('send.message')[0], 'user')
+        self.assertAlmostEqual(limiter._buckets['send.message'].tokens, 4, delta=0.05)
+
+    def test_missing_limit_is_not_enforced(self):
+        limiter = RateLimiter(1, {'*': None})
+        for _ in range(100):
+            self.assertIsNone(limiter.check('send.message'))
+
+
+class TransportMiddlewareTests(unittest.IsolatedAsyncioTestCase):
+    async def scope_for(self, send):
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+
+        await TransportMiddleware(inner)({'type': 'websocket'}, None, send)
+        return scopes[0]
+
+    async def test_passes_daphne_transport(self):
+        ours, peer = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(peer.close)
+        transport = tcp.Server(ours, Protocol(), ('127.0.0.1', 0), None, 0, MemoryReactor())
+        protocol = mock.Mock(transport=transport)
+        scope = await self.scope_for(functools.partial(mock.AsyncMock(), protocol))
+        self.assertIs(scope['transport'], transport)
+
+    async def test_leaves_other_servers_alone(self):
+        self.assertNotIn('transport', await self.scope_for(mock.AsyncMock()))
+        protocol = mock.Mock(transport=object())
+        self.assertNotIn('transport', await self.scope_for(functools.partial(mock.AsyncMock(), protocol)))
+
+
+class FakeTransport:
+    def __init__(self):
+        self.buffered = 0
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+
+class OutboxTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.sent = []
+
+    async def record(self, message):
+        self.sent.append(message)
+
+    def outbox(self, policy='disconnect'):
+        return Outbox(
+            self.record, self.transport, maxsize=2, policy=policy,
+            consumer='test', high_water=100, poll_interval=0.01,
+        )
+
+    def frame(self, text):
+        return {'type': 'websocket.send', 'text': text}
+
+    async def test_sends_straight_through_while_transport_keeps_up(self):
+        outbox = self.outbox()
+        await outbox.send(self.frame('a'))
+        self.assertEqual(self.sent, [self.frame('a')])
+        self.assertIsNone(outbox._task)
+
+    async def test_queues_until_transport_drains(self):
+        outbox = self.outbox()
+        self.transport.buffered = 1000
+        await outbox.send(self.frame('a'))
+        await outbox.send(self.frame('b'))
+        await asyncio.sleep(0.03)
+        self.assertEqual(self.sent, [])
+
+        self.transport.buffered = 0
+        await asyncio.sleep(0.03)
+        self.assertEqual(self.sent, [self.frame('a'), self.frame('b')])
+        await outbox.send(self.frame('c'))
+        self.assertEqual(self.sent[-1], self.frame('c'))
+
+    async def test_disconnects_slow_reader(self):
+        outbox = self.outbox()
+        self.transport.buffered = 1000
+        for text in 'abc':
+            await outbox.send(self.frame(text))
+        self.assertEqual(self.sent, [{'type': 'websocket.close', 'code': OVERFLOW_CLOSE_CODE}])
+
+        self.transport.buffered = 0
+        await outbox.send(self.frame('d'))
+        await asyncio.sleep(0.03)
+        self.assertEqual(len(self.sent), 1)
+
+    async def test_drop_oldest_keeps_newest_frames(self):
+        outbox = self.outbox('drop_oldest')
+        self.transport.buffered = 1000
+        for text in 'abc':
+            await outbox.send(self.frame(text))
+        self.transport.buffered = 0
+        await asyncio.sleep(0.03)
+        self.assertEqual(self.sent, [self.frame('b'), self.frame('c')])
+
+
+class TwistedOutboxTests(unittest.IsolatedAsyncioTestCase):
+    # A real TCP transport over a socket pair. The memory reactor never polls, so the test
+    # calls doWrite itself whenever the reactor would find the socket writable.
+    def setUp(self):
+        ours, self.peer = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(self.peer.close)
+        ours.setblocking(False)
+        self.peer.setblocking(False)
+        self.transport = tcp.Server(ours, Protocol(), ('127.0.0.1', 0), None, 0, MemoryReactor())
+        self.sent = []
+        self.outbox = Outbox(
+            self.write, self.transport, maxsize=2, policy='disconnect',
+            consumer='test', high_water=1024,
+        )
+
+    async def write(self, message):
+        self.sent.append(message)
+        if message['type'] == 'websocket.send':
+            self.transport.write(message['bytes'])
+
+    def frame(self, size):
+        return {'type': 'websocket.send', 'bytes': b'x' * size}
+
+    def read_peer(self):
+        received = 0
+        while True:
+            try:
+                chunk = self.peer.recv(65536)
+            except BlockingIOError:
+                return received
+            received += len(chunk)
+
+    async def test_queues_while_transport_is_paused(self):
+        self.assertIs(self.transport.producer, self.outbox)
+        await self.outbox.send(self.frame(10))
+        self.assertFalse(self.outbox.backlogged())
+
+        big = 4 * 1024 * 1024
+        await self.outbox.send(self.frame(big))
+        self.assertTrue(self.outbox.backlogged())
+        await self.outbox.send(self.frame(10))
+        self.assertEqual(len(self.sent), 2)
+
+        # The socket takes part of it; the rest stays buffered until the peer reads.
+        self.transport.doWrite()
+        self.assertTrue(self.outbox.backlogged())
+        received = 0
+        while self.transport.producerPaused:
+            received += self.read_peer()
+            self.transport.doWrite()
+        self.assertFalse(self.outbox.backlogged())
+        await asyncio.sleep(0)
+        self.assertEqual(len(self.sent), 3)
+        self.transport.doWrite()
+        self.assertEqual(received + self.read_peer(), 10 + big + 10)
+
+    async def test_disconnects_slow_reader(self):
+        for _ in range(4):
+            await self.outbox.send(self.frame(2048))
+        self.assertEqual(self.sent[-1], {'type': 'websocket.close', 'code': OVERFLOW_CLOSE_CODE})
+        self.assertIsNone(self.transport.producer)
+
+    async def test_connection_lost_closes_outbox(self):
+        await self.outbox.send(self.frame(2048))
+        await self.outbox.send(self.frame(10))
+        task = self.outbox._task
+        self.transport.connectionLost(Failure(ConnectionDone()))
+        self.assertTrue(self.outbox.closing)
+        await asyncio.sleep(0)
+        self.assertTrue(task.cancelled())
+        self.assertEqual(len(self.sent), 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ArchiveTests(TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.enterContext(override_settings(
+            CHAT_ARCHIVE_DIR=directory, CHAT_ARCHIVE_BLOCK_SIZE=3, CHAT_ARCHIVE_SEGMENT_SIZE=256
+        ))
+        self.alice = UserModel.objects.create(username='alice')
+        self.bob = UserModel.objects.create(username='bob')
+        self.room = ChatRoomModel.objects.create(name='room', type='group')
+        ParticipantModel.objects.create(user=self.alice, group=self.room, is_creator=True)
+        ParticipantModel.objects.create(user=self.bob, group=self.room)
+        start = timezone.now() - timedelta(days=30)
+        # Messages share timestamps in pairs, so every cursor has to break ties on the id.
+        self.messages = [
+            MessageModel.objects.create(
+                text=f'm{i}', user=[self.bob, self.alice][i % 2], group=self.room,
+                created_at=start + timedelta(minutes=i // 2),
+            )
+            for i in range(10)
+        ]
+        # m0-m5 are older than the cutoff.
+        self.cutoff = self.messages[6].created_at
+
+    def archive(self, cutoff):
+        return archive_room(self.room, cutoff, batch_size=4)
+
+    def consumer(self, user):
+        consumer = ChatRoomConsumer()
+        consumer.scope = {'user': user}
+        consumer.group = self.room
+        consumer.group_id = str(self.room.pk)
+        return consumer
+
+    def test_moves_messages_past_cutoff(self):
+        self.assertEqual(self.archive(self.cutoff), 6)
+        self.assertEqual(
+            list(MessageModel.objects.order_by('pk').values_list('text', flat=True)), ['m6', 'm7', 'm8', 'm9']
+        )
+        self.assertEqual(get_archive(self.room.pk).last_seq(), 6)
+        self.assertEqual(self.archive(self.cutoff), 0)
+
+    @override_settings(CHAT_RETENTION_DAYS={'dialog': None, 'group': 7})
+    def test_command_archives_every_room_past_retention(self):
+        other = ChatRoomModel.objects.create(name='other', type='group')
+        MessageModel.objects.create(
+            text='old', user=self.alice, group=other, created_at=timezone.now() - timedelta(days=8)
+        )
+        recent = ChatRoomModel.objects.create(name='recent', type='group')
+        MessageModel.objects.create(text='new', user=self.alice, group=recent)
+        deleted = ChatRoomModel.objects.create(name='deleted', type='group', deleted_at=timezone.now())
+        MessageModel.objects.create(
+            text='old', user=self.alice, group=deleted, created_at=timezone.now() - timedelta(days=8)
+        )
+
+        call_command('archive_messages', batch_size=4, stdout=StringIO())
+        self.assertEqual(
+            sorted(MessageModel.objects.values_list('group__name', flat=True).distinct()), ['deleted', 'recent']
+        )
+        self.assertEqual(get_archive(self.room.pk).last_seq(), 10)
+        self.assertEqual(get_archive(other.pk).last_seq(), 1)
+
+    def test_read_before_and_after_page_through_archive(self):
+        self.archive(self.cutoff)
+        archive = get_archive(self.room.pk)
+
+        pages, cursor = [], (self.messages[6].created_at, self.messages[6].pk)
+        while page := archive.read_before(self.room.pk, 2, cursor):
+            pages.append([msg.text for msg in page])
+            cursor = (page[-1].created_at, page[-1].pk)
+        self.assertEqual(pages, [['m5', 'm4'], ['m3', 'm2'], ['m1', 'm0']])
+
+        pages, cursor = [], (self.messages[0].created_at, 0)
+        while page := archive.read_after(self.room.pk, 4, cursor):
+            pages.append([msg.text for msg in page])
+            cursor = (page[-1].created_at, page[-1].pk)
+        self.assertEqual(pages, [['m0', 'm1', 'm2', 'm3'], ['m4', 'm5']])
+
+    def test_list_message_pages_from_table_into_archive(self):
+        self.archive(self.cutoff)
+        consumer = self.consumer(self.alice)
+
+        page = async_to_sync(consumer.get_message_list)(3)
+        texts = [msg['text'] for msg in page['messages']]
+        while page['has_more']:
+            page = async_to_sync(consumer.get_message_list)(3, before=decode_cursor(page['before']))
+            texts = [msg['text'] for msg in page['messages']] + texts
+        self.assertEqual(texts, [f'm{i}' for i in range(10)])
+
+        page = async_to_sync(consumer.get_message_list)(4, after=(self.messages[1].created_at, self.messages[1].pk))
+        texts = [msg['text'] for msg in page['messages']]
+        while page['has_more']:
+            page = async_to_sync(consumer.get_message_list)(4, after=decode_cursor(page['after']))
+            texts += [msg['text'] for msg in page['messages']]
+        self.assertEqual(texts, [f'm{i}' for i in range(2, 10)])
+
+    def test_read_watermark_survives_archiving(self):
+        ParticipantModel.objects.filter(user=self.bob).update(last_read_id=self.messages[4].pk)
+        self.archive(self.cutoff)
+
+        self.assertEqual(ParticipantModel.objects.get(user=self.bob).last_read_id, self.messages[4].pk)
+        # m7 and m9 are alice's; m6 and m8 are bob's own.
+        self.assertEqual(async_to_sync(self.consumer(self.bob).get_unread_count)(), 2)
+
+    def test_group_list_previews_archived_message(self):
+        self.archive(timezone.now())
+        self.assertFalse(MessageModel.objects.exists())
+
+        result = async_to_sync(MainConsumer().group_list)(self.alice, 10)
+        self.assertEqual(result['groups'][0]['last_message']['text'], 'm9')
+        self.assertEqual(result['groups'][0]['last_message']['sender'], 'alice')
 
-# Create your tests here.
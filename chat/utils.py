@@ -0,0 +1,61 @@
+import asyncio
+import json
+import logging
+import os
+from ipaddress import ip_address, ip_network
+
+from asgiref.sync import SyncToAsync, async_to_sync
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _main_event_loop():
+    if getattr(SyncToAsync.threadlocal, 'main_event_loop_pid', None) == os.getpid():
+        loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+        if loop is not None and loop.is_running():
+            return loop
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception():
+        logger.error('Detached coroutine crashed', exc_info=future.exception())
+
+
+def encode_frame(message, event=None, status='ok'):
+    return json.dumps({
+        'status': status,
+        'event': event,
+        'message': message
+    })
+
+
+def encode_batch(frames):
+    # The frames are already encoded, so the batch is joined as text instead of re-encoded.
+    return '{"status": "ok", "event": "messages.batch", "message": [' + ', '.join(frames) + ']}'
+
+
+_background_tasks = set()
+
+
+def spawn(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_failure)
+    return task
+
+
+def run_detached(coroutine_function, *args):
+    # Inside a sync_to_async worker thread: hand the coroutine to the consumer's loop and return.
+    # Anywhere else (admin, management commands) run it to completion before returning.
+    loop = _main_event_loop()
+    if loop is not None:
+        asyncio.run_coroutine_threadsafe(coroutine_function(*args), loop).add_done_callback(_log_failure)
+    else:
+        async_to_sync(coroutine_function)(*args)
+
+
+def is_internal(address):
+    # Requests over a unix socket come without an address.
+    return not address or any(ip_address(address) in ip_network(net) for net in settings.CHAT_INTERNAL_NETWORKS)
@@ -1,5 +1,14 @@
+import functools
+import os
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
 
+from chat import metrics as chat_metrics
+from chat.utils import is_internal
+
 
 def index(request):
     return render(request, "chat/index.html")
@@ -7,3 +16,27 @@ def index(request):
 
 def room(request, room_name):
     return render(request, "chat/room.html", {"room_name": room_name})
+
+
+def internal(view):
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not is_internal(request.META.get('REMOTE_ADDR')):
+            raise PermissionDenied
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+@internal
+def metrics(request):
+    return HttpResponse(chat_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@internal
+def health(request):
+    return JsonResponse({
+        'status': 'ok',
+        'pid': os.getpid(),
+        'worker_id': settings.CHAT_WRITE_BEHIND.get('WORKER_ID'),
+        'connections': chat_metrics.connections.total(),
+    })
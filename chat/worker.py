@@ -0,0 +1,124 @@
+# One ASGI worker process of manage.py runworkers, started as python -m chat.worker with the
+# listening socket inherited as --fd. It answers /health on a unix socket of its own. SIGTERM drains
+# it: it stops accepting, closes WebSockets with 4012 so clients reconnect to a sibling, and waits up
+# to --graceful-timeout seconds for requests in flight.
+import argparse
+import logging
+import os
+import signal
+import socket
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+# daphne.server installs the asyncio reactor, so it has to come before anything imports twisted's default one.
+from daphne.server import Server  # noqa: E402
+import django  # noqa: E402
+from daphne.utils import import_by_path  # noqa: E402
+from daphne.ws_protocol import WebSocketProtocol  # noqa: E402
+from asgiref.compatibility import guarantee_single_callable  # noqa: E402
+from twisted.internet import reactor  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Like 1012 (service restart), which autobahn won't send: clients take it as a cue to reconnect,
+# while 1000 means the server is done with them.
+DRAIN_CLOSE_CODE = 4012
+
+
+class DrainingServer(Server):
+    def __init__(self, *args, fd, family, graceful_timeout, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fd = fd
+        self.family = family
+        self.graceful_timeout = graceful_timeout
+        self.ports = []
+        self.draining = False
+
+    def adopt(self):
+        # Daphne's fd: endpoint passes the address family on as a string, so only the default
+        # AF_INET would work through it; adopting the socket directly takes either.
+        logger.info('Accepting on inherited socket %s', self.fd)
+        # Every worker wakes up for each new connection; the ones that lose the race to
+        # accept it must get EAGAIN rather than block the reactor.
+        os.set_blocking(self.fd, False)
+        self.listen_success(reactor.adoptStreamPort(self.fd, self.family, self.http_factory))
+
+    def listen_success(self, port):
+        super().listen_success(port)
+        self.ports.append(port)
+
+    def busy(self):
+        # Connections whose application instance is still running: WebSockets until they
+        # close, HTTP connections while a request is in flight. Idle keep-alives don't count.
+        return [
+            protocol for protocol, details in list(self.connections.items())
+            if 'application_instance' in details and not details['application_instance'].done()
+        ]
+
+    def drain(self, *args):
+        if self.draining:
+            return
+        self.draining = True
+        logger.info('Worker %s draining %s connections', os.getpid(), len(self.busy()))
+        for port in self.ports:
+            port.stopListening()
+        for protocol in list(self.connections):
+            if isinstance(protocol, WebSocketProtocol):
+                protocol.serverClose(code=DRAIN_CLOSE_CODE)
+
+        deadline = time.monotonic() + self.graceful_timeout
+
+        def wait():
+            if not self.busy() or time.monotonic() >= deadline:
+                self.stop()
+            else:
+                reactor.callLater(0.1, wait)
+
+        wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m chat.worker')
+    parser.add_argument('application')
+    parser.add_argument('--fd', type=int, required=True)
+    parser.add_argument('--family', choices=['INET', 'INET6'], default='INET')
+    parser.add_argument('--health-socket', required=True)
+    parser.add_argument('--graceful-timeout', type=float, default=30)
+    parser.add_argument('--verbosity', type=int, default=1)
+    parser.add_argument('--proxy-headers', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level={0: logging.WARNING, 1: logging.INFO}.get(args.verbosity, logging.DEBUG),
+        format=f'%(asctime)s [worker {os.getpid()}] %(levelname)s %(name)s %(message)s',
+    )
+    if os.path.exists(args.health_socket):
+        os.unlink(args.health_socket)
+
+    # core.asgi imports the consumers before it sets Django up.
+    django.setup()
+    server = DrainingServer(
+        application=guarantee_single_callable(import_by_path(args.application)),
+        endpoints=[f'unix:{args.health_socket}'],
+        signal_handlers=False,
+        action_logger=None,
+        proxy_forwarded_address_header='X-Forwarded-For' if args.proxy_headers else None,
+        proxy_forwarded_port_header='X-Forwarded-Port' if args.proxy_headers else None,
+        proxy_forwarded_proto_header='X-Forwarded-Proto' if args.proxy_headers else None,
+        fd=args.fd,
+        family=getattr(socket, f'AF_{args.family}'),
+        graceful_timeout=args.graceful_timeout,
+        verbosity=args.verbosity,
+    )
+    # The launcher owns SIGINT (Ctrl+C reaches the whole process group); workers stop on its SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    reactor.callWhenRunning(server.adopt)
+    reactor.callWhenRunning(lambda: signal.signal(signal.SIGTERM, lambda *_: reactor.callFromThread(server.drain)))
+    server.run()
+    if os.path.exists(args.health_socket):
+        os.unlink(args.health_socket)
+
+
+if __name__ == '__main__':
+    main()
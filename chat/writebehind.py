@@ -0,0 +1,296 @@
+import asyncio
+import atexit
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+
+from chat.db import database_write_to_async
+from chat.models import ChatRoomModel, MessageModel
+
+logger = logging.getLogger(__name__)
+
+EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+
+
+class IdGenerator:
+    # 41 bits of milliseconds, 5 of worker id, 7 of sequence: time-ordered and below 2**53.
+    def __init__(self, worker_id):
+        if worker_id is None:
+            raise ImproperlyConfigured(
+                "Write-behind needs CHAT_WRITE_BEHIND['WORKER_ID'], unique across every process on every host"
+            )
+        if not 0 <= worker_id < 1 << WORKER_BITS:
+            raise ImproperlyConfigured(f"CHAT_WRITE_BEHIND['WORKER_ID'] must be between 0 and {(1 << WORKER_BITS) - 1}")
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            worker = self.worker_id
+            now = int(time.time() * 1000) - EPOCH_MS
+            if now <= self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    self._last_ms += 1
+                now = self._last_ms
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | self._sequence
+
+
+def _dump(message):
+    return json.dumps(
+        {field.attname: field.value_from_object(message) for field in MessageModel._meta.concrete_fields},
+        cls=DjangoJSONEncoder
+    )
+
+
+def _load(line):
+    data = json.loads(line)
+    return MessageModel(**{
+        field.attname: field.to_python(data[field.attname])
+        for field in MessageModel._meta.concrete_fields
+        if field.attname in data
+    })
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Journal:
+    def __init__(self, directory, fsync, segment_size):
+        self.directory = Path(directory)
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self._segment = 0
+        self._file = None
+        self._written = 0
+        self._unflushed = Counter()
+        self._lock = threading.Lock()
+
+    def _path(self, segment):
+        return self.directory / f'{os.getpid()}-{segment}.jsonl'
+
+    def append(self, message):
+        with self._lock:
+            if self._file is None or self._written >= self.segment_size:
+                self._rotate()
+            self._file.write(_dump(message) + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._written += 1
+            self._unflushed[self._segment] += 1
+            return self._segment
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+            self._discard_if_flushed(self._segment, current=False)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._segment += 1
+        self._written = 0
+        self._file = open(self._path(self._segment), 'a', encoding='utf-8')
+
+    def _discard_if_flushed(self, segment, current):
+        if not current and self._unflushed[segment] <= 0:
+            del self._unflushed[segment]
+            self._path(segment).unlink(missing_ok=True)
+
+    def flushed(self, segments):
+        with self._lock:
+            for segment in segments:
+                self._unflushed[segment] -= 1
+            for segment in set(segments):
+                self._discard_if_flushed(segment, current=segment == self._segment)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            for segment in list(self._unflushed):
+                self._discard_if_flushed(segment, current=False)
+
+    def orphans(self):
+        # Segments left behind by worker processes that died before flushing them.
+        for path in sorted(self.directory.glob('*-*.jsonl')):
+            pid = int(path.name.split('-')[0])
+            if pid != os.getpid() and not _process_alive(pid):
+                yield path
+
+
+class MessageWriter:
+    def __init__(self, batch_size, flush_interval, max_queue_size, journal=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.journal = journal
+        self._queue = None
+        self._task = None
+        self._in_flight = []
+        self._pending = {}
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.CHAT_WRITE_BEHIND
+        journal = None
+        if config['DURABILITY'] in ('journal', 'fsync'):
+            journal = Journal(
+                config['JOURNAL_DIR'],
+                fsync=config['DURABILITY'] == 'fsync',
+                segment_size=config['BATCH_SIZE'] * 10,
+            )
+        return cls(
+            batch_size=config['BATCH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+            max_queue_size=config['MAX_QUEUE_SIZE'],
+            journal=journal,
+        )
+
+    async def put(self, message):
+        self._ensure_started()
+        segment = self.journal.append(message) if self.journal else None
+        self._pending[message.pk] = message
+        await self._queue.put((message, segment))
+        return message
+
+    def pending(self, group_id):
+        # Messages of the room that this process has broadcast but not written yet.
+        return [message for message in list(self._pending.values()) if str(message.group_id) == str(group_id)]
+
+    def _written(self, batch):
+        for message, _ in batch:
+            self._pending.pop(message.pk, None)
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            pending = self._drain() if self._queue is not None else []
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            for item in pending:
+                self._queue.put_nowait(item)
+            # A fresh context, so the flush loop does not inherit the first caller's database user.
+            self._task = loop.create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self):
+        if self.journal:
+            await database_write_to_async(self.replay_orphans)()
+
+        while True:
+            batch = [await self._queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self._in_flight = batch
+            delay = self.flush_interval
+            while True:
+                try:
+                    await database_write_to_async(self._write)(batch)
+                    self._written(batch)
+                    break
+                except Exception:
+                    logger.exception('Write-behind flush of %d messages failed, retrying', len(batch))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5)
+            self._in_flight = []
+
+    def _write(self, batch):
+        self._insert([message for message, _ in batch])
+        if self.journal:
+            self.journal.flushed([segment for _, segment in batch])
+
+    def _drain(self):
+        items = []
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    def _insert(self, messages):
+        try:
+            with transaction.atomic():
+                MessageModel.objects.bulk_create(messages)
+                self._advance_rooms(messages)
+        except IntegrityError:
+            # Retrying would fail forever: write the rest of the batch and log the clashing rows.
+            for message in messages:
+                try:
+                    with transaction.atomic():
+                        MessageModel.objects.bulk_create([message])
+                        self._advance_rooms([message])
+                except IntegrityError:
+                    logger.error('Write-behind message conflicts with a stored one, not written: %s', _dump(message))
+
+    def _advance_rooms(self, messages):
+        # chat.sequence numbers messages without touching the rooms; last_seq catches up here.
+        last_seqs = {}
+        for message in messages:
+            last_seqs[message.group_id] = max(last_seqs.get(message.group_id, 0), message.seq)
+        for group_id, last_seq in last_seqs.items():
+            ChatRoomModel.objects.filter(pk=group_id, last_seq__lt=last_seq).update(last_seq=last_seq)
+
+    def replay_orphans(self):
+        for path in self.journal.orphans():
+            with open(path, encoding='utf-8') as file:
+                messages = [_load(line) for line in file if line.strip()]
+            for i in range(0, len(messages), self.batch_size):
+                chunk = messages[i:i + self.batch_size]
+                stored = MessageModel.objects.in_bulk([message.pk for message in chunk])
+                new = []
+                for message in chunk:
+                    if message.pk not in stored:
+                        new.append(message)
+                    elif _dump(stored[message.pk]) != _dump(message):
+                        # Only a row that was already flushed before the crash may be skipped.
+                        logger.error('Journaled message conflicts with a stored one, not replayed: %s', _dump(message))
+                self._insert(new)
+            path.unlink(missing_ok=True)
+            logger.info('Replayed %d journaled messages from %s', len(messages), path.name)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        batch = self._in_flight + (self._drain() if self._queue is not None else [])
+        for i in range(0, len(batch), self.batch_size):
+            self._write(batch[i:i + self.batch_size])
+            self._written(batch[i:i + self.batch_size])
+        self._in_flight = []
+        if self.journal:
+            self.journal.close()
+
+
+next_message_id = None
+message_writer = MessageWriter.from_settings()
+
+if settings.CHAT_WRITE_BEHIND['ENABLED']:
+    next_message_id = IdGenerator(settings.CHAT_WRITE_BEHIND['WORKER_ID'])
+    atexit.register(message_writer.close)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -87,23 +88,49 @@ ASGI_APPLICATION = 'core.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite tuned for many concurrent readers and one writer: WAL lets reads run alongside
+# the write in progress, IMMEDIATE transactions take the write lock up front instead of
+# failing on upgrade, and connections live on in the fixed database threads.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA cache_size=-20000;'
+                'PRAGMA mmap_size=134217728;'
+            ),
+        },
     }
 }
 
+DATABASE_ROUTERS = ['chat.dbrouters.ReplicaRouter']
+
 # CHANNEL_LAYERS = {
 #     "default": {
 #         "BACKEND": "channels.layers.InMemoryChannelLayer"
 #     }
 # }
+# Rooms whose members all sit on one worker never leave the process; Redis carries
+# only traffic for members on other workers. Groups are spread over the Redis hosts
+# with a consistent-hash ring, so more hosts can be appended to scale out. See chat/layers.py.
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chat.layers.HybridChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "remote": {
+                "BACKEND": "chat.layers.ShardedRedisChannelLayer",
+                "CONFIG": {
+                    "hosts": [("127.0.0.1", 6379)],
+                },
+            },
         },
     },
 }
@@ -141,3 +168,114 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 APPEND_SLASH = False
+
+
+# Chat
+
+CHAT_MESSAGE_PAGE_SIZE = 50
+CHAT_MESSAGE_PAGE_SIZE_MAX = 200
+CHAT_SYNC_MAX_GAP = 500
+# sync.since stops at a missing seq, which write-behind on another worker may still be
+# flushing, unless the message after it is older than this many seconds.
+CHAT_SYNC_HOLE_TIMEOUT = 10
+CHAT_GROUP_PAGE_SIZE = 50
+CHAT_GROUP_PAGE_SIZE_MAX = 200
+CHAT_PREVIEW_LENGTH = 100
+CHAT_USER_PAGE_SIZE = 50
+CHAT_USER_PAGE_SIZE_MAX = 200
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_PAGE_SIZE_MAX = 100
+CHAT_FANOUT_BATCH_SIZE = 100
+# group.delete hides the room at once and removes its rows in the background,
+# CHAT_DELETE_BATCH_SIZE per transaction, reporting progress to the creator at most
+# every CHAT_DELETE_PROGRESS_INTERVAL seconds. `manage.py purge_deleted_groups` finishes
+# deletions a restart interrupted.
+CHAT_DELETE_BATCH_SIZE = 1000
+CHAT_DELETE_PROGRESS_INTERVAL = 1
+# With a Redis channel layer, room presence entries live this many seconds unless the
+# connection refreshes them (every third of it), so a crashed worker's users age out.
+CHAT_PRESENCE_TTL = 60
+# Worker threads for the sync ORM calls left on database_sync_to_async; size it from
+# chat_db_queue_wait_seconds and chat_db_queue_depth on /metrics. Writes always go
+# through a single writer thread of their own.
+CHAT_DB_THREADS = 4
+# History, group list and directory reads may go to one of the CHAT_DATABASE_REPLICAS
+# aliases; everything else uses CHAT_DATABASE_PRIMARY. A user who writes reads from the
+# primary for CHAT_REPLICA_PIN_SECONDS afterwards, so replication lag never hides their own changes.
+# The pin is broadcast over the channel layer, so it holds on every worker sharing that layer.
+CHAT_DATABASE_PRIMARY = 'default'
+CHAT_DATABASE_REPLICAS = []
+CHAT_REPLICA_PIN_SECONDS = 5
+CHAT_ROOM_CACHE_SIZE = 10000
+CHAT_ROOM_CACHE_TTL = 60
+CHAT_TOKEN_CACHE_SIZE = 10000
+CHAT_TOKEN_CACHE_TTL = 300
+CHAT_DIRECTORY_CACHE_SIZE = 1000
+CHAT_DIRECTORY_CACHE_TTL = 30
+# /metrics, /health and runworkers' --health-port answer only clients in CHAT_INTERNAL_NETWORKS,
+# or on a unix socket. Behind a proxy on the same host, pass the client address on
+# (--proxy-headers) or block the paths there.
+CHAT_INTERNAL_NETWORKS = ['127.0.0.0/8', '::1/128']
+
+# Token-bucket limits on incoming events as (events per second, burst). CONNECTION applies
+# to one socket, USER to all of a user's sockets served by this process. '*' covers events
+# without an entry of their own; a missing or None limit is not enforced.
+CHAT_RATE_LIMITS = {
+    '*': {'CONNECTION': (10, 20), 'USER': (20, 40)},
+    'send.message': {'CONNECTION': (5, 10), 'USER': (10, 20)},
+    'list.message': {'CONNECTION': (5, 10), 'USER': (10, 20)},
+    'search.message': {'CONNECTION': (2, 5), 'USER': (4, 10)},
+}
+CHAT_RATE_LIMIT_USERS = 10000
+
+# Under daphne, frames to a client with more than CHAT_SEND_BUFFER_HIGH_WATER bytes still
+# unsent on its socket wait in a queue of CHAT_SEND_QUEUE_SIZE frames. When a slow reader
+# fills it, CHAT_SEND_QUEUE_POLICY decides: 'drop_oldest', 'drop_newest' or 'disconnect'
+# (close with 4013 so the client reconnects and catches up with sync.since). Other ASGI
+# servers don't expose the transport, and frames are sent without this protection.
+CHAT_SEND_BUFFER_HIGH_WATER = 64 * 1024
+CHAT_SEND_QUEUE_SIZE = 1000
+CHAT_SEND_QUEUE_POLICY = 'disconnect'
+
+# Connections that send batch.mode get the broadcasts arriving within CHAT_BATCH_WINDOW
+# seconds, up to CHAT_BATCH_MAX_SIZE of them, as one messages.batch frame.
+CHAT_BATCH_WINDOW = 0.02
+CHAT_BATCH_MAX_SIZE = 50
+
+# Retention per ChatRoomModel.type: `manage.py archive_messages` moves messages older than
+# this many days (None keeps them in the table) into compressed per-room segment files
+# under CHAT_ARCHIVE_DIR, where list.message keeps paging into them. See chat/archive.py.
+CHAT_RETENTION_DAYS = {
+    'dialog': None,
+    'group': None,
+}
+CHAT_ARCHIVE_DIR = BASE_DIR / 'archive'
+CHAT_ARCHIVE_BATCH_SIZE = 1000
+CHAT_ARCHIVE_BLOCK_SIZE = 100
+CHAT_ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# `manage.py runworkers` serves ASGI_APPLICATION from CHAT_WORKERS processes (None: one
+# per CPU, at most 16) sharing one listening socket. Workers get CHAT_WORKER_GRACEFUL_TIMEOUT
+# seconds to drain on reload or shutdown, and one that fails CHAT_WORKER_HEALTH_FAILURES
+# /health checks in a row (every CHAT_WORKER_HEALTH_INTERVAL seconds) is replaced.
+CHAT_WORKERS = None
+CHAT_WORKER_GRACEFUL_TIMEOUT = 30
+CHAT_WORKER_HEALTH_INTERVAL = 5
+CHAT_WORKER_HEALTH_TIMEOUT = 2
+CHAT_WORKER_HEALTH_FAILURES = 3
+
+# Opt-in write-behind persistence for chat messages: messages get a server-assigned id,
+# are broadcast immediately and are inserted in batches.
+# DURABILITY: 'memory' (lost if the process crashes), 'journal' (appended to a local
+# journal before broadcast, replayed after a crash) or 'fsync' (journal is fsynced too).
+CHAT_WRITE_BEHIND = {
+    'ENABLED': False,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 0.05,
+    'MAX_QUEUE_SIZE': 10000,
+    'DURABILITY': 'journal',
+    'JOURNAL_DIR': BASE_DIR / 'journal',
+    # 0-31, required when ENABLED and unique across every process on every host. runworkers
+    # sets CHAT_WORKER_ID, which is only unique within one host.
+    'WORKER_ID': int(os.environ['CHAT_WORKER_ID']) if 'CHAT_WORKER_ID' in os.environ else None,
+}
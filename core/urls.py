@@ -18,8 +18,12 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.authtoken import views
 
+from chat.views import health, metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
+    path('health', health, name='health'),
     path('', include('chat.urls')),
     path('auth/', views.ObtainAuthToken.as_view(), name='auth')
 ]